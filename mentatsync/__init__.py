@@ -14,6 +14,7 @@ def includeme(config):
     config.include("mozsvc")
     # Add in the stuff we define ourselves.
     config.include("mentatsync.storage")
+    config.include("mentatsync.notify")
     config.scan("mentatsync.views")
 
 
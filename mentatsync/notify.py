@@ -0,0 +1,235 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Notification of head changes, for clients watching for new data.
+
+This module lets request handlers block until a user's head changes,
+without repeatedly polling the storage backend.  Whenever the head is
+set, the code that set it calls notify() on a HeadNotifier, which wakes
+any requests waiting on that user's head.
+
+The default LocalNotifier only knows about waiters in the current process.
+For deployments with multiple worker processes, a BrokerNotifier fans out
+notifications to every process via a publish/subscribe message broker.
+Configure it in the "notifier" section of the config file like so:
+
+    [notifier]
+    backend = mentatsync.notify.BrokerNotifier
+    broker = mentatsync.notify.RedisBroker
+    url = redis://localhost:6379/0
+
+"""
+
+import abc
+import json
+import logging
+import threading
+import contextlib
+import collections
+
+from mozsvc.plugin import resolve_name
+
+
+logger = logging.getLogger(__name__)
+
+
+class HeadNotifier(object):
+    """Abstract Base Class for notifying waiters of head changes."""
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def notify(self, userid, head):
+        """Notify any waiters that the user's head has changed."""
+
+    @abc.abstractmethod
+    def watch(self, userid):
+        """Context manager producing a HeadWaiter for the given user.
+
+        The waiter will see any notifications that occur after it is
+        created, so callers should create it *before* checking the
+        current head, to avoid missing a change that happens in between.
+        """
+
+    def close(self):
+        """Release any resources held by the notifier."""
+
+
+class HeadWaiter(object):
+    """A single request waiting for a user's head to change."""
+
+    def __init__(self):
+        self.head = None
+        self._event = threading.Event()
+
+    def wake(self, head):
+        """Wake the waiter, telling it about the new head."""
+        self.head = head
+        self._event.set()
+
+    def wait(self, timeout):
+        """Wait for the head to change, returning the new head.
+
+        If the timeout expires first then None is returned.
+        """
+        self._event.wait(timeout)
+        return self.head
+
+
+class LocalNotifier(HeadNotifier):
+    """HeadNotifier that wakes waiters in the current process only.
+
+    Waiters block on a threading.Event, which becomes a greenlet-friendly
+    primitive when running under gevent with monkey-patching.
+    """
+
+    def __init__(self):
+        self._waiters = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def notify(self, userid, head):
+        self._wake(userid, head)
+
+    @contextlib.contextmanager
+    def watch(self, userid):
+        waiter = HeadWaiter()
+        with self._lock:
+            self._waiters[userid].add(waiter)
+        try:
+            yield waiter
+        finally:
+            with self._lock:
+                waiters = self._waiters[userid]
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[userid]
+
+    def _wake(self, userid, head):
+        """Wake all waiters for the given user in this process."""
+        with self._lock:
+            waiters = list(self._waiters.get(userid, ()))
+        for waiter in waiters:
+            waiter.wake(head)
+
+
+class BrokerNotifier(LocalNotifier):
+    """HeadNotifier that fans out notifications via a message broker.
+
+    Notifications are published to the broker rather than delivered
+    directly.  Each process subscribes to the broker, and wakes its local
+    waiters for every message it receives, including its own.  The broker
+    can be given as an object or as the dotted name of a class, in which
+    case any extra keyword arguments are passed to its constructor.
+    """
+
+    def __init__(self, broker, **broker_kwds):
+        super(BrokerNotifier, self).__init__()
+        if isinstance(broker, basestring):
+            broker = resolve_name(broker)(**broker_kwds)
+        self.broker = broker
+        self.broker.subscribe(self._on_message)
+
+    def notify(self, userid, head):
+        self.broker.publish(json.dumps({"userid": userid, "head": head}))
+
+    def close(self):
+        self.broker.unsubscribe(self._on_message)
+
+    def _on_message(self, message):
+        try:
+            message = json.loads(message)
+            self._wake(message["userid"], message["head"])
+        except (ValueError, KeyError, TypeError):
+            logger.exception("Invalid head notification: %r", message)
+
+
+class LocalBroker(object):
+    """In-process stand-in for a publish/subscribe message broker.
+
+    All LocalBroker instances with the same channel name share the same
+    set of subscribers, so multiple BrokerNotifiers in a single process
+    can simulate a multi-process deployment for testing.  Subscribers stay
+    registered until they unsubscribe, so tests should close any notifiers
+    they create.
+    """
+
+    _channels = collections.defaultdict(list)
+    _channels_lock = threading.Lock()
+
+    def __init__(self, channel="default"):
+        self.channel = channel
+
+    def publish(self, message):
+        with self._channels_lock:
+            subscribers = list(self._channels[self.channel])
+        for callback in subscribers:
+            callback(message)
+
+    def subscribe(self, callback):
+        with self._channels_lock:
+            self._channels[self.channel].append(callback)
+
+    def unsubscribe(self, callback):
+        with self._channels_lock:
+            subscribers = self._channels[self.channel]
+            subscribers.remove(callback)
+            if not subscribers:
+                del self._channels[self.channel]
+
+
+class RedisBroker(object):
+    """Message broker using Redis publish/subscribe.
+
+    Each subscriber gets a background thread that listens for messages
+    on the channel.  This requires the "redis" package to be installed.
+    """
+
+    def __init__(self, url="redis://localhost:6379/0",
+                 channel="mentatsync:heads"):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.channel = channel
+        self._subscriptions = {}
+
+    def publish(self, message):
+        self.client.publish(self.channel, message)
+
+    def subscribe(self, callback):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+
+        def listen():
+            for item in pubsub.listen():
+                callback(item["data"])
+
+        thread = threading.Thread(target=listen)
+        thread.daemon = True
+        thread.start()
+        self._subscriptions[callback] = pubsub
+
+    def unsubscribe(self, callback):
+        # The listening thread exits once the unsubscription is confirmed.
+        self._subscriptions.pop(callback).unsubscribe()
+
+
+def get_notifier(request):
+    """Returns the HeadNotifier instance to use for a given request."""
+    return request.registry["mentatsync:notifier"]
+
+
+def includeme(config):
+    """Load the head notifier for use by the given configurator.
+
+    The notifier is configured from the "notifier" section of the settings,
+    whose "backend" setting gives the class to use.  Other settings are
+    passed to the class constructor as keyword arguments.  If there is no
+    such section, a LocalNotifier is used.
+    """
+    settings = config.registry.settings
+    notifier_settings = settings.getsection("notifier")
+    backend = notifier_settings.pop("backend", LocalNotifier)
+    if isinstance(backend, basestring):
+        backend = resolve_name(backend)
+    config.registry["mentatsync:notifier"] = backend(**notifier_settings)
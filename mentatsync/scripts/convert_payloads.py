@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Background conversion of legacy chunk payloads into shared payloads.
+
+Chunk payloads used to be stored inline in the chunks table, first as base64
+text and later as raw binary.  They are now stored once per unique content
+in a separate "payloads" table, keyed by their SHA256 hash and reference
+counted, with the chunks table pointing at them by hash.  Legacy rows are
+recognizable by having a non-NULL "payload_encoding" column, which says
+how to interpret their inline payload.
+
+To migrate an existing database, first stop the server and bring its schema
+up to date; see mentatsync.scripts.migrate_schema for details.  That keeps
+the existing chunk payloads inline, marking them as legacy base64 rows.
+
+The server can read both old and new rows, so it is safe to put it back into
+service immediately.  Then run this script to gradually convert the existing
+rows in the background, a small batch at a time:
+
+    mentatsync-convert-payloads /path/to/config.ini
+
+"""
+
+import os
+import sys
+import time
+import logging
+import optparse
+
+import mozsvc.config
+
+from mentatsync.storage import (load_storage_from_settings,
+                                iter_base_storages)
+
+
+logger = logging.getLogger("mentatsync.scripts.convert_payloads")
+
+
+def convert_payloads(storage, batch_size=100, sleep_time=0.1):
+    """Convert all legacy chunk payloads in the given SQLStorage backend.
+
+    Chunks are converted a batch at a time, each in its own short database
+    transaction, sleeping for the given number of seconds between batches
+    so as not to overload the database.
+    """
+    num_batches = 0
+    last_key = storage.convert_legacy_chunks(limit=batch_size)
+    while last_key is not None:
+        num_batches += 1
+        logger.debug("Converted %d batches, up to %r", num_batches, last_key)
+        time.sleep(sleep_time)
+        last_key = storage.convert_legacy_chunks(last_key, limit=batch_size)
+    logger.info("Finished converting legacy chunk payloads")
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the convert_payloads() function.
+    """
+    usage = "usage: %prog [options] config_file"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--batch-size", type="int", default=100,
+                      help="Number of chunks to convert in each batch")
+    parser.add_option("", "--sleep-time", type="float", default=0.1,
+                      help="Seconds to sleep between each batch")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    level = logging.DEBUG if opts.verbosity else logging.INFO
+    logging.basicConfig(stream=sys.stderr, level=level,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    config_file = os.path.abspath(args[0])
+    config = mozsvc.config.get_configurator({"__file__": config_file})
+    storage = load_storage_from_settings("storage", config.registry.settings)
+    # Convert each underlying SQLStorage instance, skipping any wrappers.
+    for base_storage in iter_base_storages(storage):
+        convert_payloads(base_storage, opts.batch_size, opts.sleep_time)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
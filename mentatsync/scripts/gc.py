@@ -0,0 +1,173 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Background garbage collection of abandoned data in the SQL backend.
+
+Clients create pending transactions and upload chunks before committing
+them by advancing the head.  If a client goes away part-way through a sync,
+or loses a race to commit, those pending transactions are never committed
+and the chunks it uploaded may never be referenced by anything.
+
+Resetting a user's storage doesn't delete anything immediately either.
+Instead the user is switched to a new, empty store, and their old store is
+marked as dead.  Its rows are then deleted in the background.
+
+Similarly, once a client has registered a snapshot of a store's full
+state, all of the committed history before that snapshot is redundant.
+
+This script finds and deletes such data in six passes:
+
+  * all rows belonging to dead stores, a few minutes after they were reset
+  * committed transactions that precede the store's newest snapshot, and
+    the chunk lists of any older snapshots
+  * pending branches that haven't been extended for a while, along with
+    their transactions
+  * chunks that aren't part of any transaction, and were uploaded a while
+    ago, dropping their references to the corresponding payloads
+  * payloads that have no remaining references, including their files in
+    the filestore
+  * files in the filestore that have no payload, and were written a while
+    ago, which can be left behind by uploads that failed to commit
+
+Each pass walks a table in primary key order (or the filestore in name
+order) a small batch at a time, using a separate short database transaction
+for each batch and sleeping between batches, so that it never holds locks
+on the hot tables for long.  Run it periodically from cron, or leave it
+running with --interval:
+
+    mentatsync-gc --max-age=604800 /path/to/config.ini
+
+To tell how recently things were used, it relies on the "last_modified"
+column of the branches table and the "created" column of the chunks table.
+It also relies on indexes over transactions(userid, branch) and over
+transaction_chunks(userid, chunk).  To add them to an existing database,
+along with the new tables used for resets and snapshots, bring its schema
+up to date; see mentatsync.scripts.migrate_schema for details.  Existing
+rows will have NULL timestamps, and are treated as being old.
+
+"""
+
+import os
+import sys
+import time
+import logging
+import optparse
+
+import mozsvc.config
+
+from mentatsync.storage import (load_storage_from_settings,
+                                iter_base_storages)
+from mentatsync.storage.sql import DEFAULT_GC_MAX_AGE, DEFAULT_PURGE_DELAY
+
+
+logger = logging.getLogger("mentatsync.scripts.gc")
+
+
+def collect_garbage(storage, batch_size=100, sleep_time=0.1,
+                    max_age=DEFAULT_GC_MAX_AGE,
+                    purge_delay=DEFAULT_PURGE_DELAY):
+    """Run a full garbage-collection pass over the given SQLStorage backend.
+
+    Each batch is processed in its own short database transaction, sleeping
+    for the given number of seconds between batches so as not to overload
+    the database.  Branches and chunks are only collected if they have not
+    been written to for "max_age" seconds, and dead stores are only purged
+    "purge_delay" seconds after the user was reset.
+    """
+    # The order matters: purging dead stores, pruning history and deleting
+    # stale branches can leave chunks and payloads without references, and
+    # deleting chunks can leave payloads without references.
+    _run_in_batches("dead stores", sleep_time, lambda start: (
+        storage.gc_dead_stores(start, batch_size, purge_delay)
+    ))
+    _run_in_batches("snapshot history", sleep_time, lambda start: (
+        storage.gc_snapshot_history(start, batch_size)
+    ))
+    _run_in_batches("stale branches", sleep_time, lambda start: (
+        storage.gc_stale_branches(start, batch_size, max_age)
+    ))
+    _run_in_batches("unreferenced chunks", sleep_time, lambda start: (
+        storage.gc_unreferenced_chunks(start, batch_size, max_age)
+    ))
+    _run_in_batches("unreferenced payloads", sleep_time, lambda start: (
+        storage.gc_unreferenced_payloads(start, batch_size)
+    ))
+    _run_in_batches("orphaned files", sleep_time, lambda start: (
+        storage.gc_orphaned_files(start, batch_size, max_age)
+    ))
+    logger.info("Finished collecting garbage")
+
+
+def collect_all_garbage(storage, **kwds):
+    """Run garbage collection on each SQL backend underlying the given one.
+
+    This skips past any wrappers around the backend, and descends into each
+    shard of a sharded backend.  Other backends, which have no need for
+    garbage collection, are ignored.
+    """
+    for base_storage in iter_base_storages(storage):
+        if hasattr(base_storage, "gc_stale_branches"):
+            collect_garbage(base_storage, **kwds)
+
+
+def _run_in_batches(description, sleep_time, run_batch):
+    """Call run_batch repeatedly, until it returns None."""
+    num_batches = 0
+    last_key = run_batch(None)
+    while last_key is not None:
+        num_batches += 1
+        logger.debug("Scanned %d batches of %s, up to %r",
+                     num_batches, description, last_key)
+        time.sleep(sleep_time)
+        last_key = run_batch(last_key)
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the collect_garbage() function.
+    """
+    usage = "usage: %prog [options] config_file"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--batch-size", type="int", default=100,
+                      help="Number of rows to scan in each batch")
+    parser.add_option("", "--sleep-time", type="float", default=0.1,
+                      help="Seconds to sleep between each batch")
+    parser.add_option("", "--max-age", type="int",
+                      default=DEFAULT_GC_MAX_AGE,
+                      help="Seconds after which abandoned data is collected")
+    parser.add_option("", "--purge-delay", type="int",
+                      default=DEFAULT_PURGE_DELAY,
+                      help="Seconds after a reset to purge the user's data")
+    parser.add_option("", "--interval", type="int", default=0,
+                      help="Repeat every this many seconds, rather than once")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    level = logging.DEBUG if opts.verbosity else logging.INFO
+    logging.basicConfig(stream=sys.stderr, level=level,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    config_file = os.path.abspath(args[0])
+    config = mozsvc.config.get_configurator({"__file__": config_file})
+    storage = load_storage_from_settings("storage", config.registry.settings)
+
+    while True:
+        collect_all_garbage(storage, batch_size=opts.batch_size,
+                            sleep_time=opts.sleep_time, max_age=opts.max_age,
+                            purge_delay=opts.purge_delay)
+        if not opts.interval:
+            return 0
+        time.sleep(opts.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Offline upgrade of an existing SQL database to the current schema.
+
+The schema has changed in several ways since the first release:
+
+  * pending transactions are grouped into "branches", and the current head
+    of each store is kept in the "heads" table, rather than being derived
+    from the "committed", "prev_head" and "next_head" columns of the
+    transactions table
+  * chunk payloads are stored as binary, shared between users via the
+    "payloads" table, and chunks record when they were created
+  * users are mapped to stores via the "user_stores" table, and reset
+    stores are queued for purging in the "dead_stores" table
+  * stores can have snapshots, in the "snapshots" and "snapshot_chunks"
+    tables
+  * there are new indexes to support garbage collection
+
+This script brings a database up to date from any earlier version of the
+schema, and does nothing if it is already up to date.  It currently
+supports MySQL and SQLite.  To upgrade, stop the server, back up the
+database, and then run:
+
+    mentatsync-migrate-schema /path/to/config.ini
+
+Old-style transactions are copied into a rebuilt transactions table.  Each
+committed transaction becomes its own committed branch, each pending chain
+becomes a pending branch starting at its first transaction, and the newest
+committed transaction of each store becomes its head.  Old-style chunks
+are copied into a rebuilt chunks table and marked as legacy base64 rows,
+leaving their payloads inline.
+
+The server can read both old and new chunk rows, so it is safe to put it
+back into service immediately.  The legacy chunk payloads can then be moved
+into the payloads table in the background, and abandoned data collected,
+using the mentatsync-convert-payloads and mentatsync-gc scripts.  Migrated
+rows have NULL timestamps, and so are treated as being old by the latter.
+
+"""
+
+import os
+import sys
+import logging
+import optparse
+
+import mozsvc.config
+
+from sqlalchemy import MetaData, Table
+from sqlalchemy.engine import reflection
+from sqlalchemy.sql import text as sqltext
+
+from mentatsync.storage import (load_storage_from_settings,
+                                iter_base_storages)
+from mentatsync.storage.sql import dbconnect
+
+
+logger = logging.getLogger("mentatsync.scripts.migrate_schema")
+
+
+# Copy the old-style transactions into the rebuilt table.  Each committed
+# transaction is its own branch.  Each pending chain shares a "next_head",
+# and becomes a branch named after its first transaction, which is the one
+# whose parent isn't pending.
+
+_COPY_COMMITTED_TRANSACTIONS = """
+    INSERT INTO transactions (userid, trnid, parent, seq, branch)
+    SELECT userid, trnid, parent, seq, trnid
+    FROM transactions_legacy
+    WHERE committed
+"""
+
+_COPY_PENDING_TRANSACTIONS = """
+    INSERT INTO transactions (userid, trnid, parent, seq, branch)
+    SELECT t.userid, t.trnid, t.parent, t.seq, f.trnid
+    FROM transactions_legacy AS t
+    INNER JOIN transactions_legacy AS f
+    ON f.userid = t.userid AND f.next_head = t.next_head
+    WHERE NOT t.committed AND NOT f.committed
+    AND NOT EXISTS (
+        SELECT 1 FROM transactions_legacy AS p
+        WHERE p.userid = f.userid AND p.trnid = f.parent
+        AND NOT p.committed
+    )
+"""
+
+_CREATE_COMMITTED_BRANCHES = """
+    INSERT INTO branches (userid, branch, base, tip, committed)
+    SELECT userid, trnid, parent, trnid, 1
+    FROM transactions_legacy
+    WHERE committed
+"""
+
+_CREATE_PENDING_BRANCHES = """
+    INSERT INTO branches (userid, branch, base, tip, committed)
+    SELECT f.userid, f.trnid, f.parent, f.next_head, 0
+    FROM transactions_legacy AS f
+    WHERE NOT f.committed
+    AND NOT EXISTS (
+        SELECT 1 FROM transactions_legacy AS p
+        WHERE p.userid = f.userid AND p.trnid = f.parent
+        AND NOT p.committed
+    )
+"""
+
+_CREATE_HEADS = """
+    INSERT INTO heads (userid, trnid, seq)
+    SELECT t.userid, t.trnid, t.seq
+    FROM transactions_legacy AS t
+    WHERE t.committed
+    AND NOT EXISTS (
+        SELECT 1 FROM transactions_legacy AS t2
+        WHERE t2.userid = t.userid AND t2.committed AND t2.seq > t.seq
+    )
+"""
+
+# Copy the old-style chunks into the rebuilt table, taking whichever of the
+# new columns already exist and marking all inline payloads as base64.
+
+_COPY_CHUNKS = """
+    INSERT INTO chunks
+        (userid, chunk, payload_hash, payload, payload_encoding, created)
+    SELECT userid, chunk, {payload_hash}, payload,
+        {payload_encoding}, {created}
+    FROM chunks_legacy
+"""
+
+
+def migrate_schema(storage):
+    """Upgrade the database of the given SQLStorage backend in place.
+
+    Tables that need rebuilding are renamed aside, re-created and copied
+    across; missing tables, nullable columns and indexes are then added.
+    This should only be run while the server is stopped.
+    """
+    engine = storage.dbconnector.engine
+    inspector = reflection.Inspector.from_engine(engine)
+    tables = set(inspector.get_table_names())
+    if "transactions" in tables:
+        columns = _get_column_names(inspector, "transactions")
+        if "committed" in columns:
+            _migrate_transactions(engine)
+    if "chunks" in tables:
+        columns = _get_column_names(inspector, "chunks")
+        if "payload_encoding" not in columns:
+            _migrate_chunks(engine, columns)
+    _add_missing_tables(engine)
+    logger.info("Finished migrating the schema")
+
+
+def migrate_all_schemas(storage):
+    """Upgrade the database of each SQL backend underlying the given one.
+
+    This skips past any wrappers around the backend, and descends into each
+    shard of a sharded backend.  Other backends are ignored.
+    """
+    for base_storage in iter_base_storages(storage):
+        if hasattr(base_storage, "dbconnector"):
+            migrate_schema(base_storage)
+
+
+def _get_column_names(inspector, table_name):
+    return set(c["name"] for c in inspector.get_columns(table_name))
+
+
+def _rename_aside(engine, table_name):
+    """Rename a table to "<name>_legacy", dropping its indexes.
+
+    Index names must be unique across the whole database in some backends,
+    so the old ones have to go before the rebuilt table can be created.
+    """
+    table = Table(table_name, MetaData(), autoload=True, autoload_with=engine)
+    for index in table.indexes:
+        index.drop(engine)
+    with engine.begin() as connection:
+        connection.execute(sqltext(
+            "ALTER TABLE {0} RENAME TO {0}_legacy".format(table_name)
+        ))
+
+
+def _drop_legacy(engine, table_name):
+    with engine.begin() as connection:
+        connection.execute(sqltext("DROP TABLE {0}_legacy".format(table_name)))
+
+
+def _migrate_transactions(engine):
+    """Rebuild the transactions table, backfilling branches and heads."""
+    logger.info("Migrating transactions to branches and heads")
+    _rename_aside(engine, "transactions")
+    dbconnect.transactions.create(engine)
+    dbconnect.branches.create(engine, checkfirst=True)
+    dbconnect.heads.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        for query in (_COPY_COMMITTED_TRANSACTIONS,
+                      _COPY_PENDING_TRANSACTIONS,
+                      _CREATE_COMMITTED_BRANCHES,
+                      _CREATE_PENDING_BRANCHES,
+                      _CREATE_HEADS):
+            connection.execute(sqltext(query))
+    _drop_legacy(engine, "transactions")
+
+
+def _migrate_chunks(engine, columns):
+    """Rebuild the chunks table, marking existing payloads as legacy."""
+    logger.info("Migrating chunks to nullable inline payloads")
+    _rename_aside(engine, "chunks")
+    dbconnect.chunks.create(engine)
+    query = _COPY_CHUNKS.format(
+        payload_hash="payload_hash" if "payload_hash" in columns else "NULL",
+        payload_encoding="'{}'".format(dbconnect.PAYLOAD_ENCODING_BASE64),
+        created="created" if "created" in columns else "NULL",
+    )
+    with engine.begin() as connection:
+        connection.execute(sqltext(query))
+    _drop_legacy(engine, "chunks")
+
+
+def _add_missing_tables(engine):
+    """Create missing tables, and add missing nullable columns and indexes.
+
+    Tables that already exist have been rebuilt if necessary, so anything
+    they still lack can be added in place.
+    """
+    inspector = reflection.Inspector.from_engine(engine)
+    tables = set(inspector.get_table_names())
+    for table in dbconnect.metadata.sorted_tables:
+        if table.name not in tables:
+            logger.info("Creating table %s", table.name)
+            table.create(engine)
+            continue
+        columns = _get_column_names(inspector, table.name)
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            if not column.nullable:
+                raise RuntimeError("can't add non-nullable column %s.%s" % (
+                                   table.name, column.name))
+            logger.info("Adding column %s.%s", table.name, column.name)
+            with engine.begin() as connection:
+                connection.execute(sqltext(
+                    "ALTER TABLE {} ADD COLUMN {} {} NULL".format(
+                        table.name, column.name,
+                        column.type.compile(dialect=engine.dialect))
+                ))
+        indexes = set(i["name"] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                logger.info("Creating index %s", index.name)
+                index.create(engine)
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the migrate_schema() function.
+    """
+    usage = "usage: %prog [options] config_file"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    level = logging.DEBUG if opts.verbosity else logging.INFO
+    logging.basicConfig(stream=sys.stderr, level=level,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    config_file = os.path.abspath(args[0])
+    config = mozsvc.config.get_configurator({"__file__": config_file})
+    storage = load_storage_from_settings("storage", config.registry.settings)
+    migrate_all_schemas(storage)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
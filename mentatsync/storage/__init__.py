@@ -7,8 +7,10 @@ Abstract interface definition for storage backends.
 
 """
 
+import os
 import abc
 import logging
+from StringIO import StringIO
 
 from mozsvc.plugin import resolve_name
 
@@ -44,6 +46,11 @@ class ConflictError(StorageError):
     pass
 
 
+class ChunkHashMismatchError(StorageError):
+    """Exception raised when a chunk's id doesn't match its content hash."""
+    pass
+
+
 class MentatSyncStorage(object):
     """Abstract Base Class for storage backends."""
 
@@ -62,8 +69,24 @@ class MentatSyncStorage(object):
         """Updates the transaction id for the current head."""
 
     @abc.abstractmethod
-    def get_transactions(self, userid, frm, limit):
-        """Returns an iterator of transactions in increasing sequence order."""
+    def get_transaction_seq(self, userid, trnid):
+        """Returns the sequence number of a specific committed transaction."""
+
+    @abc.abstractmethod
+    def get_transactions_after(self, userid, seq, limit):
+        """Returns an iterator of committed transactions after the given seq.
+
+        The transactions are produced in increasing sequence order, as dicts
+        with keys "id" and "seq".  Use a seq of zero to start from the root.
+        """
+
+    @abc.abstractmethod
+    def get_transactions_with_chunks_after(self, userid, seq, limit):
+        """Returns an iterator of transaction dicts, including their chunks.
+
+        This is like get_transactions_after, but each dict also has keys
+        "parent" and "chunks".
+        """
 
     @abc.abstractmethod
     def create_transaction(self, userid, trnid, prev_trnid, chunks):
@@ -71,22 +94,104 @@ class MentatSyncStorage(object):
 
     @abc.abstractmethod
     def get_transaction(self, userid, trnid):
-        """Returns a specific transaction."""
+        """Returns a specific transaction.
+
+        The transaction is returned as a dict with keys "id", "seq",
+        "parent", "chunks", and "committed" to say whether it has been
+        committed by advancing the head to it or one of its descendants.
+        """
+
+    @abc.abstractmethod
+    def get_snapshot(self, userid):
+        """Returns the newest snapshot, or None if there isn't one.
+
+        The snapshot is returned as a dict with keys "id" and "seq", giving
+        the committed transaction whose state it captures.
+        """
+
+    @abc.abstractmethod
+    def get_snapshot_with_chunks(self, userid):
+        """Returns the newest snapshot including its chunks, or None.
+
+        This is like get_snapshot, but the dict also has key "chunks".
+        """
+
+    @abc.abstractmethod
+    def create_snapshot(self, userid, trnid, chunks):
+        """Creates a snapshot of the state as of a committed transaction.
+
+        The chunks must together represent the full state of the store as
+        of the given transaction, so that clients can start from them rather
+        than replaying all of the history before it.  The snapshot replaces
+        any existing one, and so must be of a later transaction.  Committed
+        transactions older than the newest snapshot may then be pruned.
+        """
 
     @abc.abstractmethod
     def create_chunk(self, userid, chunk, contents):
         """Creates a specific chunk."""
 
+    @abc.abstractmethod
+    def create_chunks(self, userid, chunks):
+        """Creates many chunks, from an iterable of (chunk, payload) pairs."""
+
     @abc.abstractmethod
     def get_chunk(self, userid, chunk):
         """Returns a specific chunk."""
 
+    def open_chunk(self, userid, chunk):
+        """Returns a specific chunk, as a readable file-like object.
+
+        Backends can override this to avoid reading large payloads fully
+        into memory, e.g. by returning a file from the local filesystem.
+        """
+        return StringIO(self.get_chunk(userid, chunk))
+
+    def create_chunk_from_file(self, userid, chunk, fileobj):
+        """Creates a specific chunk, reading its contents from a file.
+
+        Backends can override this to avoid reading large payloads fully
+        into memory, e.g. by streaming them into a file on disk.
+        """
+        self.create_chunk(userid, chunk, fileobj.read())
+
+    def open_chunk_encoded(self, userid, chunk, encodings):
+        """Returns a specific chunk as a file-like object, and its encoding.
+
+        If the backend happens to store the chunk in one of the given
+        content-encodings (e.g. "gzip") then it may return the encoded
+        data as-is, avoiding the cost of decoding it.  Otherwise this is
+        the same as open_chunk, with an encoding of "identity".
+        """
+        return self.open_chunk(userid, chunk), "identity"
+
+    @abc.abstractmethod
+    def get_chunks(self, userid, chunks):
+        """Returns an iterator of (chunk, payload) pairs for many chunks.
+
+        The pairs are produced in the order requested.  Chunks that do not
+        exist are silently omitted from the results.
+        """
+
+    @abc.abstractmethod
+    def push(self, userid, chunks, transactions, head=None):
+        """Atomically creates chunks and transactions, and updates the head.
+
+        This combines create_chunks, create_transaction and set_head into
+        a single atomic operation.  The chunks are given as an iterable of
+        (chunk, payload) pairs, and the transactions as a list of dicts with
+        keys "id", "parent" and "chunks".  If the head is given, it will be
+        updated to the given transaction id.  If any part of the operation
+        fails then none of it will take effect.
+        """
+
 
 def get_storage(request):
     """Returns a storage backend instance, given a request object.
 
     This function retrieves the appropriate storage backend instance to
-    use for a given request.  Imaging it doing some sort of clever sharding.
+    use for a given request.  Sharding of users across multiple backends
+    is handled by configuring a ShardedStorage instance as the backend.
     """
     return request.registry["mentatsync:storage:default"]
 
@@ -116,12 +221,55 @@ def load_storage_from_settings(section_name, settings):
     another section of the settings from which a subordinate backend plugin
     is loaded.  This allows you to e.g. wrap a MemcachedStorage instance
     around an SQLStorage instance from a single config file.
+
+    Similarly, if the settings contain a key named "shards", this is taken
+    to be a list of other sections from which to load backend plugins.  They
+    are passed to the class constructor as a dict mapping section names to
+    backend instances, in the "shards" keyword argument.
     """
     section_settings = settings.getsection(section_name)
     klass = resolve_name(section_settings.pop("backend"))
+    shards = section_settings.pop("shards", None)
+    if shards is not None:
+        if isinstance(shards, basestring):
+            shards = shards.split()
+        section_settings["shards"] = dict(
+            (name, load_storage_from_settings(name, settings))
+            for name in shards
+        )
     wraps = section_settings.pop("wraps", None)
     if wraps is None:
         return klass(**section_settings)
     else:
         wrapped_storage = load_storage_from_settings(wraps, settings)
         return klass(wrapped_storage, **section_settings)
+
+
+def iter_base_storages(storage):
+    """Iterate over the innermost backends of a (possibly wrapped) backend.
+
+    This unwraps any caching layers around the given backend, and descends
+    into each shard of a sharded backend, producing the backend instances
+    that actually hold the data.  It's useful for maintenance scripts that
+    need to operate directly on e.g. each underlying SQLStorage instance.
+    """
+    while hasattr(storage, "storage"):
+        storage = storage.storage
+    shards = getattr(storage, "shards", None)
+    if shards is None:
+        yield storage
+    else:
+        for name in sorted(shards):
+            for base_storage in iter_base_storages(shards[name]):
+                yield base_storage
+
+
+def get_file_size(fileobj):
+    """Get the total size of a seekable file-like object.
+
+    The file is left positioned at the start, ready to be read.
+    """
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    return size
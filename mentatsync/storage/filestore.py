@@ -0,0 +1,188 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Content-addressed storage of chunk payloads on the local filesystem.
+
+This module implements a simple content-addressed file store, which storage
+backends can use to keep chunk payloads out of the database.  Each payload
+is stored in a file named for its SHA256 hash, inside a sharded directory
+tree so that no single directory grows too large:
+
+    <root>/ab/cd/abcdef0123456789...
+
+Callers may append a suffix to the hash when storing a transformed version
+of the payload, e.g. a compressed copy, so that it never collides with the
+original.
+
+Since files are named for their contents, they are never modified once
+written.  New files are written to a temporary name and then atomically
+renamed into place, so readers never see a partially-written payload.
+Storing a payload that already exists updates its modification time, so
+that a garbage collector can tell which files are still being written to.
+
+"""
+
+import os
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+from StringIO import StringIO
+
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks in which to copy payload data into files.
+BLOCK_SIZE = 64 * 1024
+
+
+class FileChunkStore(object):
+    """Content-addressed store for chunk payloads on the local filesystem."""
+
+    def __init__(self, path, fsync=True):
+        self.path = os.path.abspath(path)
+        self.fsync = fsync
+        _makedirs(self.path)
+
+    def get_path(self, digest):
+        """Get the filesystem path at which to store the given hash."""
+        return os.path.join(self.path, digest[0:2], digest[2:4], digest)
+
+    def put(self, payload, digest=None):
+        """Store the given payload, returning its hash.
+
+        If the caller has already calculated the hash of the payload, it
+        may be passed in to avoid calculating it a second time.
+        """
+        if digest is None:
+            digest = hashlib.sha256(payload).hexdigest()
+        self.put_file(StringIO(payload), digest)
+        return digest
+
+    def put_file(self, fileobj, digest):
+        """Store the payload read from the given file, under the given hash.
+
+        The data is copied a block at a time, so this can store payloads
+        of any size without reading them fully into memory.
+        """
+        path = self.get_path(digest)
+        # If it already exists then there's nothing to do, except to mark
+        # it as recently used.  It may have been deleted in the meantime,
+        # in which case we need to write it out again.
+        try:
+            os.utime(path, None)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            return
+        dirname = os.path.dirname(path)
+        _makedirs(dirname)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(fileobj, f, BLOCK_SIZE)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.rename(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def open(self, digest):
+        """Open the payload with the given hash, as a binary file object."""
+        return open(self.get_path(digest), "rb")
+
+    def get(self, digest):
+        """Get the payload with the given hash, as a bytestring."""
+        with self.open(digest) as f:
+            return f.read()
+
+    def discard(self, digest):
+        """Move the payload with the given hash aside, in preparation for
+        deleting it.
+
+        The file is renamed to a temporary name in the same directory, and
+        that path is returned so that the caller can delete it, or put it
+        back with restore().  If there is no such payload, None is returned.
+        """
+        path = self.get_path(digest)
+        tmp_path = None
+        try:
+            # This fails if the payload's directory doesn't exist,
+            # in which case there's nothing to discard.
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                            prefix=".del-")
+            os.close(fd)
+            os.rename(path, tmp_path)
+        except OSError, e:
+            if tmp_path is not None:
+                os.unlink(tmp_path)
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return tmp_path
+
+    def get_mtime(self, digest):
+        """Get the modification time of the payload with the given hash.
+
+        If there is no such payload, None is returned.
+        """
+        try:
+            return os.path.getmtime(self.get_path(digest))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def list_keys(self, start="", limit=100):
+        """List up to "limit" stored hashes, in order, after the given one.
+
+        The directory tree is sharded by prefix, so walking it in sorted
+        order produces the hashes in sorted order.  Temporary files are
+        skipped.
+        """
+        keys = []
+        for name1 in _listdir(self.path):
+            if name1 < start[0:2]:
+                continue
+            path1 = os.path.join(self.path, name1)
+            for name2 in _listdir(path1):
+                if name1 + name2 < start[0:4]:
+                    continue
+                for name in _listdir(os.path.join(path1, name2)):
+                    if name.startswith(".") or name <= start:
+                        continue
+                    keys.append(name)
+                    if len(keys) >= limit:
+                        return keys
+        return keys
+
+    def restore(self, tmp_path, digest):
+        """Put back a payload that was moved aside by discard()."""
+        # If it was stored again in the meantime then it will have the
+        # same contents, so it's fine to replace it.
+        os.rename(tmp_path, self.get_path(digest))
+
+
+def _makedirs(path):
+    """Create the given directory and any parents, if they don't exist."""
+    try:
+        os.makedirs(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _listdir(path):
+    """List the entries of a directory in sorted order, if it exists."""
+    try:
+        return sorted(os.listdir(path))
+    except OSError, e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return []
@@ -0,0 +1,299 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+In-process LRU caching layer for mentatsync storage.
+
+This module implements a storage plugin that wraps another storage backend,
+caching chunk payloads and committed transactions in the memory of the server
+process.  It's intended for deployments that don't have memcached, to absorb
+bursts of identical reads such as when several of a user's devices sync at
+the same time.
+
+Since each process has its own cache, only immutable data is cached.  The
+one exception is when a user's storage is reset: that clears the cache in
+the process handling the reset, but other processes may continue to serve
+stale data from their caches until it expires.  Entries are kept for at
+most cache_ttl seconds to put a bound on this.
+
+To use it, wrap it around another backend in the config file like so:
+
+    [storage]
+    backend = mentatsync.storage.lrucache.LRUCacheStorage
+    wraps = sqlstorage
+    cache_max_bytes = 67108864
+    cache_ttl = 300
+
+    [sqlstorage]
+    backend = mentatsync.storage.sql.SQLStorage
+    sqluri = mysql://...
+
+"""
+
+import time
+import itertools
+import threading
+import collections
+from StringIO import StringIO
+
+from mentatsync.storage import MentatSyncStorage, get_file_size
+
+
+# Default limit on the total size of everything in the cache.
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Default number of seconds for which each entry is kept in the cache.
+DEFAULT_CACHE_TTL = 5 * 60
+
+# Payloads bigger than this are not cached, so that one huge chunk
+# can't flush everything else out of the cache.
+DEFAULT_CACHE_CHUNK_MAX_SIZE = 1024 * 1024
+
+# Rough per-entry overhead in bytes, to account for keys and bookkeeping.
+ENTRY_OVERHEAD = 100
+
+
+class LRUCache(object):
+    """Least-recently-used cache, bounded by the total size of its values.
+
+    Each value is stored along with its size in bytes, as estimated by the
+    caller.  When the total size exceeds max_bytes, the least-recently-used
+    values are evicted until it fits again.  Values also expire ttl seconds
+    after they were stored, and reading an expired value counts as a miss.
+    Counts of hits, misses and evictions are kept for monitoring purposes.
+
+    All operations are protected by a lock, and none of them can yield to
+    another greenlet while holding it, so this is safe to use from threads
+    as well as under gevent.
+    """
+
+    def __init__(self, max_bytes, ttl=DEFAULT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Get the value stored under the given key, or None if missing."""
+        with self._lock:
+            try:
+                value, size, expires_at = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires_at <= time.time():
+                self.total_bytes -= size
+                self.misses += 1
+                return None
+            # Re-insert it to mark it as the most recently used.
+            self._items[key] = (value, size, expires_at)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size):
+        """Store the given value, evicting others as needed to make room."""
+        size += ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            try:
+                _, old_size, _ = self._items.pop(key)
+            except KeyError:
+                pass
+            else:
+                self.total_bytes -= old_size
+            self._items[key] = (value, size, expires_at)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._items.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def get_stats(self):
+        """Get a dict of statistics about the cache's size and usage."""
+        with self._lock:
+            return {
+                "items": len(self._items),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class LRUCacheStorage(MentatSyncStorage):
+    """Storage plugin that caches immutable data in process memory.
+
+    This class wraps another storage plugin and caches chunk payloads and
+    committed transaction metadata in an LRUCache.  It accepts the
+    following keyword arguments:
+
+        * cache_max_bytes:       the maximum total size of cached data
+
+        * cache_chunk_max_size:  don't cache chunk payloads larger than
+                                 this many bytes
+
+        * cache_ttl:             the maximum number of seconds for which
+                                 to cache anything
+
+    """
+
+    def __init__(self, storage, cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                 cache_chunk_max_size=DEFAULT_CACHE_CHUNK_MAX_SIZE,
+                 cache_ttl=DEFAULT_CACHE_TTL):
+        self.storage = storage
+        self.cache = LRUCache(cache_max_bytes, cache_ttl)
+        self.cache_chunk_max_size = cache_chunk_max_size
+        # Resetting a user gives them a new generation number, so that any
+        # entries cached under the old number can never be found again.
+        # Numbers are never reused, and once the cache TTL has passed, the
+        # entries cached before a reset have all expired.  So we only need
+        # to remember users reset within the TTL, ordered by reset time.
+        self._generations = collections.OrderedDict()
+        self._generations_lock = threading.Lock()
+        self._next_generation = itertools.count(1)
+
+    def get_cache_stats(self):
+        """Get a dict of statistics about the cache's size and usage."""
+        return self.cache.get_stats()
+
+    def reset(self, userid):
+        self.storage.reset(userid)
+        now = time.time()
+        with self._generations_lock:
+            for old_userid, (_, expires_at) in self._generations.items():
+                if expires_at > now:
+                    break
+                del self._generations[old_userid]
+            self._generations.pop(userid, None)
+            self._generations[userid] = (next(self._next_generation),
+                                         now + self.cache.ttl)
+
+    def get_head(self, userid):
+        return self.storage.get_head(userid)
+
+    def set_head(self, userid, trnid):
+        self.storage.set_head(userid, trnid)
+
+    def get_transaction_seq(self, userid, trnid):
+        key = self._get_key(userid, "trnseq", trnid)
+        seq = self.cache.get(key)
+        if seq is None:
+            seq = self.storage.get_transaction_seq(userid, trnid)
+            self.cache.set(key, seq, 0)
+        return seq
+
+    def get_transactions_after(self, userid, seq, limit):
+        return self.storage.get_transactions_after(userid, seq, limit)
+
+    def get_transactions_with_chunks_after(self, userid, seq, limit):
+        return self.storage.get_transactions_with_chunks_after(userid, seq,
+                                                               limit)
+
+    def create_transaction(self, userid, trnid, parent, chunks):
+        self.storage.create_transaction(userid, trnid, parent, chunks)
+
+    def get_transaction(self, userid, trnid):
+        key = self._get_key(userid, "trn", trnid)
+        trn = self.cache.get(key)
+        if trn is None:
+            trn = self.storage.get_transaction(userid, trnid)
+            # Pending transactions can still become committed.
+            if trn["committed"]:
+                size = sum(len(chunk) for chunk in trn["chunks"])
+                self.cache.set(key, trn, size)
+        # Give out a copy, so that callers can't corrupt the cache.
+        return dict(trn, chunks=list(trn["chunks"]))
+
+    def get_snapshot(self, userid):
+        # Snapshots can be replaced by newer ones, so they're never cached.
+        return self.storage.get_snapshot(userid)
+
+    def get_snapshot_with_chunks(self, userid):
+        return self.storage.get_snapshot_with_chunks(userid)
+
+    def create_snapshot(self, userid, trnid, chunks):
+        self.storage.create_snapshot(userid, trnid, chunks)
+
+    def create_chunk(self, userid, chunk, contents):
+        self.storage.create_chunk(userid, chunk, contents)
+
+    def create_chunk_from_file(self, userid, chunk, fileobj):
+        self.storage.create_chunk_from_file(userid, chunk, fileobj)
+
+    def create_chunks(self, userid, chunks):
+        self.storage.create_chunks(userid, chunks)
+
+    def get_chunk(self, userid, chunk):
+        key = self._get_key(userid, "chunk", chunk)
+        payload = self.cache.get(key)
+        if payload is None:
+            payload = self.storage.get_chunk(userid, chunk)
+            self._cache_chunk(key, payload)
+        return payload
+
+    def open_chunk(self, userid, chunk):
+        fileobj, _ = self.open_chunk_encoded(userid, chunk, ())
+        return fileobj
+
+    def open_chunk_encoded(self, userid, chunk, encodings):
+        # Look for the chunk in any of the acceptable encodings,
+        # preferring an encoded version if there is one.
+        for encoding in tuple(encodings) + ("identity",):
+            payload = self.cache.get(self._get_key(userid, "chunk", chunk,
+                                                   encoding))
+            if payload is not None:
+                return StringIO(payload), encoding
+        # Cache it if it's small, otherwise stream it from the storage.
+        fileobj, encoding = self.storage.open_chunk_encoded(userid, chunk,
+                                                            encodings)
+        if get_file_size(fileobj) > self.cache_chunk_max_size:
+            return fileobj, encoding
+        try:
+            payload = fileobj.read()
+        finally:
+            fileobj.close()
+        key = self._get_key(userid, "chunk", chunk, encoding)
+        self._cache_chunk(key, payload)
+        return StringIO(payload), encoding
+
+    def get_chunks(self, userid, chunks):
+        cached = {}
+        for chunk in chunks:
+            payload = self.cache.get(self._get_key(userid, "chunk", chunk))
+            if payload is not None:
+                cached[chunk] = payload
+        missing = [chunk for chunk in chunks if chunk not in cached]
+        if missing:
+            for chunk, payload in self.storage.get_chunks(userid, missing):
+                cached[chunk] = payload
+                self._cache_chunk(self._get_key(userid, "chunk", chunk),
+                                  payload)
+        for chunk in chunks:
+            try:
+                yield chunk, cached[chunk]
+            except KeyError:
+                pass
+
+    def push(self, userid, chunks, transactions, head=None):
+        self.storage.push(userid, chunks, transactions, head)
+
+    def _get_key(self, userid, kind, name, encoding="identity"):
+        """Get the cache key for the given item in the user's storage."""
+        generation, _ = self._generations.get(userid, (0, None))
+        return (userid, generation, kind, name, encoding)
+
+    def _cache_chunk(self, key, payload):
+        """Cache the given chunk payload, if it's not too big."""
+        if len(payload) <= self.cache_chunk_max_size:
+            self.cache.set(key, payload, len(payload))
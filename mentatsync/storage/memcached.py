@@ -0,0 +1,390 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Memcached caching layer for mentatsync storage.
+
+This module implements a storage plugin that wraps another storage backend,
+caching frequently-read data in memcached.  Chunk payloads and committed
+transactions never change once written, so they can be cached for a long
+time, though not forever in case they belong to a store that's been reset.
+The head changes, so it is explicitly updated in the cache whenever it is
+set through this plugin.  It's also only cached for a short time, so that
+a stale head won't be served for long if updating the cache fails.
+
+Resetting a user's storage can't enumerate and delete all their cached
+items.  Instead, each user has a "generation" token that is included in
+all of their cache keys, and a reset simply generates a new token.  Any
+items cached under the old token are then unreachable, and will eventually
+be evicted by memcached.  The tokens expire along with the items, so that if
+a reset fails to store the new token, the old items are only reachable for
+a bounded time.
+
+To use it, wrap it around another backend in the config file like so:
+
+    [storage]
+    backend = mentatsync.storage.memcached.MemcachedStorage
+    wraps = sqlstorage
+    server = 127.0.0.1:11211
+
+    [sqlstorage]
+    backend = mentatsync.storage.sql.SQLStorage
+    sqluri = mysql://...
+
+"""
+
+import time
+import uuid
+import logging
+import threading
+import contextlib
+from StringIO import StringIO
+
+from mozsvc.plugin import resolve_name
+from mozsvc.exceptions import BackendError
+from mozsvc.storage.mcclient import MemcachedClient
+
+from mentatsync.storage import (MentatSyncStorage, ConflictError,
+                                get_file_size)
+
+
+logger = logging.getLogger(__name__)
+
+
+# Payloads bigger than this are not cached, since memcached by default
+# refuses to store items larger than 1MB.
+DEFAULT_CACHE_CHUNK_MAX_SIZE = 1000 * 1000
+
+# Default number of seconds for which to cache the head.
+DEFAULT_CACHE_HEAD_TTL = 30
+
+# Default number of seconds for which to cache immutable items, and the
+# generation tokens that their keys depend on.
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+
+# Memcached flag used to mark values that are stored as raw bytes
+# rather than serialized as JSON.
+FLAG_RAW_BYTES = 1
+
+
+class MemcachedStorage(MentatSyncStorage):
+    """Storage plugin that caches immutable data in memcached.
+
+    This class wraps another storage plugin and caches chunk payloads,
+    committed transaction metadata and the head in memcached.  It accepts the
+    following keyword arguments, and passes any others through to the
+    memcached client:
+
+        * client_class:          dotted name of the memcached client class
+                                 to use; defaults to BinaryMemcachedClient
+
+        * cache_chunk_max_size:  don't cache chunk payloads larger than
+                                 this many bytes
+
+        * cache_head_ttl:        the number of seconds for which to cache
+                                 the head
+
+        * cache_ttl:             the number of seconds for which to cache
+                                 everything else
+
+    """
+
+    def __init__(self, storage, client_class=None,
+                 cache_chunk_max_size=DEFAULT_CACHE_CHUNK_MAX_SIZE,
+                 cache_head_ttl=DEFAULT_CACHE_HEAD_TTL,
+                 cache_ttl=DEFAULT_CACHE_TTL, **kwds):
+        self.storage = storage
+        if client_class is None:
+            client_class = BinaryMemcachedClient
+        elif isinstance(client_class, basestring):
+            client_class = resolve_name(client_class)
+        self.cache = client_class(**kwds)
+        self.cache_chunk_max_size = cache_chunk_max_size
+        self.cache_head_ttl = cache_head_ttl
+        self.cache_ttl = cache_ttl
+
+    def reset(self, userid):
+        self.storage.reset(userid)
+        # Orphan all existing cache entries by starting a new generation.
+        self._cache_call("set", userid + ":gen", _new_generation(),
+                         self.cache_ttl)
+
+    def get_head(self, userid):
+        key = self._get_key(userid, "head")
+        head = self._cache_call("get", key)
+        if head is None:
+            head = self.storage.get_head(userid)
+            # Only add, so that we never overwrite a newer head that
+            # was set by a concurrent call to set_head.
+            self._cache_call("add", key, head, self.cache_head_ttl)
+        return head
+
+    def set_head(self, userid, trnid):
+        with self._invalidating_head_on_conflict(userid):
+            self.storage.set_head(userid, trnid)
+        self._set_cached_head(userid, trnid)
+
+    def get_transaction_seq(self, userid, trnid):
+        key = self._get_key(userid, "trnseq:" + trnid)
+        seq = self._cache_call("get", key)
+        if seq is None:
+            seq = self.storage.get_transaction_seq(userid, trnid)
+            self._cache_call("set", key, seq, self.cache_ttl)
+        return seq
+
+    def get_transactions_after(self, userid, seq, limit):
+        return self.storage.get_transactions_after(userid, seq, limit)
+
+    def get_transactions_with_chunks_after(self, userid, seq, limit):
+        return self.storage.get_transactions_with_chunks_after(userid, seq,
+                                                               limit)
+
+    def create_transaction(self, userid, trnid, parent, chunks):
+        with self._invalidating_head_on_conflict(userid):
+            self.storage.create_transaction(userid, trnid, parent, chunks)
+
+    def get_transaction(self, userid, trnid):
+        key = self._get_key(userid, "trn:" + trnid)
+        trn = self._cache_call("get", key)
+        if trn is None:
+            trn = self.storage.get_transaction(userid, trnid)
+            # Pending transactions can still become committed.
+            if trn["committed"]:
+                self._cache_call("set", key, trn, self.cache_ttl)
+        return trn
+
+    def get_snapshot(self, userid):
+        # Snapshots can be replaced by newer ones, so they're never cached.
+        return self.storage.get_snapshot(userid)
+
+    def get_snapshot_with_chunks(self, userid):
+        return self.storage.get_snapshot_with_chunks(userid)
+
+    def create_snapshot(self, userid, trnid, chunks):
+        self.storage.create_snapshot(userid, trnid, chunks)
+
+    def create_chunk(self, userid, chunk, contents):
+        self.storage.create_chunk(userid, chunk, contents)
+
+    def create_chunk_from_file(self, userid, chunk, fileobj):
+        self.storage.create_chunk_from_file(userid, chunk, fileobj)
+
+    def create_chunks(self, userid, chunks):
+        self.storage.create_chunks(userid, chunks)
+
+    def get_chunk(self, userid, chunk):
+        key = self._get_key(userid, "chunk:" + chunk)
+        payload = self._cache_call("get", key)
+        if payload is None:
+            payload = self.storage.get_chunk(userid, chunk)
+            self._cache_chunk(key, payload)
+        return payload
+
+    def open_chunk(self, userid, chunk):
+        fileobj, _ = self.open_chunk_encoded(userid, chunk, ())
+        return fileobj
+
+    def open_chunk_encoded(self, userid, chunk, encodings):
+        # Look for the chunk in any of the acceptable encodings,
+        # preferring an encoded version if there is one.
+        prefix = self._get_key_prefix(userid)
+        keys = {prefix + "chunk:" + chunk: "identity"}
+        for encoding in encodings:
+            keys[prefix + "chunk:%s:%s" % (chunk, encoding)] = encoding
+        items = self._cache_call("get_multi", keys.keys()) or {}
+        if items:
+            key = max(items, key=lambda k: keys[k] != "identity")
+            return StringIO(items[key]), keys[key]
+        # Cache it if it's small, otherwise stream it from the storage.
+        fileobj, encoding = self.storage.open_chunk_encoded(userid, chunk,
+                                                            encodings)
+        if get_file_size(fileobj) > self.cache_chunk_max_size:
+            return fileobj, encoding
+        try:
+            payload = fileobj.read()
+        finally:
+            fileobj.close()
+        if encoding == "identity":
+            self._cache_chunk(prefix + "chunk:" + chunk, payload)
+        else:
+            self._cache_chunk(prefix + "chunk:%s:%s" % (chunk, encoding),
+                              payload)
+        return StringIO(payload), encoding
+
+    def get_chunks(self, userid, chunks):
+        prefix = self._get_key_prefix(userid)
+        keys = dict((prefix + "chunk:" + chunk, chunk) for chunk in chunks)
+        items = self._cache_call("get_multi", keys.keys()) or {}
+        cached = dict((keys[key], payload) for key, payload in items.items())
+        missing = [chunk for chunk in chunks if chunk not in cached]
+        if missing:
+            for chunk, payload in self.storage.get_chunks(userid, missing):
+                cached[chunk] = payload
+                self._cache_chunk(prefix + "chunk:" + chunk, payload)
+        for chunk in chunks:
+            try:
+                yield chunk, cached[chunk]
+            except KeyError:
+                pass
+
+    def push(self, userid, chunks, transactions, head=None):
+        with self._invalidating_head_on_conflict(userid):
+            self.storage.push(userid, chunks, transactions, head)
+        if head is not None:
+            self._set_cached_head(userid, head)
+
+    def _get_key(self, userid, name):
+        """Get the cache key for the named item in the user's storage."""
+        return self._get_key_prefix(userid) + name
+
+    def _get_key_prefix(self, userid):
+        """Get the prefix for all cache keys in the user's storage.
+
+        This includes the user's current generation token, creating one
+        if necessary, and so costs a round-trip to memcached.
+        """
+        gen_key = userid + ":gen"
+        gen = self._cache_call("get", gen_key)
+        if gen is None:
+            gen = _new_generation()
+            if not self._cache_call("add", gen_key, gen, self.cache_ttl):
+                gen = self._cache_call("get", gen_key) or gen
+        return "%s:%s:" % (userid, gen)
+
+    def _set_cached_head(self, userid, head):
+        """Update the cached head, after setting it in the storage."""
+        key = self._get_key(userid, "head")
+        self._cache_call("set", key, head, self.cache_head_ttl)
+
+    def _cache_chunk(self, key, payload):
+        """Cache the given chunk payload, if it's not too big."""
+        if len(payload) <= self.cache_chunk_max_size:
+            self._cache_call("set", key, payload, self.cache_ttl)
+
+    def _cache_call(self, method, *args):
+        """Call a method on the memcached client, ignoring any errors.
+
+        The cache is only an optimization, so if memcached is unavailable,
+        or refuses a key or value as too large, we log the error and carry
+        on as though it were empty.
+        """
+        try:
+            return getattr(self.cache, method)(*args)
+        except (BackendError, ValueError):
+            logger.exception("Error accessing memcached")
+            return None
+
+    @contextlib.contextmanager
+    def _invalidating_head_on_conflict(self, userid):
+        """Forget the cached head if the wrapped block raises a conflict.
+
+        Conflicts are often caused by the client working from a stale
+        head, so make sure their next request gets a fresh one.
+        """
+        try:
+            yield
+        except ConflictError:
+            self._cache_call("delete", self._get_key(userid, "head"))
+            raise
+
+
+class BinaryMemcachedClient(MemcachedClient):
+    """MemcachedClient that can store raw bytestrings.
+
+    The base MemcachedClient serializes all values as JSON, which can't
+    represent arbitrary binary data.  This subclass stores bytestrings
+    as-is, and marks them with a flag so they can be read back correctly.
+    """
+
+    def _encode_value(self, value):
+        if isinstance(value, str):
+            if len(value) > self.max_value_size:
+                raise ValueError("value too long")
+            return value, FLAG_RAW_BYTES
+        return super(BinaryMemcachedClient, self)._encode_value(value)
+
+    def _decode_value(self, value, flags):
+        if flags & FLAG_RAW_BYTES:
+            return value
+        return super(BinaryMemcachedClient, self)._decode_value(value, flags)
+
+
+class LocalMemcachedClient(BinaryMemcachedClient):
+    """BinaryMemcachedClient that keeps everything in memory.
+
+    This class emulates a memcached server in-process, for use in tests.
+    Values still go through the same encoding and decoding as they would
+    with a real server.  It honours expiry times, but never evicts items.
+    """
+
+    def __init__(self, key_prefix="", max_key_size=None, max_value_size=None,
+                 **kwds):
+        # Deliberately don't call the superclass constructor,
+        # since we don't want to create a connection pool.
+        self.key_prefix = key_prefix
+        self.max_key_size = max_key_size or 250
+        self.max_value_size = max_value_size or 20 * 1024 * 1024
+        self.server = _LocalMemcachedServer()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        yield self.server
+
+
+class _LocalMemcachedServer(object):
+    """In-memory emulation of the umemcache client interface."""
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def get_multi(self, keys):
+        with self.lock:
+            items = ((key, self._get(key)) for key in keys)
+            return dict(item for item in items if item[1] is not None)
+
+    def set(self, key, data, time=0, flags=0):
+        with self.lock:
+            self.items[key] = (data, flags, _get_expiry(time))
+        return "STORED"
+
+    def add(self, key, data, time=0, flags=0):
+        with self.lock:
+            if self._get(key) is not None:
+                return "NOT_STORED"
+            self.items[key] = (data, flags, _get_expiry(time))
+        return "STORED"
+
+    def delete(self, key):
+        with self.lock:
+            if self.items.pop(key, None) is None:
+                return "NOT_FOUND"
+        return "DELETED"
+
+    def _get(self, key):
+        """Get the (data, flags) stored under a key, if it hasn't expired."""
+        try:
+            data, flags, expires_at = self.items[key]
+        except KeyError:
+            return None
+        if expires_at is not None and expires_at <= time.time():
+            del self.items[key]
+            return None
+        return data, flags
+
+
+def _get_expiry(ttl):
+    """Get the time at which an item expires, given its memcached TTL."""
+    if not ttl:
+        return None
+    return time.time() + ttl
+
+
+def _new_generation():
+    """Generate a new, unique cache generation token."""
+    return uuid.uuid4().hex[:12]
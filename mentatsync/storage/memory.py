@@ -0,0 +1,386 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+In-memory storage backend for mentatsync.
+
+This module implements a storage plugin that keeps all data in the memory
+of the server process.  Nothing is persisted, so it's only suitable for
+testing, benchmarking and ephemeral deployments, but it gives an upper
+bound on the performance that the web layer can achieve, against which
+the SQL backend can be compared.
+
+Each user's data is kept in a compact set of structures of its own:
+
+  * a dict mapping transaction ids to small slotted records
+  * parallel lists of the seqs and records of committed transactions,
+    in seq order, so that listings can find their starting point by bisection
+  * a dict mapping chunk ids to (id, payload) pairs, with the payloads
+    as plain bytestrings
+  * the newest snapshot, if any, with its chunk ids as a tuple
+
+There's no background garbage collection for this backend, so history is
+pruned as soon as it's superseded by a new snapshot.
+
+Transactions and snapshots refer to each chunk using the copy of its id
+that's stored alongside its payload, so that the many transactions
+referencing a given chunk all share a single copy of its id.
+
+Each user's data is protected by a lock of its own, so that operations
+on different users never wait for each other.  Users are only given data
+structures of their own once something is written for them, so reads for
+unknown users don't allocate anything, and resetting a user discards them.
+
+To use it, configure it as the backend in the config file like so:
+
+    [storage]
+    backend = mentatsync.storage.memory.MemoryStorage
+
+"""
+
+import bisect
+import hashlib
+import threading
+import contextlib
+
+from mentatsync.storage import (MentatSyncStorage,
+                                ConflictError,
+                                TransactionNotFoundError,
+                                ChunkNotFoundError,
+                                ChunkHashMismatchError,
+                                ROOT_TRANSACTION)
+
+
+class MemoryStorage(MentatSyncStorage):
+    """Storage plugin that keeps all data in process memory.
+
+    This class implements the storage plugin API using plain python data
+    structures.  It accepts the following keyword arguments:
+
+        * verify_chunk_ids:      reject uploaded chunks whose id is not
+                                 the SHA256 hash of their contents
+
+    """
+
+    def __init__(self, verify_chunk_ids=False):
+        self.verify_chunk_ids = verify_chunk_ids
+        self._users = {}
+        self._users_lock = threading.Lock()
+        # Shared by all users with no data, and never written to.
+        self._empty_user = _UserData()
+
+    def reset(self, userid):
+        with self._users_lock:
+            self._users.pop(userid, None)
+
+    def get_head(self, userid):
+        return self._get_user(userid).head
+
+    def set_head(self, userid, trnid):
+        user = self._get_or_create_user(userid)
+        with user.lock:
+            with _undo_on_error() as undo:
+                self._set_head(user, trnid, undo)
+
+    def _set_head(self, user, trnid, undo):
+        trn = user.transactions.get(trnid)
+        if trn is None:
+            raise ConflictError()
+        # The transaction must be at the tip of a pending branch, which
+        # must be based on the current head.
+        branch = user.branches[trn.branch]
+        if branch.committed or branch.tip != trnid:
+            raise ConflictError()
+        if branch.base != user.head:
+            raise ConflictError()
+        # Walk back along the branch to find all of its transactions.
+        trns = [trn]
+        while trns[-1].parent != branch.base:
+            trns.append(user.transactions[trns[-1].parent])
+        trns.reverse()
+        # Committed branches always extend the head, so their transactions
+        # can simply be appended to keep the index in seq order.
+        prev_head = user.head
+        num_committed = len(user.committed_seqs)
+        branch.committed = True
+        user.head = trnid
+        user.committed_seqs.extend(t.seq for t in trns)
+        user.committed_trns.extend(trns)
+
+        def rollback():
+            branch.committed = False
+            user.head = prev_head
+            del user.committed_seqs[num_committed:]
+            del user.committed_trns[num_committed:]
+
+        undo.append(rollback)
+
+    def get_transaction_seq(self, userid, trnid):
+        user = self._get_user(userid)
+        with user.lock:
+            trn = user.transactions.get(trnid)
+            if trn is None or not user.branches[trn.branch].committed:
+                raise TransactionNotFoundError()
+            return trn.seq
+
+    def get_transactions_after(self, userid, seq, limit):
+        return iter([{
+            "id": trn.trnid,
+            "seq": trn.seq,
+        } for trn in self._get_committed_after(userid, seq, limit)])
+
+    def get_transactions_with_chunks_after(self, userid, seq, limit):
+        return iter([{
+            "id": trn.trnid,
+            "seq": trn.seq,
+            "parent": trn.parent,
+            "chunks": list(trn.chunks),
+        } for trn in self._get_committed_after(userid, seq, limit)])
+
+    def _get_committed_after(self, userid, seq, limit):
+        """Get a page of committed transaction records, after the given seq."""
+        user = self._get_user(userid)
+        with user.lock:
+            idx = bisect.bisect_right(user.committed_seqs, seq)
+            return user.committed_trns[idx:idx + limit]
+
+    def create_transaction(self, userid, trnid, parent, chunks):
+        user = self._get_or_create_user(userid)
+        with user.lock:
+            with _undo_on_error() as undo:
+                self._create_transaction(user, trnid, parent, chunks, undo)
+
+    def _create_transaction(self, user, trnid, parent, chunks, undo):
+        if trnid in user.transactions:
+            raise ConflictError()
+        if parent == ROOT_TRANSACTION:
+            parent_seq = 0
+            parent_branch = None
+        else:
+            parent_trn = user.transactions.get(parent)
+            if parent_trn is None:
+                raise ConflictError()
+            parent_seq = parent_trn.seq
+            parent_branch = user.branches[parent_trn.branch]
+            if parent_branch.committed:
+                parent_branch = None
+        chunks = _get_stored_chunk_ids(user, chunks)
+        if parent_branch is None:
+            # Descending from a committed transaction starts a new branch.
+            branch = trnid
+            user.branches[branch] = _Branch(parent, trnid)
+            undo.append(lambda: user.branches.pop(branch))
+        else:
+            # Descending from a pending transaction extends its branch,
+            # but only if the parent doesn't already have a descendant.
+            if parent_branch.tip != parent:
+                raise ConflictError()
+            branch = parent_trn.branch
+            parent_branch.tip = trnid
+            undo.append(lambda: setattr(parent_branch, "tip", parent))
+        user.transactions[trnid] = _Transaction(trnid, parent, parent_seq + 1,
+                                                branch, chunks)
+        undo.append(lambda: user.transactions.pop(trnid))
+
+    def get_transaction(self, userid, trnid):
+        user = self._get_user(userid)
+        with user.lock:
+            trn = user.transactions.get(trnid)
+            if trn is None:
+                raise TransactionNotFoundError()
+            return {
+                "id": trn.trnid,
+                "seq": trn.seq,
+                "parent": trn.parent,
+                "chunks": list(trn.chunks),
+                "committed": user.branches[trn.branch].committed,
+            }
+
+    def get_snapshot(self, userid):
+        snapshot = self._get_user(userid).snapshot
+        if snapshot is None:
+            return None
+        return {
+            "id": snapshot.trnid,
+            "seq": snapshot.seq,
+        }
+
+    def get_snapshot_with_chunks(self, userid):
+        snapshot = self._get_user(userid).snapshot
+        if snapshot is None:
+            return None
+        return {
+            "id": snapshot.trnid,
+            "seq": snapshot.seq,
+            "chunks": list(snapshot.chunks),
+        }
+
+    def create_snapshot(self, userid, trnid, chunks):
+        user = self._get_or_create_user(userid)
+        with user.lock:
+            trn = user.transactions.get(trnid)
+            if trn is None or not user.branches[trn.branch].committed:
+                raise ConflictError()
+            if user.snapshot is not None and user.snapshot.seq >= trn.seq:
+                raise ConflictError()
+            chunks = _get_stored_chunk_ids(user, chunks)
+            user.snapshot = _Snapshot(trnid, trn.seq, chunks)
+            self._prune_history(user, trn.seq)
+
+    def _prune_history(self, user, seq):
+        """Discard all transactions from before the given seq.
+
+        Any pending transactions that old can never be committed, since
+        their branch isn't based on the head, so they go too.  Branches are
+        discarded once their tip is gone.
+        """
+        idx = bisect.bisect_left(user.committed_seqs, seq)
+        del user.committed_seqs[:idx]
+        del user.committed_trns[:idx]
+        for trnid, trn in user.transactions.items():
+            if trn.seq < seq:
+                del user.transactions[trnid]
+        for branch_id, branch in user.branches.items():
+            if branch.tip not in user.transactions:
+                del user.branches[branch_id]
+
+    def create_chunk(self, userid, chunk, contents):
+        self.create_chunks(userid, [(chunk, contents)])
+
+    def create_chunks(self, userid, chunks):
+        user = self._get_or_create_user(userid)
+        with user.lock:
+            with _undo_on_error() as undo:
+                self._create_chunks(user, chunks, undo)
+
+    def _create_chunks(self, user, chunks, undo):
+        for chunk, payload in chunks:
+            if self.verify_chunk_ids:
+                if chunk != hashlib.sha256(payload).hexdigest():
+                    raise ChunkHashMismatchError()
+            # Chunks are immutable, so the first upload wins.
+            if chunk not in user.chunks:
+                user.chunks[chunk] = (chunk, payload)
+                undo.append(lambda chunk=chunk: user.chunks.pop(chunk))
+
+    def get_chunk(self, userid, chunk):
+        try:
+            return self._get_user(userid).chunks[chunk][1]
+        except KeyError:
+            raise ChunkNotFoundError()
+
+    def get_chunks(self, userid, chunks):
+        user_chunks = self._get_user(userid).chunks
+        for chunk in chunks:
+            try:
+                yield chunk, user_chunks[chunk][1]
+            except KeyError:
+                pass
+
+    def push(self, userid, chunks, transactions, head=None):
+        user = self._get_or_create_user(userid)
+        with user.lock:
+            with _undo_on_error() as undo:
+                self._create_chunks(user, chunks, undo)
+                for trn in transactions:
+                    self._create_transaction(user, trn["id"], trn["parent"],
+                                             trn["chunks"], undo)
+                if head is not None:
+                    self._set_head(user, head, undo)
+
+    def _get_user(self, userid):
+        """Get the data structures for the given user, for reading.
+
+        Users with no data get an empty set of structures, which must not
+        be modified.
+        """
+        return self._users.get(userid, self._empty_user)
+
+    def _get_or_create_user(self, userid):
+        """Get the data structures for the given user, creating if needed."""
+        try:
+            return self._users[userid]
+        except KeyError:
+            with self._users_lock:
+                return self._users.setdefault(userid, _UserData())
+
+
+class _UserData(object):
+    """All of the data stored for a single user."""
+
+    __slots__ = ("lock", "head", "transactions", "branches", "chunks",
+                 "committed_seqs", "committed_trns", "snapshot")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.head = ROOT_TRANSACTION
+        self.transactions = {}
+        self.branches = {}
+        self.chunks = {}
+        self.committed_seqs = []
+        self.committed_trns = []
+        self.snapshot = None
+
+
+class _Transaction(object):
+    """A single transaction, with its chunk ids as a tuple."""
+
+    __slots__ = ("trnid", "parent", "seq", "branch", "chunks")
+
+    def __init__(self, trnid, parent, seq, branch, chunks):
+        self.trnid = trnid
+        self.parent = parent
+        self.seq = seq
+        self.branch = branch
+        self.chunks = chunks
+
+
+class _Branch(object):
+    """A linear chain of transactions, which are committed together."""
+
+    __slots__ = ("base", "tip", "committed")
+
+    def __init__(self, base, tip):
+        self.base = base
+        self.tip = tip
+        self.committed = False
+
+
+class _Snapshot(object):
+    """The full state as of a committed transaction, as a tuple of chunks."""
+
+    __slots__ = ("trnid", "seq", "chunks")
+
+    def __init__(self, trnid, seq, chunks):
+        self.trnid = trnid
+        self.seq = seq
+        self.chunks = chunks
+
+
+@contextlib.contextmanager
+def _undo_on_error():
+    """Context manager to undo partial changes if an operation fails.
+
+    This produces a list to which the operation should append a callable
+    for each change that it makes.  If the operation raises an error, the
+    callables are run in reverse order to restore the previous state.
+    """
+    undo = []
+    try:
+        yield undo
+    except BaseException:
+        for func in reversed(undo):
+            func()
+        raise
+
+
+def _get_stored_chunk_ids(user, chunks):
+    """Get the user's stored copies of the given chunk ids, as a tuple.
+
+    ChunkNotFoundError is raised if the user doesn't have all the chunks.
+    """
+    try:
+        return tuple(user.chunks[chunk][0] for chunk in chunks)
+    except KeyError:
+        raise ChunkNotFoundError()
@@ -0,0 +1,186 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Userid-sharded routing across multiple storage backends.
+
+This module implements a storage plugin that spreads users across several
+independent backends, so that no single database has to hold everyone's
+data.  All of a user's data lives on exactly one shard, so every operation
+can simply be forwarded to the backend that owns that user.
+
+Users are assigned to shards by consistent hashing: each shard is placed at
+many pseudo-random points around a hash ring, and a user belongs to the
+first shard found clockwise from the hash of their userid.  The points are
+derived from the shard names rather than their order, so adding a new shard
+only moves the users that now hash to it, about 1/N of them, and leaves
+everyone else where they were.  Individual users can also be pinned to a
+specific shard by listing them in an explicit assignment table, e.g. while
+migrating their data from one shard to another.
+
+To use it, list the sections describing each shard in the config file
+like so:
+
+    [storage]
+    backend = mentatsync.storage.sharded.ShardedStorage
+    shards = shard1 shard2
+    assignments = some-userid:shard2
+
+    [shard1]
+    backend = mentatsync.storage.sql.SQLStorage
+    sqluri = mysql://db1...
+
+    [shard2]
+    backend = mentatsync.storage.sql.SQLStorage
+    sqluri = mysql://db2...
+
+Each shard is loaded as a separate backend, and so maintains its own pool
+of database connections.
+
+"""
+
+import bisect
+import hashlib
+
+from mentatsync.storage import MentatSyncStorage
+
+
+# Number of points at which each shard appears on the hash ring.  More
+# points give a more even spread of users, at the cost of a bigger ring.
+DEFAULT_POINTS_PER_SHARD = 100
+
+
+class ShardedStorage(MentatSyncStorage):
+    """Storage plugin that routes each userid to one of several backends.
+
+    This class takes a dict mapping shard names to storage backends, and
+    forwards each call to the backend that owns the given userid.  It also
+    accepts the following keyword arguments:
+
+        * assignments:       explicit "userid:shard" pairs, overriding the
+                             hash ring for the given users
+
+        * points_per_shard:  number of points for each shard on the
+                             hash ring
+
+    """
+
+    def __init__(self, shards, assignments=None,
+                 points_per_shard=DEFAULT_POINTS_PER_SHARD):
+        if not shards:
+            raise ValueError("at least one shard must be configured")
+        self.shards = shards
+        self.assignments = _parse_assignments(assignments)
+        for userid, name in self.assignments.iteritems():
+            if name not in shards:
+                raise ValueError("unknown shard %r for %r" % (name, userid))
+        ring = []
+        for name in shards:
+            for i in xrange(int(points_per_shard)):
+                ring.append((_hash("%s:%d" % (name, i)), name))
+        ring.sort()
+        self._ring_points = [point for point, _ in ring]
+        self._ring_names = [name for _, name in ring]
+
+    def get_shard_name(self, userid):
+        """Get the name of the shard that owns the given userid."""
+        try:
+            return self.assignments[userid]
+        except KeyError:
+            pass
+        idx = bisect.bisect(self._ring_points, _hash(userid))
+        return self._ring_names[idx % len(self._ring_names)]
+
+    def get_shard(self, userid):
+        """Get the storage backend that owns the given userid."""
+        return self.shards[self.get_shard_name(userid)]
+
+    def reset(self, userid):
+        self.get_shard(userid).reset(userid)
+
+    def get_head(self, userid):
+        return self.get_shard(userid).get_head(userid)
+
+    def set_head(self, userid, trnid):
+        self.get_shard(userid).set_head(userid, trnid)
+
+    def get_transaction_seq(self, userid, trnid):
+        return self.get_shard(userid).get_transaction_seq(userid, trnid)
+
+    def get_transactions_after(self, userid, seq, limit):
+        shard = self.get_shard(userid)
+        return shard.get_transactions_after(userid, seq, limit)
+
+    def get_transactions_with_chunks_after(self, userid, seq, limit):
+        shard = self.get_shard(userid)
+        return shard.get_transactions_with_chunks_after(userid, seq, limit)
+
+    def create_transaction(self, userid, trnid, parent, chunks):
+        shard = self.get_shard(userid)
+        shard.create_transaction(userid, trnid, parent, chunks)
+
+    def get_transaction(self, userid, trnid):
+        return self.get_shard(userid).get_transaction(userid, trnid)
+
+    def get_snapshot(self, userid):
+        return self.get_shard(userid).get_snapshot(userid)
+
+    def get_snapshot_with_chunks(self, userid):
+        return self.get_shard(userid).get_snapshot_with_chunks(userid)
+
+    def create_snapshot(self, userid, trnid, chunks):
+        self.get_shard(userid).create_snapshot(userid, trnid, chunks)
+
+    def create_chunk(self, userid, chunk, contents):
+        self.get_shard(userid).create_chunk(userid, chunk, contents)
+
+    def create_chunk_from_file(self, userid, chunk, fileobj):
+        self.get_shard(userid).create_chunk_from_file(userid, chunk, fileobj)
+
+    def create_chunks(self, userid, chunks):
+        self.get_shard(userid).create_chunks(userid, chunks)
+
+    def get_chunk(self, userid, chunk):
+        return self.get_shard(userid).get_chunk(userid, chunk)
+
+    def open_chunk(self, userid, chunk):
+        return self.get_shard(userid).open_chunk(userid, chunk)
+
+    def open_chunk_encoded(self, userid, chunk, encodings):
+        shard = self.get_shard(userid)
+        return shard.open_chunk_encoded(userid, chunk, encodings)
+
+    def get_chunks(self, userid, chunks):
+        return self.get_shard(userid).get_chunks(userid, chunks)
+
+    def push(self, userid, chunks, transactions, head=None):
+        self.get_shard(userid).push(userid, chunks, transactions, head)
+
+
+def _hash(key):
+    """Hash the given string to a position on the ring."""
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+def _parse_assignments(assignments):
+    """Parse the explicit shard assignment table from the settings.
+
+    The table may be given as a dict, or as "userid:shard" pairs separated
+    by whitespace or newlines.
+    """
+    if not assignments:
+        return {}
+    if isinstance(assignments, dict):
+        return dict(assignments)
+    if isinstance(assignments, basestring):
+        assignments = assignments.split()
+    else:
+        assignments = [pair for line in assignments for pair in line.split()]
+    parsed = {}
+    for pair in assignments:
+        userid, sep, name = pair.rpartition(":")
+        if not sep or not userid or not name:
+            raise ValueError("invalid shard assignment: %r" % (pair,))
+        parsed[userid] = name
+    return parsed
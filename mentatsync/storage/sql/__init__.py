@@ -16,21 +16,77 @@ sharding of the BSO items into multiple tables named "bso0" through "bsoN".
 This behaviour is off by default; pass shard=True to enable it.
 """
 
+import os
+import time
+import zlib
+import uuid
 import base64
+import hashlib
+import itertools
+import random
 import logging
+import tempfile
+import collections
+from StringIO import StringIO
+
+from sqlalchemy.exc import IntegrityError
+
+from mozsvc.exceptions import BackendError
 
 from mentatsync.storage import (MentatSyncStorage,
                                 ConflictError,
                                 TransactionNotFoundError,
                                 ChunkNotFoundError,
-                                ROOT_TRANSACTION)
+                                ChunkHashMismatchError,
+                                ROOT_TRANSACTION,
+                                get_file_size)
 
-from mentatsync.storage.sql.dbconnect import DBConnector
+from mentatsync.storage.filestore import FileChunkStore
+from mentatsync.storage.sql.dbconnect import (DBConnector,
+                                              PAYLOAD_ENCODING_IDENTITY,
+                                              PAYLOAD_ENCODING_BASE64,
+                                              PAYLOAD_ENCODING_GZIP)
 
 
 logger = logging.getLogger(__name__)
 
 
+# The number of chunk ids to send to the database in a single IN query.
+# This needs to stay well below the bindparam limit for SQLite.
+CHUNK_BATCH_SIZE = 100
+
+# The approximate maximum size of chunk data to write in a single query.
+# This needs to stay well below max_allowed_packet for MySQL.
+CHUNK_BATCH_BYTES = 1024 * 1024
+
+# The size of the blocks in which to read and write streamed chunk data,
+# and the size beyond which it will be spooled to disk rather than memory.
+CHUNK_BLOCK_SIZE = 64 * 1024
+CHUNK_SPOOL_BYTES = 256 * 1024
+
+# The codecs that can be used to compress stored chunk payloads.
+# These double as HTTP content-codings, so that compressed payloads
+# can be served to clients without decompressing them.
+COMPRESSION_CODECS = (PAYLOAD_ENCODING_GZIP,)
+
+# The number of seconds for which to stop using a read replica after
+# failing to connect to it, before trying it again.
+DEFAULT_REPLICA_RETRY_INTERVAL = 30
+
+# The number of seconds by which a read replica may lag behind the primary.
+# Reads for a user who was reset more recently than this go to the primary.
+DEFAULT_REPLICA_MAX_LAG = 30
+
+# The number of seconds for which pending branches and unreferenced chunks
+# are left alone before being garbage-collected, in case they belong to a
+# client that is part-way through a sync.
+DEFAULT_GC_MAX_AGE = 7 * 24 * 60 * 60
+
+# The number of seconds to wait before purging the data of a user who was
+# reset, so that any requests still in flight against it can complete.
+DEFAULT_PURGE_DELAY = 5 * 60
+
+
 class SQLStorage(MentatSyncStorage):
     """Storage plugin implemented using an SQL database.
 
@@ -41,25 +97,126 @@ class SQLStorage(MentatSyncStorage):
         * create_tables:         create the database tables if they don't
                                  exist at startup
 
+        * chunk_path:            store chunk payloads as files in this
+                                 directory, keeping only their metadata
+                                 in the database
+
+        * compression:           compress newly-stored chunk payloads
+                                 using this codec; currently only "gzip"
+                                 is supported
+
+        * compression_level:     the compression level to use, from 1
+                                 (fastest) to 9 (smallest)
+
+        * verify_chunk_ids:      reject uploaded chunks whose id is not
+                                 the SHA256 hash of their contents
+
+        * replica_sqluris:       database URIs of read-only replicas, from
+                                 which to read chunks and committed
+                                 transactions
+
+        * replica_retry_interval:  seconds to wait before trying a replica
+                                   again after failing to connect to it
+
+        * replica_max_lag:       seconds by which a replica may lag behind
+                                 the primary
+
+    Reads of immutable data are sent to a randomly-chosen replica if any
+    are configured.  If the data is not found there, e.g. because the
+    replica is lagging behind, or if the replica is unavailable, the read
+    falls back to the primary database.  Everything else, including reads
+    of the head, always goes to the primary.  The replica finds the user's
+    current store itself, so for a short while after a reset it may not
+    have seen the new one yet.  Reads for users reset through this instance
+    within the last replica_max_lag seconds therefore go to the primary.
     """
 
-    def __init__(self, sqluri, **dbkwds):
+    def __init__(self, sqluri, chunk_path=None, compression=None,
+                 compression_level=6, verify_chunk_ids=False,
+                 replica_sqluris=None,
+                 replica_retry_interval=DEFAULT_REPLICA_RETRY_INTERVAL,
+                 replica_max_lag=DEFAULT_REPLICA_MAX_LAG, **dbkwds):
         self.sqluri = sqluri
         self.dbconnector = DBConnector(sqluri, **dbkwds)
+        # Replicas use the same pool settings, but each gets its own pool.
+        # They're read-only, so it would make no sense to create tables.
+        if isinstance(replica_sqluris, basestring):
+            replica_sqluris = replica_sqluris.split()
+        replica_dbkwds = dict(dbkwds, create_tables=False)
+        self.replicas = [DBConnector(replica_sqluri, **replica_dbkwds)
+                         for replica_sqluri in replica_sqluris or ()]
+        self.replica_retry_interval = int(replica_retry_interval)
+        self._replicas_down_until = {}
+        self.replica_max_lag = int(replica_max_lag)
+        self._replicas_stale_until = {}
+        if chunk_path is None:
+            self.filestore = None
+        else:
+            self.filestore = FileChunkStore(chunk_path)
+        if compression is not None and compression not in COMPRESSION_CODECS:
+            raise ValueError("unknown compression codec: %r" % (compression,))
+        self.compression = compression
+        self.compression_level = compression_level
+        self.verify_chunk_ids = verify_chunk_ids
 
     def reset(self, userid):
-        # Deleting all transactions is sufficient to reset the user's
-        # storage state.  It might leave some orphaned chunk data but
-        # that can be dealth with via background garbage collection.
-        with self.dbconnector.connect() as session:
-            session.query("DELETE_ALL_TRANSACTIONS", {
-                "userid": userid
-            })
+        # Deleting all of a big user's data at once could hold locks for a
+        # long time.  Instead, point them at a new empty store and mark the
+        # old one as dead, to be purged a small batch at a time in the
+        # background by gc_dead_stores.
+        self._avoid_replicas_after_reset(userid)
+        try:
+            with self.dbconnector.connect() as session:
+                storeid = self._get_storeid(session, userid)
+                params = {
+                    "userid": userid,
+                    "storeid": str(uuid.uuid4()),
+                    "prev_storeid": storeid,
+                    "now": int(time.time()),
+                }
+                if storeid == userid:
+                    session.query("CREATE_USER_STORE", params)
+                elif not session.query("UPDATE_USER_STORE", params):
+                    # Someone else reset the user concurrently.
+                    return
+                session.query("CREATE_DEAD_STORE", params)
+        except IntegrityError:
+            # Someone else gave the user their first new store concurrently.
+            # Some databases won't commit after a failed statement, so this
+            # is caught only once the session has been rolled back.
+            pass
+
+    def _avoid_replicas_after_reset(self, userid):
+        """Read the user's data from the primary until replicas catch up."""
+        if not self.replicas:
+            return
+        now = time.time()
+        for stale_userid, until in self._replicas_stale_until.items():
+            if until <= now:
+                self._replicas_stale_until.pop(stale_userid, None)
+        self._replicas_stale_until[userid] = now + self.replica_max_lag
+
+    def _get_storeid(self, session, userid):
+        """Get the id of the store currently holding the user's data.
+
+        All rows in the other tables are keyed by this id rather than by the
+        userid itself.  Users who have never been reset have no entry in the
+        user_stores table, and their store id is the same as their userid.
+
+        Queries on the hot read paths do this lookup inline, and so can be
+        given the userid directly.
+        """
+        storeid = session.query_scalar("GET_USER_STORE", {
+            "userid": userid,
+        })
+        if storeid is None:
+            storeid = userid
+        return storeid
 
     def get_head(self, userid):
         with self.dbconnector.connect() as session:
             head = session.query_scalar("GET_HEAD", {
-                "userid": userid
+                "userid": userid,
             })
             if head is None:
                 head = ROOT_TRANSACTION
@@ -67,101 +224,1076 @@ class SQLStorage(MentatSyncStorage):
 
     def set_head(self, userid, trnid):
         with self.dbconnector.connect() as session:
-            updated = session.query("COMMIT_PENDING_TRANSACTION", {
-                "userid": userid,
+            storeid = self._get_storeid(session, userid)
+            self._set_head(session, storeid, trnid)
+
+    def _set_head(self, session, storeid, trnid):
+        trn_info = session.query_fetchone("GET_TRANSACTION_BRANCH", {
+            "userid": storeid,
+            "trnid": trnid,
+        })
+        if trn_info is None:
+            raise ConflictError()
+        # Mark the transaction's branch as committed.  This will fail if
+        # the branch was already committed, or if the transaction isn't
+        # at the tip of its branch.
+        updated = session.query("COMMIT_PENDING_BRANCH", {
+            "userid": storeid,
+            "branch": trn_info["branch"],
+            "trnid": trnid,
+        })
+        if not updated:
+            raise ConflictError()
+        # Advance the head, but only if it's still at the branch's base.
+        base = trn_info["base"]
+        if base == ROOT_TRANSACTION:
+            try:
+                session.query("CREATE_HEAD", {
+                    "userid": storeid,
+                    "trnid": trnid,
+                    "seq": trn_info["seq"],
+                })
+            except IntegrityError:
+                raise ConflictError()
+        else:
+            updated = session.query("UPDATE_HEAD", {
+                "userid": storeid,
                 "trnid": trnid,
+                "seq": trn_info["seq"],
+                "prev_head": base,
             })
             if not updated:
                 raise ConflictError()
 
-    def get_transactions(self, userid, frm, limit):
+    def get_transaction_seq(self, userid, trnid):
+        # Only committed transactions have a seq, so it never changes.
+        def get_seq(session, userid):
+            return session.query_scalar("GET_TRANSACTION_SEQ", {
+                "userid": userid,
+                "trnid": trnid,
+            })
+
+        seq = self._read_immutable(userid, get_seq)
+        if seq is None:
+            raise TransactionNotFoundError()
+        return seq
+
+    def get_transactions_after(self, userid, seq, limit):
         with self.dbconnector.connect() as session:
-            if frm == ROOT_TRANSACTION:
-                trns = session.query_fetchall("GET_TRANSACTIONS_FROM_ROOT", {
-                    "userid": userid,
-                    "limit": limit,
-                })
-            else:
-                trns = session.query_fetchall("GET_TRANSACTIONS", {
+            trns = session.query_fetchall("GET_TRANSACTIONS_AFTER", {
+                "userid": userid,
+                "seq": seq,
+                "limit": limit,
+            })
+            for trn in trns:
+                yield {
+                    "id": trn["trnid"],
+                    "seq": trn["seq"],
+                }
+
+    def get_transactions_with_chunks_after(self, userid, seq, limit):
+        with self.dbconnector.connect() as session:
+            rows = session.query_fetchall(
+                "GET_TRANSACTIONS_WITH_CHUNKS_AFTER", {
                     "userid": userid,
-                    "from": frm,
+                    "seq": seq,
                     "limit": limit,
                 })
-                if next(trns)["trnid"] != frm:
-                    # Whoops!
-                    # You tried to query from an uncommitted transaction!
-                    raise RuntimeError("seriously, don't do that")
-            for trn in trns:
-                yield trn["trnid"]
+            # Each row is a single (transaction, chunk) pair, ordered by
+            # seq and then by idx, so we can group them back together.
+            trns = itertools.groupby(rows, lambda row: row["trnid"])
+            for trnid, trn_rows in trns:
+                trn_rows = list(trn_rows)
+                yield {
+                    "id": trnid,
+                    "seq": trn_rows[0]["seq"],
+                    "parent": trn_rows[0]["parent"],
+                    "chunks": [r["chunk"] for r in trn_rows
+                               if r["chunk"] is not None],
+                }
 
     def create_transaction(self, userid, trnid, parent, chunks):
         with self.dbconnector.connect() as session:
-            if parent == ROOT_TRANSACTION:
-                session.query("CREATE_PENDING_TRANSACTION_FROM_ROOT", {
+            storeid = self._get_storeid(session, userid)
+            self._create_transaction(session, storeid, trnid, parent, chunks)
+
+    def _create_transaction(self, session, storeid, trnid, parent, chunks):
+        if parent == ROOT_TRANSACTION:
+            parent_seq = 0
+            parent_committed = True
+        else:
+            parent_info = session.query_fetchone("GET_TRANSACTION_BRANCH", {
+                "userid": storeid,
+                "trnid": parent,
+            })
+            if parent_info is None:
+                # We should probably differentiate this from the other
+                # conflict cases below, but meh for now.
+                raise ConflictError
+            parent_seq = parent_info["seq"]
+            parent_committed = parent_info["committed"]
+        if parent_committed:
+            # Descending from a committed transaction starts a new branch.
+            branch = trnid
+            session.query("CREATE_PENDING_BRANCH", {
+                "userid": storeid,
+                "branch": branch,
+                "base": parent,
+                "now": int(time.time()),
+            })
+        else:
+            # Descending from a pending transaction extends its branch,
+            # but only if the parent doesn't already have a descendant.
+            branch = parent_info["branch"]
+            updated = session.query("EXTEND_PENDING_BRANCH", {
+                "userid": storeid,
+                "branch": branch,
+                "trnid": trnid,
+                "parent": parent,
+                "now": int(time.time()),
+            })
+            if not updated:
+                raise ConflictError
+        session.query("CREATE_TRANSACTION", {
+            "userid": storeid,
+            "trnid": trnid,
+            "parent": parent,
+            "seq": parent_seq + 1,
+            "branch": branch,
+        })
+        self._add_chunk_list(session, "ADD_TRANSACTION_CHUNKS", storeid,
+                             trnid, chunks)
+
+    def _add_chunk_list(self, session, query_name, storeid, trnid, chunks):
+        """Link a list of chunks into a transaction or a snapshot.
+
+        This is done a batch at a time, using one query to check that they
+        all exist and another to insert them all at once.  The check locks
+        the chunks, so that the garbage collector can't delete them before
+        the new references to them are committed.
+        """
+        for idx in xrange(0, len(chunks), CHUNK_BATCH_SIZE):
+            batch = chunks[idx:idx + CHUNK_BATCH_SIZE]
+            distinct_chunks = list(set(batch))
+            found = list(session.query_fetchall("LOCK_CHUNKS", {
+                "userid": storeid,
+                "chunks": distinct_chunks,
+            }))
+            if len(found) != len(distinct_chunks):
+                raise ChunkNotFoundError()
+            session.query(query_name, {
+                "userid": storeid,
+                "trnid": trnid,
+                "idx": idx,
+                "chunks": batch,
+            })
+
+    def get_transaction(self, userid, trnid):
+        def get_trn(session, userid):
+            return self._get_transaction(session, userid, trnid)
+
+        # Pending transactions may yet be committed, so a replica may
+        # have a stale view of them.  Only trust it for committed ones.
+        trn = self._read_immutable(
+            userid, get_trn, lambda trn: trn is None or not trn["committed"])
+        if trn is None:
+            raise TransactionNotFoundError()
+        return trn
+
+    def _get_transaction(self, session, userid, trnid):
+        trn = session.query_fetchone("GET_TRANSACTION", {
+            "userid": userid,
+            "trnid": trnid,
+        })
+        if trn is None:
+            return None
+        chunks = session.query_fetchall("GET_TRANSACTION_CHUNKS", {
+            "userid": userid,
+            "trnid": trnid,
+        })
+        return {
+            "id": trn["trnid"],
+            "seq": trn["seq"],
+            "parent": trn["parent"],
+            "chunks": [c["chunk"] for c in chunks],
+            "committed": bool(trn["committed"]),
+        }
+
+    def get_snapshot(self, userid):
+        # Snapshots can be replaced, so always read them from the primary.
+        with self.dbconnector.connect() as session:
+            return self._get_snapshot(session, userid)
+
+    def get_snapshot_with_chunks(self, userid):
+        with self.dbconnector.connect() as session:
+            snapshot = self._get_snapshot(session, userid)
+            if snapshot is not None:
+                chunks = session.query_fetchall("GET_SNAPSHOT_CHUNKS", {
                     "userid": userid,
-                    "trnid": trnid,
+                    "trnid": snapshot["id"],
                 })
+                snapshot["chunks"] = [c["chunk"] for c in chunks]
+            return snapshot
+
+    def _get_snapshot(self, session, userid):
+        row = session.query_fetchone("GET_SNAPSHOT", {
+            "userid": userid,
+        })
+        if row is None:
+            return None
+        return {
+            "id": row["trnid"],
+            "seq": row["seq"],
+        }
+
+    def create_snapshot(self, userid, trnid, chunks):
+        with self.dbconnector.connect() as session:
+            storeid = self._get_storeid(session, userid)
+            seq = session.query_scalar("GET_TRANSACTION_SEQ", {
+                "userid": storeid,
+                "trnid": trnid,
+            })
+            if seq is None:
+                raise ConflictError()
+            prev = self._get_snapshot(session, storeid)
+            if prev is not None and prev["seq"] >= seq:
+                raise ConflictError()
+            params = {
+                "userid": storeid,
+                "trnid": trnid,
+                "seq": seq,
+            }
+            try:
+                self._add_chunk_list(session, "ADD_SNAPSHOT_CHUNKS", storeid,
+                                     trnid, chunks)
+            except IntegrityError:
+                # Someone else created the same snapshot concurrently.
+                raise ConflictError()
+            if prev is None:
+                try:
+                    session.query("CREATE_SNAPSHOT", params)
+                except IntegrityError:
+                    # Someone else created a snapshot concurrently.
+                    raise ConflictError()
             else:
-                inserted = session.query("CREATE_PENDING_TRANSACTION", {
-                    "userid": userid,
-                    "trnid": trnid,
-                    "parent": parent,
+                # Replace the previous snapshot, if it's still the latest.
+                params["prev_seq"] = prev["seq"]
+                if not session.query("UPDATE_SNAPSHOT", params):
+                    raise ConflictError()
+
+    def create_chunk(self, userid, chunk, payload):
+        with self.dbconnector.connect() as session:
+            storeid = self._get_storeid(session, userid)
+            self._create_chunks(session, storeid, [(chunk, payload)])
+
+    def create_chunk_from_file(self, userid, chunk, fileobj):
+        # Spool the payload into a temporary file while calculating its
+        # hash, so that we never hold more than a small buffer in memory.
+        spooled, payload_hash, size = _spool_payload(fileobj)
+        with spooled:
+            self._check_chunk_hash(chunk, payload_hash)
+            with self.dbconnector.connect() as session:
+                storeid = self._get_storeid(session, userid)
+                self._add_chunks(session, storeid, [(chunk, payload_hash)], {
+                    payload_hash: (spooled, size),
                 })
-                if not inserted:
-                    # This could fail because parent doesn't exist, or
-                    # because parent already has a descendant.
-                    # We should differentiate, but meh for now.
-                    raise ConflictError
-                updated = session.query("BUMP_PENDING_TRANSACTION_ANCESTORS", {
-                    "userid": userid,
-                    "trnid": trnid,
-                    "parent": parent,
+
+    def create_chunks(self, userid, chunks):
+        with self.dbconnector.connect() as session:
+            storeid = self._get_storeid(session, userid)
+            self._create_chunks(session, storeid, chunks)
+
+    def _create_chunks(self, session, storeid, chunks):
+        for batch in _batch_chunks(chunks):
+            new_chunks = []
+            payloads = {}
+            for chunk, payload in batch:
+                payload_hash = hashlib.sha256(payload).hexdigest()
+                self._check_chunk_hash(chunk, payload_hash)
+                new_chunks.append((chunk, payload_hash))
+                payloads[payload_hash] = (StringIO(payload), len(payload))
+            self._add_chunks(session, storeid, new_chunks, payloads)
+
+    def _check_chunk_hash(self, chunk, payload_hash):
+        """Check that a chunk id matches its payload, if so configured."""
+        if self.verify_chunk_ids and chunk != payload_hash:
+            raise ChunkHashMismatchError()
+
+    def _add_chunks(self, session, storeid, chunks, payloads):
+        """Add a batch of chunks, storing any new payloads.
+
+        The "chunks" argument is a list of (chunk, payload_hash) pairs, and
+        "payloads" maps each payload hash to a (fileobj, size) pair from
+        which the payload can be read if it needs to be stored.
+        """
+        # Chunks are immutable, so there's nothing to store for any that
+        # the user has already uploaded.  But uploading one again means it's
+        # still in use, so refresh its upload time to keep it safe from the
+        # garbage collector.  That's done before looking for existing chunks
+        # so that they stay locked until we commit, and any that were
+        # deleted in the meantime are simply uploaded afresh.
+        distinct_chunks = list(set(chunk for chunk, _ in chunks))
+        now = int(time.time())
+        session.query("TOUCH_CHUNKS", {
+            "userid": storeid,
+            "chunks": distinct_chunks,
+            "now": now,
+        })
+        existing = session.query_fetchall("GET_CHUNK_IDS", {
+            "userid": storeid,
+            "chunks": distinct_chunks,
+        })
+        seen = set(row["chunk"] for row in existing)
+        new_chunks = []
+        refcounts = collections.defaultdict(int)
+        for chunk, payload_hash in chunks:
+            if chunk in seen:
+                continue
+            seen.add(chunk)
+            new_chunks.append((chunk, payload_hash))
+            refcounts[payload_hash] += 1
+        if not new_chunks:
+            return
+        self._add_payload_refs(session, payloads, refcounts)
+        try:
+            session.query("ADD_CHUNKS", {
+                "userid": storeid,
+                "chunks": new_chunks,
+                "now": now,
+            })
+        except IntegrityError:
+            # Someone else uploaded the same chunks concurrently.
+            raise ConflictError()
+
+    def _add_payload_refs(self, session, payloads, refcounts):
+        """Add references to the given payloads, storing any new ones.
+
+        The "payloads" argument maps payload hashes to a (fileobj, size)
+        pair from which to read the payload, and "refcounts" maps payload
+        hashes to the number of references to add for that payload.
+        """
+        existing = session.query_fetchall("GET_PAYLOAD_HASHES", {
+            "hashes": list(refcounts),
+        })
+        existing = set(row["hash"] for row in existing)
+        missing = [h for h in refcounts if h not in existing]
+        if missing:
+            try:
+                session.query("INSERT_PAYLOADS", {
+                    "payloads": [self._encode_payload(h, *payloads[h])
+                                 for h in missing],
                 })
-                if not updated:
-                    raise RuntimeError("something has gone terribly wrong")
-            for idx, chunk in enumerate(chunks):
-                added = session.query("ADD_TRANSACTION_CHUNK", {
+            except IntegrityError:
+                # Someone else stored the same payloads concurrently.
+                raise ConflictError()
+        # Bump the refcounts using one query for each distinct increment,
+        # which in practice is almost always just a single query.
+        hashes_by_count = collections.defaultdict(list)
+        for payload_hash, count in refcounts.iteritems():
+            hashes_by_count[count].append(payload_hash)
+        for count, hashes in hashes_by_count.iteritems():
+            updated = session.query("INCREMENT_PAYLOAD_REFCOUNTS", {
+                "hashes": hashes,
+                "count": count,
+            })
+            if updated != len(hashes):
+                raise ConflictError()
+
+    def get_chunk(self, userid, chunk):
+        return self._decode_payload(self._get_chunk_row(userid, chunk))
+
+    def _get_chunk_row(self, userid, chunk):
+        def get_row(session, userid):
+            return session.query_fetchone("GET_CHUNK_PAYLOAD", {
+                "userid": userid,
+                "chunk": chunk,
+            })
+
+        row = self._read_immutable(userid, get_row)
+        if row is None:
+            raise ChunkNotFoundError()
+        return row
+
+    def open_chunk(self, userid, chunk):
+        fileobj, _ = self.open_chunk_encoded(userid, chunk, ())
+        return fileobj
+
+    def open_chunk_encoded(self, userid, chunk, encodings):
+        row = self._get_chunk_row(userid, chunk)
+        # Payloads in the filestore can be read without going through
+        # the database, and without loading them all into memory.  If the
+        # caller accepts the encoding they're stored in, we can also avoid
+        # decoding them.
+        encoding = row["payload_encoding"]
+        if row["payload"] is None:
+            key = _filestore_key(row["payload_hash"], encoding)
+            fileobj = self.filestore.open(key)
+        else:
+            payload = self.dbconnector.from_binary_result(row["payload"])
+            fileobj = StringIO(payload)
+        if encoding == PAYLOAD_ENCODING_IDENTITY or encoding in encodings:
+            return fileobj, encoding
+        if encoding == PAYLOAD_ENCODING_GZIP:
+            try:
+                decoded = _gzip_decompress_file(fileobj)
+            finally:
+                fileobj.close()
+            return decoded, PAYLOAD_ENCODING_IDENTITY
+        return StringIO(self._decode_payload(row)), PAYLOAD_ENCODING_IDENTITY
+
+    def get_chunks(self, userid, chunks):
+        for i in xrange(0, len(chunks), CHUNK_BATCH_SIZE):
+            batch = chunks[i:i + CHUNK_BATCH_SIZE]
+
+            def get_batch_rows(session, userid):
+                rows = session.query_fetchall("GET_CHUNK_PAYLOADS", {
                     "userid": userid,
-                    "trnid": trnid,
-                    "idx": idx,
-                    "chunk": chunk,
+                    "chunks": batch,
                 })
-                if not added:
-                    raise ChunkNotFoundError()
+                return dict((r["chunk"], r) for r in rows)
 
-    def get_transaction(self, userid, trnid):
+            # If the replica is missing any of them, try the whole batch
+            # again on the primary in case they've only just been written.
+            rows = self._read_immutable(
+                userid, get_batch_rows,
+                lambda rows: len(rows) < len(set(batch)))
+            for chunk in batch:
+                try:
+                    row = rows[chunk]
+                except KeyError:
+                    continue
+                yield chunk, self._decode_payload(row)
+
+    def _read_immutable(self, userid, func, is_stale=None):
+        """Read some of a user's immutable data, from a replica if possible.
+
+        The given function is called with a session on a randomly-chosen
+        replica and the userid, and its result returned.  If there are no
+        replicas, if the chosen replica is unavailable, if the user was
+        recently reset, or if the is_stale function says that the result
+        may be out of date, it is called again with a session on the
+        primary database instead.  By default, a result of None is taken
+        to mean that the replica has not yet seen the data.
+        """
+        if is_stale is None:
+            is_stale = _is_none
+        replica = None
+        if self._replicas_stale_until.get(userid, 0) <= time.time():
+            replica = self._choose_replica()
+        if replica is not None:
+            try:
+                with replica.connect() as session:
+                    result = func(session, userid)
+            except BackendError:
+                logger.warn("Replica unavailable, reading from primary")
+                retry_at = time.time() + self.replica_retry_interval
+                self._replicas_down_until[replica] = retry_at
+            else:
+                if not is_stale(result):
+                    return result
         with self.dbconnector.connect() as session:
-            trn = session.query_fetchone("GET_TRANSACTION", {
-                "userid": userid,
-                "trnid": trnid,
+            return func(session, userid)
+
+    def _choose_replica(self):
+        """Randomly choose a replica that is not known to be down."""
+        now = time.time()
+        replicas = [replica for replica in self.replicas
+                    if self._replicas_down_until.get(replica, 0) <= now]
+        if not replicas:
+            return None
+        return random.choice(replicas)
+
+    def _encode_payload(self, payload_hash, fileobj, size):
+        """Convert a payload into a new row for the payloads table.
+
+        The payload is read from the given file-like object, which must
+        be seekable.  If compression is enabled then the payload is
+        compressed, unless that would fail to make it any smaller.  If we
+        have a filestore then the payload is streamed out to it, and only
+        its hash is stored in the database.
+        """
+        encoding = PAYLOAD_ENCODING_IDENTITY
+        if self.compression == PAYLOAD_ENCODING_GZIP:
+            compressed = _gzip_compress_file(fileobj, self.compression_level)
+            if get_file_size(compressed) < size:
+                fileobj = compressed
+                encoding = PAYLOAD_ENCODING_GZIP
+            else:
+                fileobj.seek(0)
+        if self.filestore is not None:
+            key = _filestore_key(payload_hash, encoding)
+            self.filestore.put_file(fileobj, key)
+            payload = None
+        else:
+            # The database drivers can only take the payload as a string.
+            payload = self.dbconnector.to_binary_param(fileobj.read())
+        return {
+            "hash": payload_hash,
+            "payload": payload,
+            "payload_encoding": encoding,
+            "refcount": 0,
+        }
+
+    def _decode_payload(self, row):
+        """Convert a payload as stored in the database into raw bytes."""
+        encoding = row["payload_encoding"]
+        if row["payload"] is None:
+            key = _filestore_key(row["payload_hash"], encoding)
+            payload = self.filestore.get(key)
+        else:
+            payload = self.dbconnector.from_binary_result(row["payload"])
+        if encoding == PAYLOAD_ENCODING_GZIP:
+            payload = _gzip_decompress(payload)
+        elif encoding == PAYLOAD_ENCODING_BASE64:
+            payload = base64.b64decode(payload)
+        elif encoding != PAYLOAD_ENCODING_IDENTITY:
+            raise ValueError("unknown payload encoding: %r" % (encoding,))
+        return payload
+
+    def convert_legacy_chunks(self, start=None, limit=100):
+        """Move a batch of legacy chunk payloads into the payloads table.
+
+        This method finds up to "limit" chunks stored in a legacy format,
+        ordered by (userid, chunk) and starting after the given (userid,
+        chunk) key, and rewrites them to reference a shared payload.  It
+        returns the key of the last chunk converted, which should be
+        passed as "start" to the next call, or None if there is nothing
+        left to convert.
+        """
+        if start is None:
+            start = ("", "")
+        last_key = None
+        with self.dbconnector.connect() as session:
+            rows = list(session.query_fetchall("GET_LEGACY_CHUNKS", {
+                "userid": start[0],
+                "chunk": start[1],
+                "limit": limit,
+            }))
+            for row in rows:
+                payload = self._decode_payload(row)
+                payload_hash = hashlib.sha256(payload).hexdigest()
+                # Only add a reference if we're the ones that converted
+                # it, in case another process is converting concurrently.
+                updated = session.query("CONVERT_LEGACY_CHUNK", {
+                    "userid": row["userid"],
+                    "chunk": row["chunk"],
+                    "payload_hash": payload_hash,
+                })
+                if updated:
+                    self._add_payload_refs(session, {
+                        payload_hash: (StringIO(payload), len(payload)),
+                    }, {
+                        payload_hash: 1,
+                    })
+                last_key = (row["userid"], row["chunk"])
+        return last_key
+
+    def gc_dead_stores(self, start=None, limit=100,
+                       delay=DEFAULT_PURGE_DELAY):
+        """Delete a batch of rows from the stores of users who were reset.
+
+        This method finds the first dead store with an id of at least the
+        given "start" id, which was reset more than "delay" seconds ago, and
+        deletes up to "limit" of its rows from one of the tables.  Once all
+        of its rows are gone, the dead store itself is removed.  It returns
+        the id of the store, which should be passed as "start" to the next
+        call, or None if there is nothing left to purge.
+        """
+        if start is None:
+            start = ""
+        cutoff = int(time.time()) - delay
+        with self.dbconnector.connect() as session:
+            storeid = session.query_scalar("GET_DEAD_STORE", {
+                "storeid": start,
+                "cutoff": cutoff,
             })
-            if trn is None:
-                raise TransactionNotFoundError()
-            chunks = session.query_fetchall("GET_TRANSACTION_CHUNKS", {
-                "userid": userid,
-                "trnid": trnid,
+            if storeid is None:
+                return None
+            params = {
+                "userid": storeid,
+                "storeid": storeid,
+                "limit": limit,
+            }
+            # Chunks must be deleted individually, so that we know exactly
+            # which payload references to drop.
+            rows = list(session.query_fetchall("GET_STORE_CHUNKS", params))
+            refcounts = collections.defaultdict(int)
+            for row in rows:
+                deleted = session.query("DELETE_STORE_CHUNK", {
+                    "userid": storeid,
+                    "chunk": row["chunk"],
+                })
+                if deleted and row["payload_encoding"] is None:
+                    refcounts[row["payload_hash"]] += 1
+            if rows:
+                self._drop_payload_refs(session, refcounts)
+                return storeid
+            # No snapshot can be of the root transaction, so this finds
+            # the chunk lists of all of them.
+            if self._delete_old_snapshot_chunks(session, storeid,
+                                                ROOT_TRANSACTION, limit):
+                return storeid
+            for query in ("GET_STORE_TRANSACTIONS",
+                          "GET_STORE_TRANSACTION_CHUNKS"):
+                rows = session.query_fetchall(query, params)
+                trnids = [row["trnid"] for row in rows]
+                if trnids:
+                    self._delete_transactions(session, storeid, trnids, limit)
+                    return storeid
+            rows = session.query_fetchall("GET_STORE_BRANCHES", params)
+            branches = [row["branch"] for row in rows]
+            if branches:
+                params["branches"] = branches
+                session.query("DELETE_STORE_BRANCHES", params)
+                return storeid
+            session.query("DELETE_HEAD", params)
+            session.query("DELETE_SNAPSHOT", params)
+            session.query("DELETE_DEAD_STORE", params)
+            return storeid
+
+    def gc_snapshot_history(self, start=None, limit=100):
+        """Delete a batch of history made redundant by a newer snapshot.
+
+        This method finds the first store with an id of at least the given
+        "start" id whose snapshot has not yet been fully pruned, and deletes
+        up to "limit" rows from one of the tables: the chunk lists of older
+        snapshots, then committed transactions from before the snapshot,
+        then the branches that held them.  Once there's nothing left to
+        delete, the store is marked as pruned.  It returns the id of the
+        store, which should be passed as "start" to the next call, or None
+        if there is nothing left to prune.
+        """
+        if start is None:
+            start = ""
+        with self.dbconnector.connect() as session:
+            row = session.query_fetchone("GET_GC_SNAPSHOT", {
+                "userid": start,
             })
-            return {
-                "id": trn["trnid"],
-                "seq": trn["seq"],
-                "parent": trn["parent"],
-                "chunks": [c["chunk"] for c in chunks],
+            if row is None:
+                return None
+            storeid = row["userid"]
+            params = {
+                "userid": storeid,
+                "seq": row["seq"],
+                "limit": limit,
             }
+            if self._delete_old_snapshot_chunks(session, storeid,
+                                                row["trnid"], limit):
+                return storeid
+            # Transactions are deleted oldest first, so whatever's left is
+            # always a contiguous run of history leading to the snapshot.
+            rows = session.query_fetchall("GET_PRUNABLE_TRANSACTIONS", params)
+            trnids = [r["trnid"] for r in rows]
+            if trnids:
+                self._delete_transactions(session, storeid, trnids, limit)
+                return storeid
+            rows = session.query_fetchall("GET_PRUNABLE_BRANCHES", params)
+            branches = [r["branch"] for r in rows]
+            if branches:
+                params["branches"] = branches
+                session.query("DELETE_STORE_BRANCHES", params)
+                return storeid
+            session.query("MARK_SNAPSHOT_PRUNED", params)
+            return storeid
 
-    def create_chunk(self, userid, chunk, payload):
+    def _delete_old_snapshot_chunks(self, session, storeid, keep, limit):
+        """Delete up to "limit" entries from the chunk lists of snapshots.
+
+        The chunk list of the snapshot with id "keep" is left alone.  This
+        returns True if anything was deleted.
+        """
+        rows = list(session.query_fetchall("GET_OLD_SNAPSHOT_CHUNKS", {
+            "userid": storeid,
+            "trnid": keep,
+            "limit": limit,
+        }))
+        deleted = False
+        for trnid, trn_rows in itertools.groupby(rows, lambda r: r["trnid"]):
+            session.query("DELETE_OLD_SNAPSHOT_CHUNKS", {
+                "userid": storeid,
+                "trnid": trnid,
+                "idx": max(r["idx"] for r in trn_rows),
+            })
+            deleted = True
+        return deleted
+
+    def gc_stale_branches(self, start=None, limit=100,
+                          max_age=DEFAULT_GC_MAX_AGE):
+        """Delete a batch of abandoned pending branches.
+
+        This method scans up to "limit" branches, ordered by (userid, branch)
+        and starting after the given key, and deletes any that are pending
+        and have not been extended for "max_age" seconds, along with all of
+        their transactions.  It returns the key of the last branch scanned,
+        which should be passed as "start" to the next call, or None if the
+        scan is complete.
+
+        A branch with more transactions than can be deleted in one batch
+        is left part-way through, and the key returned is the one before it,
+        so that the next call carries on where this one left off.
+        """
+        if start is None:
+            start = ("", "")
+        cutoff = int(time.time()) - max_age
+        last_key = None
         with self.dbconnector.connect() as session:
-            session.query("CREATE_CHUNK", {
-                "userid": userid,
-                "chunk": chunk,
-                "payload": base64.b64encode(payload),
+            rows = list(session.query_fetchall("GET_GC_BRANCHES", {
+                "userid": start[0],
+                "branch": start[1],
+                "limit": limit,
+            }))
+            for row in rows:
+                params = {
+                    "userid": row["userid"],
+                    "branch": row["branch"],
+                    "cutoff": cutoff,
+                    "limit": limit,
+                }
+                # Killed branches have an empty tip.  Killing the branch
+                # first means that any concurrent attempt to extend or
+                # commit it will fail with a conflict.
+                if row["tip"] != "":
+                    if row["committed"] or _is_recent(row["last_modified"],
+                                                      cutoff):
+                        last_key = (row["userid"], row["branch"])
+                        continue
+                    if not session.query("KILL_STALE_BRANCH", params):
+                        last_key = (row["userid"], row["branch"])
+                        continue
+                trns = session.query_fetchall("GET_BRANCH_TRANSACTIONS",
+                                              params)
+                trnids = [trn["trnid"] for trn in trns]
+                if trnids:
+                    self._delete_transactions(session, row["userid"], trnids,
+                                              limit)
+                    return last_key or start
+                session.query("DELETE_KILLED_BRANCH", params)
+                last_key = (row["userid"], row["branch"])
+        return last_key
+
+    def _delete_transactions(self, session, storeid, trnids, limit):
+        """Delete some of the given transactions, along with their chunks.
+
+        Transactions are deleted in the given order, until about "limit"
+        rows of their chunk lists have been deleted.  Each transaction's
+        chunk list is deleted in the same database transaction as the
+        transaction itself, so nobody can see it half-deleted, but no
+        single statement deletes more than "limit" rows.
+        """
+        counts = session.query_fetchall("GET_TRANSACTION_CHUNK_COUNTS", {
+            "userid": storeid,
+            "trnids": trnids,
+        })
+        counts = dict((row["trnid"], row) for row in counts)
+        deleted = []
+        num_rows = 0
+        for trnid in trnids:
+            count = counts.get(trnid)
+            if count is not None:
+                if deleted and num_rows + count["num_chunks"] > limit:
+                    break
+                num_rows += count["num_chunks"]
+                for idx in xrange(limit - 1, count["max_idx"] + limit, limit):
+                    session.query("DELETE_TRANSACTION_CHUNKS_UPTO", {
+                        "userid": storeid,
+                        "trnid": trnid,
+                        "idx": idx,
+                    })
+            deleted.append(trnid)
+        session.query("DELETE_STORE_TRANSACTIONS", {
+            "userid": storeid,
+            "trnids": deleted,
+        })
+
+    def gc_unreferenced_chunks(self, start=None, limit=100,
+                               max_age=DEFAULT_GC_MAX_AGE):
+        """Delete a batch of chunks that no transaction refers to.
+
+        This method finds up to "limit" chunks, ordered by (userid, chunk)
+        and starting after the given key, that are not part of any
+        transaction or snapshot and were uploaded more than "max_age"
+        seconds ago, and deletes them.  It returns the key of the last chunk
+        found, which should be passed as "start" to the next call, or None
+        if the scan is complete.
+
+        This drops the deleted chunks' references to their payloads, but
+        does not delete the payloads themselves; that's done by a separate
+        pass over the payloads table in gc_unreferenced_payloads.
+        """
+        if start is None:
+            start = ("", "")
+        cutoff = int(time.time()) - max_age
+        last_key = None
+        with self.dbconnector.connect() as session:
+            rows = list(session.query_fetchall("GET_GC_CHUNKS", {
+                "userid": start[0],
+                "chunk": start[1],
+                "cutoff": cutoff,
+                "limit": limit,
+            }))
+            refcounts = collections.defaultdict(int)
+            for row in rows:
+                last_key = (row["userid"], row["chunk"])
+                # Something may have started using it in the meantime.
+                deleted = session.query("DELETE_UNREFERENCED_CHUNK", {
+                    "userid": row["userid"],
+                    "chunk": row["chunk"],
+                    "cutoff": cutoff,
+                })
+                # Legacy rows don't hold a reference to their payload.
+                if deleted and row["payload_encoding"] is None:
+                    refcounts[row["payload_hash"]] += 1
+            self._drop_payload_refs(session, refcounts)
+        return last_key
+
+    def _drop_payload_refs(self, session, refcounts):
+        """Remove references to the given payloads.
+
+        The "refcounts" argument maps payload hashes to the number of
+        references to remove from that payload.  Payloads left with no
+        references are deleted later, by gc_unreferenced_payloads.
+        """
+        hashes_by_count = collections.defaultdict(list)
+        for payload_hash, count in refcounts.iteritems():
+            hashes_by_count[count].append(payload_hash)
+        for count, hashes in hashes_by_count.iteritems():
+            session.query("DECREMENT_PAYLOAD_REFCOUNTS", {
+                "hashes": hashes,
+                "count": count,
             })
 
-    def get_chunk(self, userid, chunk):
+    def gc_unreferenced_payloads(self, start=None, limit=100):
+        """Delete a batch of payloads that no chunk refers to.
+
+        This method scans up to "limit" payloads, ordered by hash and
+        starting after the given hash, and deletes any that have a refcount
+        of zero, including their files in the filestore.  It returns the
+        hash of the last payload scanned, which should be passed as "start"
+        to the next call, or None if the scan is complete.
+        """
+        if start is None:
+            start = ""
         with self.dbconnector.connect() as session:
-            payload = session.query_scalar("GET_CHUNK_PAYLOAD", {
-                "userid": userid,
-                "chunk": chunk,
+            rows = list(session.query_fetchall("GET_GC_PAYLOADS", {
+                "hash": start,
+                "limit": limit,
+            }))
+        if not rows:
+            return None
+        candidates = [row for row in rows if row["refcount"] == 0]
+        if candidates:
+            self._delete_unreferenced_payloads(candidates)
+        return rows[-1]["hash"]
+
+    def _delete_unreferenced_payloads(self, rows):
+        """Delete the given payload rows, if they're still unreferenced.
+
+        Payloads in the filestore are moved aside before deleting their row,
+        so that a concurrent upload of the same content will write a fresh
+        copy rather than finding the old one about to be deleted.  If the
+        payload gains a new reference in the meantime, it's put back.
+        """
+        discarded = {}
+        for row in rows:
+            if row["in_filestore"] and self.filestore is not None:
+                key = _filestore_key(row["hash"], row["payload_encoding"])
+                path = self.filestore.discard(key)
+                if path is not None:
+                    discarded[row["hash"]] = (key, path)
+        hashes = [row["hash"] for row in rows]
+        try:
+            with self.dbconnector.connect() as session:
+                session.query("DELETE_UNREFERENCED_PAYLOADS", {
+                    "hashes": hashes,
+                })
+                kept = session.query_fetchall("GET_PAYLOAD_HASHES", {
+                    "hashes": hashes,
+                })
+                kept = set(row["hash"] for row in kept)
+        except BaseException:
+            kept = set(hashes)
+            raise
+        finally:
+            for payload_hash, (key, path) in discarded.iteritems():
+                if payload_hash in kept:
+                    self.filestore.restore(path, key)
+                else:
+                    os.unlink(path)
+
+    def gc_orphaned_files(self, start=None, limit=100,
+                          max_age=DEFAULT_GC_MAX_AGE):
+        """Delete a batch of files in the filestore that no payload uses.
+
+        Files are written to the filestore before the database transaction
+        that adds their payload row is committed, so a transaction that
+        fails or is rolled back can leave files with no row behind.  This
+        method scans up to "limit" files, ordered by name and starting
+        after the given name, and deletes any that have no payload row and
+        were last written more than "max_age" seconds ago.  It returns the
+        name of the last file scanned, which should be passed as "start"
+        to the next call, or None if the scan is complete.
+
+        Legacy chunks can refer to files without a payload row, so nothing
+        is deleted until they have all been converted.
+        """
+        if self.filestore is None:
+            return None
+        if start is None:
+            with self.dbconnector.connect() as session:
+                legacy = session.query_fetchone(
+                    "GET_LEGACY_FILESTORE_CHUNK", {})
+            if legacy is not None:
+                logger.warn("Not sweeping the filestore, since there are"
+                            " unconverted legacy chunks")
+                return None
+        keys = self.filestore.list_keys(start or "", limit)
+        if not keys:
+            return None
+        cutoff = time.time() - max_age
+        candidates = []
+        for key in keys:
+            mtime = self.filestore.get_mtime(key)
+            if mtime is not None and mtime < cutoff:
+                candidates.append(key)
+        if candidates:
+            self._delete_orphaned_files(candidates)
+        return keys[-1]
+
+    def _delete_orphaned_files(self, keys):
+        """Delete the given filestore files, if they still have no row.
+
+        As in _delete_unreferenced_payloads, the files are moved aside
+        before checking for a row one last time, so that a concurrent upload
+        of the same content will write a fresh copy.
+        """
+        keys = [key for key in keys
+                if key not in self._get_filestore_keys(keys)]
+        if not keys:
+            return
+        discarded = {}
+        for key in keys:
+            path = self.filestore.discard(key)
+            if path is not None:
+                discarded[key] = path
+        try:
+            kept = self._get_filestore_keys(keys)
+        except BaseException:
+            kept = set(discarded)
+            raise
+        finally:
+            for key, path in discarded.iteritems():
+                if key in kept:
+                    self.filestore.restore(path, key)
+                else:
+                    os.unlink(path)
+
+    def _get_filestore_keys(self, keys):
+        """Find which of the given filestore files have a payload row."""
+        hashes = list(set(key.split(".")[0] for key in keys))
+        with self.dbconnector.connect() as session:
+            rows = session.query_fetchall("GET_FILESTORE_PAYLOADS", {
+                "hashes": hashes,
             })
-            if payload is None:
-                raise ChunkNotFoundError()
-            return base64.b64decode(payload)
+            return set(_filestore_key(row["hash"], row["payload_encoding"])
+                       for row in rows)
+
+    def push(self, userid, chunks, transactions, head=None):
+        with self.dbconnector.connect() as session:
+            storeid = self._get_storeid(session, userid)
+            self._create_chunks(session, storeid, chunks)
+            for trn in transactions:
+                self._create_transaction(session, storeid, trn["id"],
+                                         trn["parent"], trn["chunks"])
+            if head is not None:
+                self._set_head(session, storeid, head)
+
+
+def _is_recent(timestamp, cutoff):
+    """Check whether a last-modified timestamp is newer than the cutoff.
+
+    Rows that predate the timestamp columns have a NULL timestamp, and are
+    always considered old.
+    """
+    return timestamp is not None and timestamp >= cutoff
+
+
+def _is_none(result):
+    """Default staleness check for data read from a replica."""
+    return result is None
+
+
+def _batch_chunks(chunks):
+    """Split an iterable of (chunk, payload) pairs into bounded batches."""
+    batch = []
+    batch_bytes = 0
+    for chunk, payload in chunks:
+        batch.append((chunk, payload))
+        batch_bytes += len(payload)
+        if len(batch) >= CHUNK_BATCH_SIZE or batch_bytes >= CHUNK_BATCH_BYTES:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
+
+def _filestore_key(payload_hash, encoding):
+    """Get the name under which to store a payload in the filestore.
+
+    Encoded payloads get a suffix, so that changing the compression
+    settings can never confuse them with an unencoded file of the same
+    content.
+    """
+    if encoding == PAYLOAD_ENCODING_IDENTITY:
+        return payload_hash
+    return payload_hash + "." + encoding
+
+
+def _spool_payload(fileobj):
+    """Copy a payload into a temporary file, calculating its hash and size.
+
+    Small payloads are kept in memory, larger ones are spooled to disk.
+    Returns a (spooled, payload_hash, size) tuple with the temporary file
+    positioned at the start of the payload.
+    """
+    spooled = tempfile.SpooledTemporaryFile(CHUNK_SPOOL_BYTES)
+    hasher = hashlib.sha256()
+    size = 0
+    for block in iter(lambda: fileobj.read(CHUNK_BLOCK_SIZE), ""):
+        hasher.update(block)
+        spooled.write(block)
+        size += len(block)
+    spooled.seek(0)
+    return spooled, hasher.hexdigest(), size
+
+
+def _gzip_compress_file(fileobj, level):
+    """Compress a file into a temporary file in the gzip format."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    spooled = tempfile.SpooledTemporaryFile(CHUNK_SPOOL_BYTES)
+    for block in iter(lambda: fileobj.read(CHUNK_BLOCK_SIZE), ""):
+        spooled.write(compressor.compress(block))
+    spooled.write(compressor.flush())
+    spooled.seek(0)
+    return spooled
+
+
+def _gzip_decompress_file(fileobj):
+    """Decompress a gzip-format file into a temporary file."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    spooled = tempfile.SpooledTemporaryFile(CHUNK_SPOOL_BYTES)
+    for block in iter(lambda: fileobj.read(CHUNK_BLOCK_SIZE), ""):
+        # Limit the output of each step, to guard against zip bombs
+        # blowing up our memory usage.
+        spooled.write(decompressor.decompress(block, CHUNK_BLOCK_SIZE))
+        while decompressor.unconsumed_tail:
+            spooled.write(decompressor.decompress(
+                decompressor.unconsumed_tail, CHUNK_BLOCK_SIZE))
+    spooled.write(decompressor.flush())
+    spooled.seek(0)
+    return spooled
+
+
+def _gzip_decompress(data):
+    """Decompress data from the gzip format, as used by HTTP."""
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
@@ -25,7 +25,7 @@ from sqlalchemy.util.queue import Queue
 from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.sql import insert, update, text as sqltext
 from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError
-from sqlalchemy import (Integer, String, Text, Boolean,
+from sqlalchemy import (Integer, String, LargeBinary, Boolean,
                         MetaData, Column, Table, Index)
 from sqlalchemy.dialects import postgresql, mysql
 
@@ -63,18 +63,60 @@ def UUID():
     return String(36)
 
 
+# Each user's data is kept in a "store", and all rows in the other tables
+# are keyed by the store id rather than by the userid.  The two are the same
+# until the user is reset, at which point the "user_stores" table is updated
+# to point them at a new empty store.  The old store is recorded in the
+# "dead_stores" table so that its rows can be purged in the background.
+
+user_stores = Table(
+    "user_stores",
+    metadata,
+    Column("userid", UUID(), primary_key=True, nullable=False),
+    Column("storeid", UUID(), nullable=False),
+)
+
+
+dead_stores = Table(
+    "dead_stores",
+    metadata,
+    Column("storeid", UUID(), primary_key=True, nullable=False),
+    Column("deleted_at", Integer, nullable=False),
+)
+
+
 transactions = Table(
     "transactions",
     metadata,
     Column("userid", UUID(), primary_key=True, nullable=False),
     Column("trnid", UUID(), primary_key=True, nullable=False),
     Column("parent", UUID(), nullable=False),
-    Column("committed", Boolean, nullable=False),
     Column("seq", Integer, nullable=False),
-    Column("prev_head", UUID(), nullable=False),
-    Column("next_head", UUID(), nullable=False),
+    Column("branch", UUID(), nullable=False),
     Index("trn_usr_seq", "userid", "seq"),
-    Index("trn_usr_nhead", "userid", "next_head"),
+    Index("trn_usr_branch", "userid", "branch"),
+)
+
+
+heads = Table(
+    "heads",
+    metadata,
+    Column("userid", UUID(), primary_key=True, nullable=False),
+    Column("trnid", UUID(), nullable=False),
+    Column("seq", Integer, nullable=False),
+)
+
+
+branches = Table(
+    "branches",
+    metadata,
+    Column("userid", UUID(), primary_key=True, nullable=False),
+    Column("branch", UUID(), primary_key=True, nullable=False),
+    Column("base", UUID(), nullable=False),
+    Column("tip", UUID(), nullable=False),
+    Column("committed", Boolean, nullable=False),
+    Column("last_modified", Integer, nullable=True),
+    Index("brn_usr_tip", "userid", "tip"),
 )
 
 
@@ -86,19 +128,89 @@ transaction_chunks = Table(
     Column("idx", Integer, primary_key=True, nullable=False,
            autoincrement=False),
     Column("chunk", UUID(), nullable=False),
+    Index("trnchk_usr_chunk", "userid", "chunk"),
+)
+
+
+# Each store may have a snapshot of its full state as of some committed
+# transaction, so that new clients can start from that rather than replaying
+# all of the history before it.  Only the newest snapshot is kept, but the
+# chunk lists of older ones linger in "snapshot_chunks" until the garbage
+# collector deletes them, along with any history that the newest snapshot
+# has made redundant.  The "pruned_seq" column records how far it got.
+
+snapshots = Table(
+    "snapshots",
+    metadata,
+    Column("userid", UUID(), primary_key=True, nullable=False),
+    Column("trnid", UUID(), nullable=False),
+    Column("seq", Integer, nullable=False),
+    Column("pruned_seq", Integer, nullable=False),
+)
+
+
+snapshot_chunks = Table(
+    "snapshot_chunks",
+    metadata,
+    Column("userid", UUID(), primary_key=True, nullable=False),
+    Column("trnid", UUID(), primary_key=True, nullable=False),
+    Column("idx", Integer, primary_key=True, nullable=False,
+           autoincrement=False),
+    Column("chunk", String(64), nullable=False),
+    Index("snpchk_usr_chunk", "userid", "chunk"),
 )
 
 
-PAYLOAD_TYPE = Text()
-PAYLOAD_TYPE = PAYLOAD_TYPE.with_variant(postgresql.TEXT(), 'postgresql')
-PAYLOAD_TYPE = PAYLOAD_TYPE.with_variant(mysql.MEDIUMTEXT(), 'mysql')
+PAYLOAD_TYPE = LargeBinary()
+PAYLOAD_TYPE = PAYLOAD_TYPE.with_variant(postgresql.BYTEA(), 'postgresql')
+PAYLOAD_TYPE = PAYLOAD_TYPE.with_variant(mysql.LONGBLOB(), 'mysql')
+
+# Chunk payloads are stored once per unique content, in the "payloads" table
+# keyed by their SHA256 hash and with a count of the number of references to
+# them.  The "chunks" table records which chunks each user has uploaded, and
+# references the corresponding payload by its hash.
+#
+# Chunk payloads were originally stored inline in the chunks table, either
+# as base64-encoded text or as raw binary, or in the file store with only
+# their hash in the chunks table.  Such legacy rows have a non-NULL value
+# in the "payload_encoding" column, and do not hold a reference to any row
+# in the payloads table.  They can be moved into the payloads table in the
+# background; see the docs in mentatsync.scripts.convert_payloads for details.
+#
+# Payloads may be stored compressed, in which case "payload_encoding" names
+# the compression codec.  The hash is always that of the uncompressed data.
+#
+# If the payload in the payloads table is NULL, then it is stored outside
+# the database, in a content-addressed file store under its hash.
+#
+# Chunks and pending branches record when they were last written to, as
+# integer seconds since the epoch, so that the garbage collector can tell
+# which ones have been abandoned; see mentatsync.scripts.gc for details.
+# Rows that predate these columns have them set to NULL.
+
+PAYLOAD_ENCODING_IDENTITY = "identity"
+PAYLOAD_ENCODING_BASE64 = "base64"
+PAYLOAD_ENCODING_GZIP = "gzip"
 
 chunks = Table(
     "chunks",
     metadata,
     Column("userid", UUID(), primary_key=True, nullable=False),
     Column("chunk", String(64), primary_key=True, nullable=False),
-    Column("payload", PAYLOAD_TYPE, nullable=False),
+    Column("payload_hash", String(64), nullable=True),
+    Column("payload", PAYLOAD_TYPE, nullable=True),
+    Column("payload_encoding", String(16), nullable=True),
+    Column("created", Integer, nullable=True),
+)
+
+
+payloads = Table(
+    "payloads",
+    metadata,
+    Column("hash", String(64), primary_key=True, nullable=False),
+    Column("payload", PAYLOAD_TYPE, nullable=True),
+    Column("payload_encoding", String(16), nullable=False),
+    Column("refcount", Integer, nullable=False),
 )
 
 
@@ -231,9 +343,16 @@ class DBConnector(object):
 
         # Create the tables if necessary.
         if create_tables:
+            user_stores.create(self.engine, checkfirst=True)
+            dead_stores.create(self.engine, checkfirst=True)
+            heads.create(self.engine, checkfirst=True)
             transactions.create(self.engine, checkfirst=True)
+            branches.create(self.engine, checkfirst=True)
             transaction_chunks.create(self.engine, checkfirst=True)
+            snapshots.create(self.engine, checkfirst=True)
+            snapshot_chunks.create(self.engine, checkfirst=True)
             chunks.create(self.engine, checkfirst=True)
+            payloads.create(self.engine, checkfirst=True)
 
         # Load the pre-built queries to use with this database backend.
         # Currently we have a generic set of queries, and some queries specific
@@ -255,6 +374,14 @@ class DBConnector(object):
         self._render_query_dialect = copy.copy(self.engine.dialect)
         self._render_query_dialect.paramstyle = "named"
 
+        # Queries are sent to the database as plain text, so the bindparams
+        # don't carry any type information.  Binary data must be explicitly
+        # converted to and from the form expected by the database driver.
+        binary_type = PAYLOAD_TYPE.dialect_impl(self.engine.dialect)
+        self._binary_bind = binary_type.bind_processor(self.engine.dialect)
+        self._binary_result = binary_type.result_processor(
+            self.engine.dialect, None)
+
         # PyMySQL Connection objects hold a reference to their most recent
         # Result object, which can cause large datasets to remain in memory.
         # Explicitly clear it when returning a connection to the pool.
@@ -271,6 +398,18 @@ class DBConnector(object):
         """Create a new DBConnection object from this connector."""
         return DBConnection(self)
 
+    def to_binary_param(self, value):
+        """Convert a bytestring into a bindparam value for a binary column."""
+        if self._binary_bind is None:
+            return value
+        return self._binary_bind(value)
+
+    def from_binary_result(self, value):
+        """Convert a value read from a binary column into a bytestring."""
+        if self._binary_result is None:
+            return value
+        return self._binary_result(value)
+
     def get_query(self, name, params):
         """Get the named pre-built query."""
         # Get the pre-built query with that name.
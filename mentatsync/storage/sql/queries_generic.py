@@ -10,104 +10,707 @@ query object.
 
 """
 
-from mentatsync.storage import ROOT_TRANSACTION
+from sqlalchemy.sql import (select, insert, update, table, column,
+                            bindparam, func, case)
 
 
+# Lightweight table definitions for use in constructing dynamic queries.
+# We can't import the real ones from dbconnect without a circular import.
+
+_user_stores = table(
+    "user_stores",
+    column("userid"),
+    column("storeid"),
+)
+
+_chunks = table(
+    "chunks",
+    column("userid"),
+    column("chunk"),
+    column("payload_hash"),
+    column("payload"),
+    column("payload_encoding"),
+    column("created"),
+)
+
+_payloads = table(
+    "payloads",
+    column("hash"),
+    column("payload"),
+    column("payload_encoding"),
+    column("refcount"),
+)
+
+_transactions = table(
+    "transactions",
+    column("userid"),
+    column("trnid"),
+)
+
+_branches = table(
+    "branches",
+    column("userid"),
+    column("branch"),
+)
+
+_transaction_chunks = table(
+    "transaction_chunks",
+    column("userid"),
+    column("trnid"),
+    column("idx"),
+    column("chunk"),
+)
+
+_snapshot_chunks = table(
+    "snapshot_chunks",
+    column("userid"),
+    column("trnid"),
+    column("idx"),
+    column("chunk"),
+)
+
+
+# Pending transactions are grouped into "branches", each of which is a linear
+# chain of transactions descending from some committed base transaction.
+# A transaction is committed iff the branch it belongs to is committed, so
+# that committing a whole chain of transactions touches only a single row.
+
+# All the other tables are keyed by the id of the user's current store,
+# which is looked up here.  Resetting a user switches them to a new store
+# using compare-and-swap, and marks the old one as dead.
+#
+# Queries on the hot read paths look up the store inline, so that they
+# don't need a separate round-trip to the database.  They can also be given
+# a store id in place of the userid, since store ids are freshly generated
+# and so never appear as a userid in the user_stores table.
+
+_current_storeid = """COALESCE((
+        SELECT storeid FROM user_stores WHERE user_stores.userid = :userid
+    ), :userid)"""
+
+
+def _current_storeid_expr():
+    """Build an SQLAlchemy expression for the id of the user's store."""
+    return func.coalesce(
+        select([_user_stores.c.storeid]).where(
+            _user_stores.c.userid == bindparam("userid")
+        ).as_scalar(),
+        bindparam("userid")
+    )
+
+
+GET_USER_STORE = """
+    SELECT storeid
+    FROM user_stores
+    WHERE userid = :userid
+"""
+
+CREATE_USER_STORE = """
+    INSERT INTO user_stores (userid, storeid)
+    VALUES (:userid, :storeid)
+"""
+
+UPDATE_USER_STORE = """
+    UPDATE user_stores
+    SET storeid = :storeid
+    WHERE userid = :userid AND storeid = :prev_storeid
+"""
+
+CREATE_DEAD_STORE = """
+    INSERT INTO dead_stores (storeid, deleted_at)
+    VALUES (:prev_storeid, :now)
+"""
+
 GET_HEAD = """
     SELECT trnid
-    FROM transactions
+    FROM heads
+    WHERE userid = %s
+""" % (_current_storeid,)
+
+# The head is advanced using compare-and-swap on the current value, to
+# detect concurrent commits.  If the user has no head row then the head
+# is the root transaction, and we must create the row instead.
+
+CREATE_HEAD = """
+    INSERT INTO heads (userid, trnid, seq)
+    VALUES (:userid, :trnid, :seq)
+"""
+
+UPDATE_HEAD = """
+    UPDATE heads
+    SET trnid = :trnid, seq = :seq
+    WHERE userid = :userid AND trnid = :prev_head
+"""
+
+DELETE_HEAD = """
+    DELETE FROM heads
     WHERE userid = :userid
-    AND committed
-    ORDER BY seq DESC LIMIT 1
 """
 
-GET_TRANSACTIONS = """
+# Listings are keyed on seq rather than on trnid, so that each page
+# can be fetched with a single range scan over the trn_usr_seq index.
+
+GET_TRANSACTION_SEQ = """
+    SELECT t.seq
+    FROM transactions AS t
+    INNER JOIN branches AS b
+    ON b.userid = t.userid AND b.branch = t.branch
+    WHERE t.userid = %s AND t.trnid = :trnid
+    AND b.committed
+""" % (_current_storeid,)
+
+GET_TRANSACTIONS_AFTER = """
+    SELECT t.trnid, t.seq
+    FROM transactions AS t
+    INNER JOIN branches AS b
+    ON b.userid = t.userid AND b.branch = t.branch
+    WHERE t.userid = %s
+    AND t.seq > :seq
+    AND b.committed
+    ORDER BY t.seq ASC
+    LIMIT :limit
+""" % (_current_storeid,)
+
+# This fetches a page of transactions along with their chunk lists in a
+# single query.  The inner select picks out the page of transactions, so
+# that the limit applies to transactions rather than to individual chunks.
+
+GET_TRANSACTIONS_WITH_CHUNKS_AFTER = """
+    SELECT t.trnid, t.parent, t.seq, tc.chunk
+    FROM (
+        SELECT t.userid, t.trnid, t.parent, t.seq
+        FROM transactions AS t
+        INNER JOIN branches AS b
+        ON b.userid = t.userid AND b.branch = t.branch
+        WHERE t.userid = %s
+        AND t.seq > :seq
+        AND b.committed
+        ORDER BY t.seq ASC
+        LIMIT :limit
+    ) AS t
+    LEFT OUTER JOIN transaction_chunks AS tc
+    ON tc.userid = t.userid AND tc.trnid = t.trnid
+    ORDER BY t.seq ASC, tc.idx ASC
+""" % (_current_storeid,)
+
+GET_TRANSACTION = """
+    SELECT t.trnid, t.parent, t.seq, b.committed
+    FROM transactions AS t
+    INNER JOIN branches AS b
+    ON b.userid = t.userid AND b.branch = t.branch
+    WHERE t.userid = %s AND t.trnid = :trnid
+""" % (_current_storeid,)
+
+GET_TRANSACTION_CHUNKS = """
+    SELECT chunk
+    FROM transaction_chunks
+    WHERE userid = %s AND trnid = :trnid
+    ORDER BY idx
+""" % (_current_storeid,)
+
+GET_TRANSACTION_BRANCH = """
+    SELECT t.seq, t.branch, b.base, b.tip, b.committed
+    FROM transactions AS t
+    INNER JOIN branches AS b
+    ON b.userid = t.userid AND b.branch = t.branch
+    WHERE t.userid = :userid AND t.trnid = :trnid
+"""
+
+CREATE_TRANSACTION = """
+    INSERT INTO transactions (userid, trnid, parent, seq, branch)
+    VALUES (:userid, :trnid, :parent, :seq, :branch)
+"""
+
+CREATE_PENDING_BRANCH = """
+    INSERT INTO branches (userid, branch, base, tip, committed, last_modified)
+    VALUES (:userid, :branch, :base, :branch, 0, :now)
+"""
+
+# A pending branch can only be extended from its current tip, so that
+# each branch remains a linear chain of transactions.
+
+EXTEND_PENDING_BRANCH = """
+    UPDATE branches
+    SET tip = :trnid, last_modified = :now
+    WHERE userid = :userid AND branch = :branch
+    AND tip = :parent
+    AND NOT committed
+"""
+
+# A pending branch can only be committed from its tip.  This must be done
+# in the same transaction as advancing the head to that tip.
+
+COMMIT_PENDING_BRANCH = """
+    UPDATE branches
+    SET committed = 1
+    WHERE userid = :userid AND branch = :branch
+    AND tip = :trnid
+    AND NOT committed
+"""
+
+# Each store has at most one snapshot, which can only be replaced by a
+# newer one using compare-and-swap on its seq.  The chunk lists of snapshots
+# are keyed by trnid, so that a replacement can be written without touching
+# the list of the snapshot it replaces.
+
+GET_SNAPSHOT = """
+    SELECT trnid, seq
+    FROM snapshots
+    WHERE userid = %s
+""" % (_current_storeid,)
+
+GET_SNAPSHOT_CHUNKS = """
+    SELECT chunk
+    FROM snapshot_chunks
+    WHERE userid = %s AND trnid = :trnid
+    ORDER BY idx
+""" % (_current_storeid,)
+
+CREATE_SNAPSHOT = """
+    INSERT INTO snapshots (userid, trnid, seq, pruned_seq)
+    VALUES (:userid, :trnid, :seq, 0)
+"""
+
+UPDATE_SNAPSHOT = """
+    UPDATE snapshots
+    SET trnid = :trnid, seq = :seq
+    WHERE userid = :userid AND seq = :prev_seq
+"""
+
+DELETE_SNAPSHOT = """
+    DELETE FROM snapshots
+    WHERE userid = :userid
+"""
+
+# Chunk payloads may be stored inline in the chunks table for legacy rows,
+# or in the payloads table for everything else.  These queries find them
+# in whichever place they happen to be, using the chunk's payload_encoding
+# column to tell the two apart.
+
+GET_CHUNK_PAYLOAD = """
+    SELECT c.payload_hash,
+        CASE WHEN c.payload_encoding IS NULL
+            THEN p.payload
+            ELSE c.payload
+        END AS payload,
+        CASE WHEN c.payload_encoding IS NULL
+            THEN p.payload_encoding
+            ELSE c.payload_encoding
+        END AS payload_encoding
+    FROM chunks AS c
+    LEFT OUTER JOIN payloads AS p
+    ON p.hash = c.payload_hash
+    WHERE c.userid = %s AND c.chunk = :chunk
+""" % (_current_storeid,)
+
+
+def GET_CHUNK_PAYLOADS(params):
+    """Get the payloads for a list of chunks, using a single IN query."""
+    c = _chunks.alias("c")
+    p = _payloads.alias("p")
+    return select([
+        c.c.chunk,
+        c.c.payload_hash,
+        case(
+            [(c.c.payload_encoding.is_(None), p.c.payload)],
+            else_=c.c.payload
+        ).label("payload"),
+        case(
+            [(c.c.payload_encoding.is_(None), p.c.payload_encoding)],
+            else_=c.c.payload_encoding
+        ).label("payload_encoding"),
+    ]).select_from(
+        c.outerjoin(p, p.c.hash == c.c.payload_hash)
+    ).where(
+        (c.c.userid == _current_storeid_expr()) &
+        (c.c.chunk.in_(params["chunks"]))
+    )
+
+
+def GET_CHUNK_IDS(params):
+    """Find which of a list of chunks exist, using a single IN query."""
+    return select([_chunks.c.chunk]).where(
+        (_chunks.c.userid == bindparam("userid")) &
+        (_chunks.c.chunk.in_(params["chunks"]))
+    )
+
+
+def TOUCH_CHUNKS(params):
+    """Refresh the upload time of a list of chunks, using a single UPDATE."""
+    return update(_chunks).where(
+        (_chunks.c.userid == bindparam("userid")) &
+        (_chunks.c.chunk.in_(params["chunks"]))
+    ).values(
+        created=bindparam("now")
+    )
+
+
+def ADD_CHUNKS(params):
+    """Add references to a list of chunk payloads, using a multi-row INSERT.
+
+    The chunks must not already exist.
+    """
+    return insert(_chunks).values([{
+        "userid": params["userid"],
+        "chunk": chunk,
+        "payload_hash": payload_hash,
+        "created": params["now"],
+    } for chunk, payload_hash in params["chunks"]])
+
+
+def GET_PAYLOAD_HASHES(params):
+    """Find which of a list of payloads exist, using a single IN query."""
+    return select([_payloads.c.hash]).where(
+        _payloads.c.hash.in_(params["hashes"])
+    )
+
+
+def INSERT_PAYLOADS(params):
+    """Insert a list of new payloads, using a multi-row INSERT.
+
+    Dialect-specific versions of this query will silently ignore payloads
+    that already exist, which can happen if there are concurrent uploads
+    of the same content.  The generic version will raise IntegrityError.
+    """
+    return insert(_payloads).values(params["payloads"])
+
+
+def INCREMENT_PAYLOAD_REFCOUNTS(params):
+    """Add params["count"] to the refcount of each of a list of payloads."""
+    return update(_payloads).where(
+        _payloads.c.hash.in_(params["hashes"])
+    ).values(
+        refcount=_payloads.c.refcount + bindparam("count")
+    )
+
+
+def DECREMENT_PAYLOAD_REFCOUNTS(params):
+    """Subtract params["count"] from the refcount of a list of payloads."""
+    return update(_payloads).where(
+        _payloads.c.hash.in_(params["hashes"])
+    ).values(
+        refcount=_payloads.c.refcount - bindparam("count")
+    )
+
+# These are used to move legacy inline payloads into the payloads table,
+# walking the table in primary key order a small batch at a time.
+
+GET_LEGACY_CHUNKS = """
+    SELECT userid, chunk, payload, payload_encoding, payload_hash
+    FROM chunks
+    WHERE userid >= :userid
+    AND (userid > :userid OR chunk > :chunk)
+    AND payload_encoding IS NOT NULL
+    ORDER BY userid, chunk
+    LIMIT :limit
+"""
+
+CONVERT_LEGACY_CHUNK = """
+    UPDATE chunks
+    SET payload = NULL,
+        payload_encoding = NULL,
+        payload_hash = :payload_hash
+    WHERE userid = :userid AND chunk = :chunk
+    AND payload_encoding IS NOT NULL
+"""
+
+# Garbage collection walks each table in primary key order a small batch at
+# a time, so that each query is a short range scan that holds its locks only
+# briefly.  The candidates are filtered in python or by the query itself,
+# and then each deletion re-checks the conditions in case something changed
+# in the meantime.
+# Anything written to more recently than :cutoff is left alone, since it
+# may belong to a client that's part-way through a sync.
+
+GET_GC_BRANCHES = """
+    SELECT userid, branch, tip, committed, last_modified
+    FROM branches
+    WHERE userid >= :userid
+    AND (userid > :userid OR branch > :branch)
+    ORDER BY userid, branch
+    LIMIT :limit
+"""
+
+# A stale branch may have too many transactions to delete at once.  So it's
+# first killed by setting its tip to the empty string, which is never the id
+# of a transaction, so that it can no longer be extended or committed.  Its
+# transactions are then deleted a batch at a time, and finally the branch.
+
+KILL_STALE_BRANCH = """
+    UPDATE branches
+    SET tip = ''
+    WHERE userid = :userid AND branch = :branch
+    AND NOT committed
+    AND (last_modified IS NULL OR last_modified < :cutoff)
+"""
+
+GET_BRANCH_TRANSACTIONS = """
     SELECT trnid
     FROM transactions
-    WHERE userid = :userid
-    AND seq >= (
-        SELECT seq FROM transactions WHERE userid = :userid and trnid = :from
+    WHERE userid = :userid AND branch = :branch
+    ORDER BY trnid
+    LIMIT :limit
+"""
+
+DELETE_KILLED_BRANCH = """
+    DELETE FROM branches
+    WHERE userid = :userid AND branch = :branch
+    AND tip = ''
+"""
+
+# Only old chunks that nothing refers to are selected, using the indexes on
+# the chunk columns of transaction_chunks and snapshot_chunks, so that each
+# batch is made up entirely of chunks that can be deleted.
+
+GET_GC_CHUNKS = """
+    SELECT c.userid, c.chunk, c.payload_hash, c.payload_encoding
+    FROM chunks AS c
+    WHERE c.userid >= :userid
+    AND (c.userid > :userid OR c.chunk > :chunk)
+    AND (c.created IS NULL OR c.created < :cutoff)
+    AND NOT EXISTS (
+        SELECT 1 FROM transaction_chunks AS tc
+        WHERE tc.userid = c.userid AND tc.chunk = c.chunk
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM snapshot_chunks AS sc
+        WHERE sc.userid = c.userid AND sc.chunk = c.chunk
+    )
+    ORDER BY c.userid, c.chunk
+    LIMIT :limit
+"""
+
+DELETE_UNREFERENCED_CHUNK = """
+    DELETE FROM chunks
+    WHERE userid = :userid AND chunk = :chunk
+    AND (created IS NULL OR created < :cutoff)
+    AND NOT EXISTS (
+        SELECT 1 FROM transaction_chunks
+        WHERE transaction_chunks.userid = :userid
+        AND transaction_chunks.chunk = :chunk
     )
-    AND committed
-    ORDER BY seq ASC
+    AND NOT EXISTS (
+        SELECT 1 FROM snapshot_chunks
+        WHERE snapshot_chunks.userid = :userid
+        AND snapshot_chunks.chunk = :chunk
+    )
+"""
+
+# History made redundant by a snapshot is pruned one store at a time, oldest
+# transactions first, so that whatever remains is always a contiguous run of
+# seqs leading up to the snapshot.  Once done, the store is marked as pruned
+# up to the snapshot's seq so that it's skipped until the next snapshot.
+
+GET_GC_SNAPSHOT = """
+    SELECT userid, trnid, seq
+    FROM snapshots
+    WHERE userid >= :userid
+    AND pruned_seq < seq
+    ORDER BY userid
+    LIMIT 1
+"""
+
+GET_OLD_SNAPSHOT_CHUNKS = """
+    SELECT trnid, idx
+    FROM snapshot_chunks
+    WHERE userid = :userid AND trnid <> :trnid
+    ORDER BY trnid, idx
     LIMIT :limit
 """
 
-GET_TRANSACTIONS_FROM_ROOT = """
+DELETE_OLD_SNAPSHOT_CHUNKS = """
+    DELETE FROM snapshot_chunks
+    WHERE userid = :userid AND trnid = :trnid
+    AND idx <= :idx
+"""
+
+GET_PRUNABLE_TRANSACTIONS = """
     SELECT trnid
     FROM transactions
     WHERE userid = :userid
-    AND committed
-    ORDER BY seq ASC
+    AND seq < :seq
+    ORDER BY seq
     LIMIT :limit
 """
 
-DELETE_ALL_TRANSACTIONS = """
-    DELETE FROM transactions
+GET_PRUNABLE_BRANCHES = """
+    SELECT b.branch
+    FROM branches AS b
+    WHERE b.userid = :userid
+    AND b.tip <> ''
+    AND NOT EXISTS (
+        SELECT 1 FROM transactions AS t
+        WHERE t.userid = b.userid AND t.trnid = b.tip
+    )
+    LIMIT :limit
+"""
+
+MARK_SNAPSHOT_PRUNED = """
+    UPDATE snapshots
+    SET pruned_seq = seq
+    WHERE userid = :userid AND seq = :seq
+"""
+
+# Dead stores are purged one small batch at a time, working through the
+# chunks, then the transactions, then the branches, and finally the head.
+
+GET_DEAD_STORE = """
+    SELECT storeid
+    FROM dead_stores
+    WHERE storeid >= :storeid
+    AND deleted_at < :cutoff
+    ORDER BY storeid
+    LIMIT 1
+"""
+
+DELETE_DEAD_STORE = """
+    DELETE FROM dead_stores
+    WHERE storeid = :storeid
+"""
+
+GET_STORE_CHUNKS = """
+    SELECT chunk, payload_hash, payload_encoding
+    FROM chunks
     WHERE userid = :userid
+    ORDER BY chunk
+    LIMIT :limit
 """
 
-GET_TRANSACTION = """
-    SELECT trnid, parent, seq
+DELETE_STORE_CHUNK = """
+    DELETE FROM chunks
+    WHERE userid = :userid AND chunk = :chunk
+"""
+
+GET_STORE_TRANSACTIONS = """
+    SELECT trnid
     FROM transactions
-    WHERE userid = :userid AND trnid = :trnid
+    WHERE userid = :userid
+    ORDER BY trnid
+    LIMIT :limit
 """
 
-GET_TRANSACTION_CHUNKS = """
-    SELECT chunk
+GET_STORE_TRANSACTION_CHUNKS = """
+    SELECT trnid
     FROM transaction_chunks
-    WHERE userid = :userid AND trnid = :trnid
-    ORDER BY idx
+    WHERE userid = :userid
+    ORDER BY trnid, idx
+    LIMIT 1
 """
 
-CREATE_PENDING_TRANSACTION_FROM_ROOT = """
-    INSERT INTO transactions
-        (userid, trnid, parent, committed, seq, prev_head, next_head)
-    VALUES (:userid, :trnid, '{}', 0, 1, '{}', :trnid)
-""".format(ROOT_TRANSACTION, ROOT_TRANSACTION)
-
-CREATE_PENDING_TRANSACTION = """
-    INSERT INTO transactions
-        (userid, trnid, parent, committed, seq, next_head, prev_head)
-    SELECT :userid, :trnid, tprev.trnid, 0, tprev.seq + 1, :trnid,
-        CASE WHEN committed THEN :parent ELSE tprev.prev_head END AS cur_head
-    FROM transactions AS tprev
-    WHERE tprev.userid = :userid AND tprev.trnid = :parent
-    AND tprev.next_head = :parent
-"""
+# Chunk lists can be arbitrarily long, so they're deleted a range of idx
+# values at a time, so that no single statement deletes too many rows.
 
-BUMP_PENDING_TRANSACTION_ANCESTORS = """
-    UPDATE transactions
-    SET next_head = :trnid
-    WHERE userid = :userid AND next_head = :parent
+DELETE_TRANSACTION_CHUNKS_UPTO = """
+    DELETE FROM transaction_chunks
+    WHERE userid = :userid AND trnid = :trnid
+    AND idx <= :idx
 """
 
-COMMIT_PENDING_TRANSACTION = """
-    UPDATE transactions
-    SET committed = 1
+GET_STORE_BRANCHES = """
+    SELECT branch
+    FROM branches
     WHERE userid = :userid
-    AND next_head = :trnid
-    AND prev_head = COALESCE((
-        SELECT trnid FROM (
-            SELECT trnid FROM transactions
-            WHERE userid = :userid AND committed
-            ORDER BY seq DESC LIMIT 1
-        ) as current_head
-    ), '{}')
-""".format(ROOT_TRANSACTION)
-
-ADD_TRANSACTION_CHUNK = """
-    INSERT INTO transaction_chunks (userid, trnid, idx, chunk)
-    SELECT :userid, :trnid, :idx, c.chunk
-    FROM chunks AS c
-    WHERE c.userid = :userid AND c.chunk = :chunk
+    ORDER BY branch
+    LIMIT :limit
 """
 
-GET_CHUNK_PAYLOAD = """
-    SELECT payload FROM chunks WHERE userid = :userid AND chunk = :chunk
+GET_GC_PAYLOADS = """
+    SELECT hash, payload_encoding, refcount,
+        CASE WHEN payload IS NULL THEN 1 ELSE 0 END AS in_filestore
+    FROM payloads
+    WHERE hash > :hash
+    ORDER BY hash
+    LIMIT :limit
 """
 
-CREATE_CHUNK = """
-    INSERT INTO chunks (userid, chunk, payload)
-    VALUES (:userid, :chunk, :payload)
+
+# Legacy chunks may refer to a file in the filestore directly, rather than
+# through a payload row, so files can't be swept until they're converted.
+
+GET_LEGACY_FILESTORE_CHUNK = """
+    SELECT userid, chunk
+    FROM chunks
+    WHERE payload IS NULL
+    AND payload_encoding IS NOT NULL
+    LIMIT 1
 """
+
+
+def GET_FILESTORE_PAYLOADS(params):
+    """Find which of a list of payloads are kept in the filestore."""
+    return select([_payloads.c.hash, _payloads.c.payload_encoding]).where(
+        (_payloads.c.hash.in_(params["hashes"])) &
+        (_payloads.c.payload.is_(None))
+    )
+
+
+def DELETE_UNREFERENCED_PAYLOADS(params):
+    """Delete any of a list of payloads that have no references."""
+    return _payloads.delete().where(
+        (_payloads.c.hash.in_(params["hashes"])) &
+        (_payloads.c.refcount == 0)
+    )
+
+
+def DELETE_STORE_TRANSACTIONS(params):
+    """Delete a list of transactions, using a single IN query."""
+    return _transactions.delete().where(
+        (_transactions.c.userid == bindparam("userid")) &
+        (_transactions.c.trnid.in_(params["trnids"]))
+    )
+
+
+def GET_TRANSACTION_CHUNK_COUNTS(params):
+    """Find the size of the chunk lists of a list of transactions."""
+    return select([
+        _transaction_chunks.c.trnid,
+        func.count().label("num_chunks"),
+        func.max(_transaction_chunks.c.idx).label("max_idx"),
+    ]).where(
+        (_transaction_chunks.c.userid == bindparam("userid")) &
+        (_transaction_chunks.c.trnid.in_(params["trnids"]))
+    ).group_by(_transaction_chunks.c.trnid)
+
+
+def DELETE_STORE_BRANCHES(params):
+    """Delete a list of branches, using a single IN query."""
+    return _branches.delete().where(
+        (_branches.c.userid == bindparam("userid")) &
+        (_branches.c.branch.in_(params["branches"]))
+    )
+
+
+def LOCK_CHUNKS(params):
+    """Find which of a list of chunks exist, locking them against deletion.
+
+    This takes a shared lock on each chunk found, so that the garbage
+    collector can't delete them until the current transaction is over.
+    SQLite doesn't support this, but only allows one writer at a time.
+    """
+    return GET_CHUNK_IDS(params).with_for_update(read=True)
+
+
+def ADD_TRANSACTION_CHUNKS(params):
+    """Link a list of chunks into a transaction, using a multi-row INSERT.
+
+    The chunks are numbered consecutively starting from params["idx"].
+    """
+    return insert(_transaction_chunks).values(_chunk_list_rows(params))
+
+
+def ADD_SNAPSHOT_CHUNKS(params):
+    """Link a list of chunks into a snapshot, using a multi-row INSERT.
+
+    The chunks are numbered consecutively starting from params["idx"].
+    """
+    return insert(_snapshot_chunks).values(_chunk_list_rows(params))
+
+
+def _chunk_list_rows(params):
+    """Build the rows for inserting part of a numbered list of chunks."""
+    return [{
+        "userid": params["userid"],
+        "trnid": params["trnid"],
+        "idx": params["idx"] + i,
+        "chunk": chunk,
+    } for i, chunk in enumerate(params["chunks"])]
@@ -8,13 +8,9 @@ This module overrides some queries from queries_generic.py with code
 tailored to MySQL.
 """
 
-# We can use mysql's multi-table delete to transitively
-# remove chunk data when clearing a user's transactions.
+from mentatsync.storage.sql.queries_generic import _payloads
 
-DELETE_ALL_TRANSACTIONS = """
-    DELETE transactions, transaction_chunks, chunks
-    FROM transactions
-      INNER JOIN transaction_chunks USING (userid, trnid)
-      INNER JOIN chunks USING (userid)
-    WHERE transactions.userid = :userid
-"""
+
+def INSERT_PAYLOADS(params):
+    """Insert a list of new payloads, ignoring any that already exist."""
+    return _payloads.insert().values(params["payloads"]).prefix_with("IGNORE")
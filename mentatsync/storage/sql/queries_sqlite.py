@@ -7,3 +7,12 @@ Custom queries for SQLite.
 This module overrides some queries from queries_generic.py with code
 tailored to SQLite.
 """
+
+from mentatsync.storage.sql.queries_generic import _payloads
+
+
+def INSERT_PAYLOADS(params):
+    """Insert a list of new payloads, ignoring any that already exist."""
+    return _payloads.insert().values(params["payloads"]).prefix_with(
+        "OR IGNORE"
+    )
@@ -2,13 +2,34 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import sys
+import zlib
+import time
 import uuid
+import base64
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
 import random
 import string
 
+import webob
+import unittest2
+
 from mozsvc.tests.support import FunctionalTestCase
 
+from mentatsync.notify import BrokerNotifier, LocalBroker
+from mentatsync.storage import (TransactionNotFoundError, ChunkNotFoundError,
+                                ConflictError)
+from mentatsync.storage.sharded import ShardedStorage
+from mentatsync.storage.sql import SQLStorage
+from mentatsync.storage.sql.dbconnect import DBConnector
+from mentatsync.scripts.convert_payloads import convert_payloads
+from mentatsync.scripts.gc import collect_garbage
+from mentatsync.scripts.migrate_schema import migrate_schema
 from mentatsync.tests.functional.support import run_live_functional_tests
 
 
@@ -25,6 +46,16 @@ def randid():
     return str(uuid.uuid4())
 
 
+def parse_chunk_records(body):
+    records = []
+    while body:
+        header, body = body.split("\n", 1)
+        chunk, size = header.split(" ")
+        records.append((chunk, body[:int(size)]))
+        body = body[int(size):]
+    return records
+
+
 class TestAPI(FunctionalTestCase):
 
     def setUp(self):
@@ -37,6 +68,26 @@ class TestAPI(FunctionalTestCase):
         config.include("mentatsync")
         return config
 
+    def get_user_storage(self, userid=None):
+        """Get the innermost storage backend holding a user's data."""
+        if userid is None:
+            userid = self.userid
+        storage = self.config.registry["mentatsync:storage:default"]
+        while True:
+            if hasattr(storage, "storage"):
+                storage = storage.storage
+            elif hasattr(storage, "get_shard"):
+                storage = storage.get_shard(userid)
+            else:
+                return storage
+
+    def get_sql_storage(self, userid=None):
+        """Get the SQLStorage backend holding a user's data, or skip."""
+        storage = self.get_user_storage(userid)
+        if not hasattr(storage, "dbconnector"):
+            raise unittest2.SkipTest("requires an SQL storage backend")
+        return storage
+
     def test_basic_creation_of_new_transactions(self):
         # Initially, head is the empty root transaction.
         resp = self.app.get(self.root + "/head")
@@ -162,6 +213,1018 @@ class TestAPI(FunctionalTestCase):
         resp = self.app.get(self.root + "/head")
         self.assertEqual(resp.json["head"], trn4)
 
+    def test_listing_transactions_with_chunks(self):
+        self.app.put(self.root + "/chunks/aaaaaaaa", "aaaa", status=201)
+        self.app.put(self.root + "/chunks/bbbbbbbb", "bbbb", status=201)
+        trn1 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn1, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": ["bbbbbbbb", "aaaaaaaa"],
+        })
+        trn2 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn2, {
+            "parent": trn1,
+            "chunks": [],
+        })
+        trn3 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn3, {
+            "parent": trn2,
+            "chunks": ["aaaaaaaa"],
+        })
+        self.app.put_json(self.root + "/head", {
+            "head": trn3,
+        }, status=204)
+
+        # We can fetch all transactions and their chunks in one request.
+        resp = self.app.get(self.root + "/transactions?include=chunks")
+        self.assertEqual(resp.json["transactions"], [{
+            "id": trn1,
+            "seq": 1,
+            "parent": ROOT_TRANSACTION,
+            "chunks": ["bbbbbbbb", "aaaaaaaa"],
+        }, {
+            "id": trn2,
+            "seq": 2,
+            "parent": trn1,
+            "chunks": [],
+        }, {
+            "id": trn3,
+            "seq": 3,
+            "parent": trn2,
+            "chunks": ["aaaaaaaa"],
+        }])
+
+        # The limit applies to transactions, not to chunks.
+        resp = self.app.get(self.root + "/transactions?include=chunks&limit=1")
+        self.assertEqual([t["id"] for t in resp.json["transactions"]], [trn1])
+
+        # And it works from an intermediate transaction.
+        url = "/transactions?include=chunks&from=" + trn1
+        resp = self.app.get(self.root + url)
+        self.assertEqual([t["id"] for t in resp.json["transactions"]],
+                         [trn2, trn3])
+
+        # Unknown values for include are rejected.
+        self.app.get(self.root + "/transactions?include=bogus", status=400)
+
+    def test_paginating_transactions_with_cursors(self):
+        trns = []
+        parent = ROOT_TRANSACTION
+        for i in xrange(5):
+            trn = randid()
+            self.app.put_json(self.root + "/transactions/" + trn, {
+                "parent": parent,
+                "chunks": [],
+            })
+            trns.append(trn)
+            parent = trn
+        self.app.put_json(self.root + "/head", {"head": parent}, status=204)
+
+        # We can page through the transactions by following cursors.
+        for include in ("", "&include=chunks"):
+            pages = []
+            url = self.root + "/transactions?limit=2" + include
+            resp = self.app.get(url)
+            pages.append(resp.json["transactions"])
+            while resp.json["next"] is not None:
+                resp = self.app.get(url + "&cursor=" + resp.json["next"])
+                pages.append(resp.json["transactions"])
+            if include:
+                pages = [[t["id"] for t in page] for page in pages]
+            self.assertEqual(pages, [trns[0:2], trns[2:4], trns[4:]])
+
+        # Starting from a given transaction works too.
+        resp = self.app.get(self.root + "/transactions?limit=3&from=" +
+                            trns[0])
+        self.assertEqual(resp.json["transactions"], trns[1:4])
+        resp = self.app.get(self.root + "/transactions?cursor=" +
+                            resp.json["next"])
+        self.assertEqual(resp.json["transactions"], trns[4:])
+        self.assertEqual(resp.json["next"], None)
+
+        # The page size is capped by the server.
+        if not self.distant:
+            settings = self.config.registry.settings
+            settings["mentatsync.max_transactions_limit"] = 4
+            try:
+                resp = self.app.get(self.root + "/transactions?limit=1000")
+                self.assertEqual(resp.json["limit"], 4)
+                self.assertEqual(resp.json["transactions"], trns[:4])
+            finally:
+                del settings["mentatsync.max_transactions_limit"]
+
+        # Bad cursors and limits are rejected, as are unknown transactions.
+        self.app.get(self.root + "/transactions?cursor=bogus", status=400)
+        self.app.get(self.root + "/transactions?limit=0", status=400)
+        self.app.get(self.root + "/transactions?limit=x", status=400)
+        self.app.get(self.root + "/transactions?from=" + randid(), status=404)
+
+    def test_listing_a_large_page_of_transactions(self):
+        trns = [randid() for i in xrange(500)]
+        parents = [ROOT_TRANSACTION] + trns[:-1]
+        self.app.post_json(self.root + "/push", {
+            "chunks": {"aaaaaaaa": base64.b64encode("chunky")},
+            "transactions": [{
+                "id": trn,
+                "parent": parent,
+                "chunks": ["aaaaaaaa"],
+            } for trn, parent in zip(trns, parents)],
+            "head": trns[-1],
+        }, status=201)
+        resp = self.app.get(self.root + "/transactions?limit=1000")
+        self.assertEqual(resp.content_type, "application/json")
+        self.assertEqual(resp.json["transactions"], trns)
+        self.assertEqual(resp.json["next"], None)
+        resp = self.app.get(self.root + "/transactions?include=chunks&" +
+                            "limit=499")
+        self.assertEqual([t["id"] for t in resp.json["transactions"]],
+                         trns[:499])
+        self.assertEqual(resp.json["transactions"][-1]["chunks"],
+                         ["aaaaaaaa"])
+        self.assertNotEqual(resp.json["next"], None)
+
+    def test_bootstrapping_from_a_snapshot(self):
+        trns = [randid() for i in xrange(4)]
+        parents = [ROOT_TRANSACTION] + trns[:-1]
+        chunks = ["aaaaaaaa", "bbbbbbbb", "cccccccc", "dddddddd"]
+        self.app.post_json(self.root + "/push", {
+            "chunks": dict((chunk, base64.b64encode(chunk))
+                           for chunk in chunks),
+            "transactions": [{
+                "id": trn,
+                "parent": parent,
+                "chunks": [chunk],
+            } for trn, parent, chunk in zip(trns, parents, chunks)],
+            "head": trns[-1],
+        }, status=201)
+
+        # Initially there's no snapshot, so listings include everything.
+        self.app.get(self.root + "/snapshot", status=404)
+        resp = self.app.get(self.root + "/transactions")
+        self.assertEqual(resp.json["snapshot"], None)
+        self.assertEqual(resp.json["transactions"], trns)
+
+        # Snapshots must be of committed transactions, and their chunks
+        # must exist.
+        self.app.put_json(self.root + "/snapshot", {
+            "id": randid(),
+            "chunks": ["bbbbbbbb"],
+        }, status=409)
+        self.app.put_json(self.root + "/snapshot", {
+            "id": trns[2],
+            "chunks": ["eeeeeeee"],
+        }, status=404)
+        self.app.put_json(self.root + "/snapshot", {
+            "id": trns[2],
+            "chunks": ["bbbbbbbb", "cccccccc"],
+        }, status=201)
+        resp = self.app.get(self.root + "/snapshot")
+        self.assertEqual(resp.json, {
+            "id": trns[2],
+            "seq": 3,
+            "chunks": ["bbbbbbbb", "cccccccc"],
+        })
+
+        # Listing from the root now starts at the snapshot.
+        resp = self.app.get(self.root + "/transactions")
+        self.assertEqual(resp.json["snapshot"], {"id": trns[2], "seq": 3})
+        self.assertEqual(resp.json["transactions"], trns[3:])
+        resp = self.app.get(self.root + "/transactions?include=chunks")
+        self.assertEqual(resp.json["snapshot"]["chunks"],
+                         ["bbbbbbbb", "cccccccc"])
+        self.assertEqual([t["id"] for t in resp.json["transactions"]],
+                         trns[3:])
+
+        if not self.distant:
+            storage = self.get_user_storage()
+            if hasattr(storage, "dbconnector"):
+                # Older history can still be listed until it's pruned.
+                url = self.root + "/transactions?from=" + trns[0]
+                resp = self.app.get(url)
+                self.assertEqual(resp.json["snapshot"], None)
+                self.assertEqual(resp.json["transactions"], trns[1:])
+                collect_garbage(storage, sleep_time=0, max_age=-1)
+                # The snapshot keeps its chunks alive, but the pruned
+                # history doesn't.
+                self.assertRaises(ChunkNotFoundError, storage.get_chunk,
+                                  self.userid, "aaaaaaaa")
+            self.app.get(self.root + "/transactions/" + trns[0], status=404)
+            self.app.get(self.root + "/chunks/bbbbbbbb", status=200)
+
+            # Clients whose starting point was pruned must start again
+            # from the snapshot.
+            resp = self.app.get(self.root + "/transactions?from=" + trns[0])
+            self.assertEqual(resp.json["snapshot"], {"id": trns[2], "seq": 3})
+            self.assertEqual(resp.json["transactions"], trns[3:])
+
+        # A snapshot can only be replaced by a newer one.
+        self.app.put_json(self.root + "/snapshot", {
+            "id": trns[1],
+            "chunks": ["bbbbbbbb"],
+        }, status=409)
+        self.app.put_json(self.root + "/snapshot", {
+            "id": trns[3],
+            "chunks": ["bbbbbbbb", "cccccccc", "dddddddd"],
+        }, status=201)
+        resp = self.app.get(self.root + "/transactions")
+        self.assertEqual(resp.json["snapshot"], {"id": trns[3], "seq": 4})
+        self.assertEqual(resp.json["transactions"], [])
+
+    def test_http_caching_headers(self):
+        self.app.put(self.root + "/chunks/aaaaaaaa", "aaa", status=201)
+        trn = randid()
+        self.app.put_json(self.root + "/transactions/" + trn, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": ["aaaaaaaa"],
+        })
+
+        # Chunks are immutable, and can be conditionally fetched.
+        resp = self.app.get(self.root + "/chunks/aaaaaaaa")
+        self.assertTrue("immutable" in resp.headers["Cache-Control"])
+        etag = resp.headers["ETag"]
+        resp = self.app.get(self.root + "/chunks/aaaaaaaa", headers={
+            "If-None-Match": etag,
+        }, status=304)
+        self.assertEqual(resp.body, "")
+
+        # Transactions are only immutable once committed.
+        resp = self.app.get(self.root + "/transactions/" + trn)
+        self.assertEqual(resp.headers["Cache-Control"], "no-cache")
+        etag = resp.headers["ETag"]
+
+        # The head can be checked for changes without fetching it.
+        resp = self.app.get(self.root + "/head")
+        head_etag = resp.headers["ETag"]
+        self.app.get(self.root + "/head", headers={
+            "If-None-Match": head_etag,
+        }, status=304)
+        self.app.put_json(self.root + "/head", {"head": trn}, status=204)
+        resp = self.app.get(self.root + "/head", headers={
+            "If-None-Match": head_etag,
+        }, status=200)
+        self.assertEqual(resp.json["head"], trn)
+        self.assertNotEqual(resp.headers["ETag"], head_etag)
+
+        resp = self.app.get(self.root + "/transactions/" + trn, headers={
+            "If-None-Match": etag,
+        }, status=304)
+        self.assertTrue("immutable" in resp.headers["Cache-Control"])
+
+    def test_watching_for_head_changes(self):
+        # With nothing happening, the watch times out and returns
+        # the unchanged head.
+        resp = self.app.get(self.root + "/head/watch?timeout=0.05",
+                            status=200)
+        self.assertEqual(resp.json["head"], ROOT_TRANSACTION)
+
+        # If the head has already moved on, it returns immediately.
+        trn1 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn1, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": [],
+        })
+        self.app.put_json(self.root + "/head", {"head": trn1}, status=204)
+        resp = self.app.get(self.root + "/head/watch?timeout=10")
+        self.assertEqual(resp.json["head"], trn1)
+
+        # Otherwise it waits until notified of a change.
+        if self.distant:
+            raise unittest2.SkipTest("requires direct notifier access")
+        notifier = self.config.registry["mentatsync:notifier"]
+        trn2 = randid()
+        timer = threading.Timer(0.1, notifier.notify, (self.userid, trn2))
+        timer.start()
+        try:
+            resp = self.app.get(self.root + "/head/watch?timeout=10&head=" +
+                                trn1)
+        finally:
+            timer.cancel()
+        self.assertEqual(resp.json["head"], trn2)
+
+        # Bad timeouts are rejected.
+        self.app.get(self.root + "/head/watch?timeout=x", status=400)
+
+    def test_broker_notifier_fans_out_between_processes(self):
+        channel = randid()
+        notifier1 = BrokerNotifier(LocalBroker(channel))
+        notifier2 = BrokerNotifier("mentatsync.notify.LocalBroker",
+                                   channel=channel)
+        try:
+            with notifier1.watch(self.userid) as waiter:
+                notifier2.notify(self.userid, ROOT_TRANSACTION)
+                self.assertEqual(waiter.wait(1), ROOT_TRANSACTION)
+            with notifier1.watch(self.userid) as waiter:
+                notifier2.notify(randid(), ROOT_TRANSACTION)
+                self.assertEqual(waiter.wait(0.01), None)
+        finally:
+            notifier1.close()
+            notifier2.close()
+        # Closing the notifiers unsubscribes them from the broker.
+        self.assertFalse(channel in LocalBroker._channels)
+
+    def test_fetching_multiple_chunks(self):
+        self.app.put(self.root + "/chunks/aaaaaaaa", "a\nbc", status=201)
+        self.app.put(self.root + "/chunks/bbbbbbbb", "", status=201)
+        self.app.put(self.root + "/chunks/cccccccc", "c c", status=201)
+
+        # Chunks are returned in the order requested, skipping missing ones.
+        resp = self.app.get(self.root + "/chunks", {
+            "ids": "cccccccc,xxxxxxxx,aaaaaaaa,bbbbbbbb",
+        })
+        self.assertEqual(resp.content_type, "application/x-mentatsync-chunks")
+        self.assertEqual(parse_chunk_records(resp.body), [
+            ("cccccccc", "c c"),
+            ("aaaaaaaa", "a\nbc"),
+            ("bbbbbbbb", ""),
+        ])
+
+        # Invalid chunk ids are rejected.
+        self.app.get(self.root + "/chunks", {"ids": "a,B!"}, status=400)
+
+        # Requests with nothing to return still get an empty body.
+        resp = self.app.get(self.root + "/chunks", {"ids": "xxxxxxxx"})
+        self.assertEqual(resp.body, "")
+
+        # The number of chunks per request is capped by the server.
+        ids = ",".join(["aaaaaaaa"] * 1001)
+        self.app.get(self.root + "/chunks", {"ids": ids}, status=400)
+        if not self.distant:
+            settings = self.config.registry.settings
+            settings["mentatsync.max_chunk_ids"] = 2
+            try:
+                self.app.get(self.root + "/chunks", {
+                    "ids": "aaaaaaaa,bbbbbbbb",
+                })
+                self.app.get(self.root + "/chunks", {
+                    "ids": "aaaaaaaa,bbbbbbbb,cccccccc",
+                }, status=400)
+            finally:
+                del settings["mentatsync.max_chunk_ids"]
+
+    def test_uploading_multiple_chunks(self):
+        body = "aaaaaaaa 4\na\nbcbbbbbbbb 0\ncccccccc 3\nc c"
+        self.app.post(self.root + "/chunks", body, headers={
+            "Content-Type": "application/x-mentatsync-chunks",
+        }, status=201)
+        resp = self.app.get(self.root + "/chunks", {
+            "ids": "aaaaaaaa,bbbbbbbb,cccccccc",
+        })
+        self.assertEqual(parse_chunk_records(resp.body), [
+            ("aaaaaaaa", "a\nbc"),
+            ("bbbbbbbb", ""),
+            ("cccccccc", "c c"),
+        ])
+
+        # Re-uploading an existing chunk is harmless.
+        self.app.post(self.root + "/chunks", "aaaaaaaa 4\na\nbc", status=201)
+
+        # Malformed bodies are rejected, without writing anything.
+        body = "dddddddd 2\nddeeeeeeee 10\ntruncated"
+        self.app.post(self.root + "/chunks", body, status=400)
+        body = "ffffffff\nnolength"
+        self.app.post(self.root + "/chunks", body, status=400)
+        resp = self.app.get(self.root + "/chunks", {
+            "ids": "dddddddd,eeeeeeee,ffffffff",
+        })
+        self.assertEqual(resp.body, "")
+
+    def test_pushing_chunks_and_transactions_atomically(self):
+        trn1 = randid()
+        trn2 = randid()
+        self.app.post_json(self.root + "/push", {
+            "chunks": {
+                "aaaaaaaa": "YWFhYQ==",
+                "bbbbbbbb": "YmJiYg==",
+            },
+            "transactions": [{
+                "id": trn1,
+                "parent": ROOT_TRANSACTION,
+                "chunks": ["aaaaaaaa", "bbbbbbbb"],
+            }, {
+                "id": trn2,
+                "parent": trn1,
+                "chunks": ["bbbbbbbb"],
+            }],
+            "head": trn2,
+        }, status=201)
+        resp = self.app.get(self.root + "/head")
+        self.assertEqual(resp.json["head"], trn2)
+        resp = self.app.get(self.root + "/transactions/" + trn1)
+        self.assertEqual(resp.json["chunks"], ["aaaaaaaa", "bbbbbbbb"])
+        resp = self.app.get(self.root + "/chunks/aaaaaaaa")
+        self.assertEqual(resp.body, "aaaa")
+
+        # A push that fails to advance the head leaves nothing behind.
+        trn3 = randid()
+        self.app.post_json(self.root + "/push", {
+            "chunks": {
+                "cccccccc": "Y2NjYw==",
+            },
+            "transactions": [{
+                "id": trn3,
+                "parent": trn1,
+                "chunks": ["cccccccc"],
+            }],
+            "head": trn3,
+        }, status=409)
+        resp = self.app.get(self.root + "/head")
+        self.assertEqual(resp.json["head"], trn2)
+        self.app.get(self.root + "/transactions/" + trn3, status=404)
+        self.app.get(self.root + "/chunks/cccccccc", status=404)
+
+        # As does a push that references a missing chunk.
+        trn4 = randid()
+        self.app.post_json(self.root + "/push", {
+            "chunks": {
+                "dddddddd": "ZGRkZA==",
+            },
+            "transactions": [{
+                "id": trn4,
+                "parent": trn2,
+                "chunks": ["dddddddd", "xxxxxxxx"],
+            }],
+        }, status=404)
+        self.app.get(self.root + "/transactions/" + trn4, status=404)
+        self.app.get(self.root + "/chunks/dddddddd", status=404)
+
+    def test_pushing_malformed_bodies(self):
+        trn = {"id": randid(), "parent": ROOT_TRANSACTION, "chunks": []}
+        bad_bodies = [
+            [],
+            "bogus",
+            {"chunks": ["aaaaaaaa"]},
+            {"chunks": {"aaaaaaaa": 42}},
+            {"chunks": {"B!": "YWFhYQ=="}},
+            {"transactions": trn},
+            {"transactions": ["bogus"]},
+            {"transactions": [dict(trn, id=None)]},
+            {"transactions": [dict(trn, id="bogus")]},
+            {"transactions": [dict(trn, parent=42)]},
+            {"transactions": [dict(trn, chunks="aaaaaaaa")]},
+            {"transactions": [dict(trn, chunks=[42])]},
+            {"transactions": [{"id": trn["id"], "parent": trn["parent"]}]},
+            {"transactions": [trn], "head": 42},
+        ]
+        for body in bad_bodies:
+            self.app.post_json(self.root + "/push", body, status=400)
+        self.app.post(self.root + "/push", "{bogus", status=400)
+        self.app.get(self.root + "/transactions/" + trn["id"], status=404)
+
+    def test_transaction_with_many_chunks(self):
+        chunks = ["c%07d" % i for i in xrange(150)]
+        body = "".join("%s 1\nx" % c for c in chunks)
+        self.app.post(self.root + "/chunks", body, status=201)
+
+        # Chunks can appear more than once, and order is preserved.
+        trn_chunks = chunks + list(reversed(chunks))
+        trn1 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn1, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": trn_chunks,
+        })
+        resp = self.app.get(self.root + "/transactions/" + trn1)
+        self.assertEqual(resp.json["chunks"], trn_chunks)
+
+        # A missing chunk is detected, even after many good ones.
+        trn2 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn2, {
+            "parent": trn1,
+            "chunks": chunks + ["xxxxxxxx"],
+        }, status=404)
+        self.app.get(self.root + "/transactions/" + trn2, status=404)
+
+    def test_committing_a_long_pending_chain(self):
+        self.app.put(self.root + "/chunks/xx", "xx")
+        trns = []
+        parent = ROOT_TRANSACTION
+        for i in xrange(20):
+            trn = randid()
+            self.app.put_json(self.root + "/transactions/" + trn, {
+                "parent": parent,
+                "chunks": ["xx"],
+            })
+            trns.append(trn)
+            parent = trn
+
+        # Pending transactions are not visible.
+        resp = self.app.get(self.root + "/transactions")
+        self.assertEqual(resp.json["transactions"], [])
+
+        # We can't branch off from the middle of a pending chain.
+        self.app.put_json(self.root + "/transactions/" + randid(), {
+            "parent": trns[10],
+            "chunks": ["xx"],
+        }, status=409)
+
+        # Committing the tip commits the whole chain.
+        self.app.put_json(self.root + "/head", {
+            "head": trns[-1],
+        }, status=204)
+        resp = self.app.get(self.root + "/transactions")
+        self.assertEqual(resp.json["transactions"], trns)
+        resp = self.app.get(self.root + "/transactions/" + trns[-1])
+        self.assertEqual(resp.json["seq"], 20)
+
+        # It can't be committed a second time.
+        self.app.put_json(self.root + "/head", {
+            "head": trns[-1],
+        }, status=409)
+
+    def test_binary_chunk_payloads(self):
+        payload = "".join(chr(i) for i in xrange(256))
+        self.app.put(self.root + "/chunks/aaaaaaaa", payload, status=201)
+        resp = self.app.get(self.root + "/chunks/aaaaaaaa")
+        self.assertEqual(resp.body, payload)
+        body = "bbbbbbbb %d\n%s" % (len(payload), payload)
+        self.app.post(self.root + "/chunks", body, status=201)
+        resp = self.app.get(self.root + "/chunks", {"ids": "bbbbbbbb"})
+        self.assertEqual(parse_chunk_records(resp.body), [
+            ("bbbbbbbb", payload),
+        ])
+
+    def test_large_chunk_payloads(self):
+        # Big enough to be spooled to disk rather than held in memory,
+        # and compressible enough to be stored compressed if enabled.
+        payload = os.urandom(512 * 1024) + "x" * (512 * 1024)
+        self.app.put(self.root + "/chunks/aaaaaaaa", payload, status=201)
+        resp = self.app.get(self.root + "/chunks/aaaaaaaa")
+        self.assertEqual(resp.content_length, len(payload))
+        self.assertEqual(resp.body, payload)
+
+    def test_verifying_chunk_ids(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct storage access")
+        storage = self.get_user_storage()
+        storage.verify_chunk_ids = True
+        payload = randtext(100)
+        chunk = hashlib.sha256(payload).hexdigest()
+
+        # Chunks whose id doesn't match their content are rejected,
+        # whichever way they are uploaded.
+        self.app.put(self.root + "/chunks/aaaaaaaa", payload, status=400)
+        body = "aaaaaaaa %d\n%s" % (len(payload), payload)
+        self.app.post(self.root + "/chunks", body, status=400)
+        self.app.post_json(self.root + "/push", {
+            "chunks": {"aaaaaaaa": base64.b64encode(payload)},
+        }, status=400)
+        self.app.get(self.root + "/chunks/aaaaaaaa", status=404)
+
+        # Chunks whose id is their content hash are accepted.
+        self.app.put(self.root + "/chunks/" + chunk, payload, status=201)
+        resp = self.app.get(self.root + "/chunks/" + chunk)
+        self.assertEqual(resp.body, payload)
+
+    def test_reading_and_converting_legacy_base64_chunks(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct database access")
+        storage = self.get_sql_storage()
+        payload = "\x00legacy\xff"
+        with storage.dbconnector.connect() as session:
+            session.execute("""
+                INSERT INTO chunks (userid, chunk, payload, payload_encoding)
+                VALUES (:userid, :chunk, :payload, 'base64')
+            """, {
+                "userid": self.userid,
+                "chunk": "aaaaaaaa",
+                "payload": storage.dbconnector.to_binary_param(
+                    base64.b64encode(payload)),
+            }, {"queryName": "TEST_INSERT_BASE64_CHUNK"})
+
+        # The legacy chunk can be read as normal.
+        resp = self.app.get(self.root + "/chunks/aaaaaaaa")
+        self.assertEqual(resp.body, payload)
+
+        # And can be converted to reference a shared payload.
+        convert_payloads(storage, sleep_time=0)
+        with storage.dbconnector.connect() as session:
+            row = session.execute("""
+                SELECT payload, payload_encoding, payload_hash FROM chunks
+                WHERE userid = :userid AND chunk = :chunk
+            """, {
+                "userid": self.userid,
+                "chunk": "aaaaaaaa",
+            }, {"queryName": "TEST_GET_CHUNK_ROW"}).fetchone()
+        self.assertEqual(row["payload"], None)
+        self.assertEqual(row["payload_encoding"], None)
+        self.assertEqual(row["payload_hash"],
+                         hashlib.sha256(payload).hexdigest())
+        resp = self.app.get(self.root + "/chunks/aaaaaaaa")
+        self.assertEqual(resp.body, payload)
+
+    def test_migrating_a_baseline_database(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct database access")
+        self.get_sql_storage()
+        tempdir = tempfile.mkdtemp()
+        try:
+            # Create the tables as they were in the first release, with a
+            # committed chain t1 <- t2 and a pending chain t2 <- t3 <- t4.
+            path = os.path.join(tempdir, "old.db")
+            db = sqlite3.connect(path)
+            db.executescript("""
+                CREATE TABLE transactions (
+                    userid VARCHAR(36) NOT NULL,
+                    trnid VARCHAR(36) NOT NULL,
+                    parent VARCHAR(36) NOT NULL,
+                    committed BOOLEAN NOT NULL,
+                    seq INTEGER NOT NULL,
+                    prev_head VARCHAR(36) NOT NULL,
+                    next_head VARCHAR(36) NOT NULL,
+                    PRIMARY KEY (userid, trnid)
+                );
+                CREATE INDEX trn_usr_seq ON transactions (userid, seq);
+                CREATE INDEX trn_usr_nhead ON transactions (userid, next_head);
+                CREATE TABLE transaction_chunks (
+                    userid VARCHAR(36) NOT NULL,
+                    trnid VARCHAR(36) NOT NULL,
+                    idx INTEGER NOT NULL,
+                    chunk VARCHAR(36) NOT NULL,
+                    PRIMARY KEY (userid, trnid, idx)
+                );
+                CREATE TABLE chunks (
+                    userid VARCHAR(36) NOT NULL,
+                    chunk VARCHAR(64) NOT NULL,
+                    payload TEXT NOT NULL,
+                    PRIMARY KEY (userid, chunk)
+                );
+            """)
+            t1, t2, t3, t4 = [randid() for _ in xrange(4)]
+            db.executemany("""
+                INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, [
+                (self.userid, t1, ROOT_TRANSACTION, 1, 1, ROOT_TRANSACTION,
+                 t4),
+                (self.userid, t2, t1, 1, 2, t1, t4),
+                (self.userid, t3, t2, 0, 3, t2, t4),
+                (self.userid, t4, t3, 0, 4, t2, t4),
+            ])
+            db.execute("INSERT INTO transaction_chunks VALUES (?, ?, ?, ?)",
+                       (self.userid, t1, 0, "aaaaaaaa"))
+            db.execute("INSERT INTO chunks VALUES (?, ?, ?)",
+                       (self.userid, "aaaaaaaa", base64.b64encode("legacy")))
+            db.commit()
+            db.close()
+
+            storage = SQLStorage("sqlite:///" + path)
+            migrate_schema(storage)
+            # Running it again does nothing.
+            migrate_schema(storage)
+
+            # The head and committed history are preserved.
+            self.assertEqual(storage.get_head(self.userid), t2)
+            trns = storage.get_transactions_after(self.userid, 0, 10)
+            self.assertEqual([trn["id"] for trn in trns], [t1, t2])
+            t1_info = storage.get_transaction(self.userid, t1)
+            self.assertEqual(t1_info["chunks"], ["aaaaaaaa"])
+            self.assertTrue(t1_info["committed"])
+            t4_info = storage.get_transaction(self.userid, t4)
+            self.assertFalse(t4_info["committed"])
+            self.assertEqual(storage.get_chunk(self.userid, "aaaaaaaa"),
+                             "legacy")
+
+            # The pending chain can be extended and committed, but committed
+            # transactions can't be made the head again.
+            storage.create_chunk(self.userid, "bbbbbbbb", "new")
+            t5 = randid()
+            storage.create_transaction(self.userid, t5, t4, ["bbbbbbbb"])
+            with self.assertRaises(ConflictError):
+                storage.set_head(self.userid, t1)
+            storage.set_head(self.userid, t5)
+            self.assertEqual(storage.get_head(self.userid), t5)
+            trns = storage.get_transactions_after(self.userid, 0, 10)
+            self.assertEqual([trn["id"] for trn in trns],
+                             [t1, t2, t3, t4, t5])
+
+            # The legacy chunks can be converted.
+            convert_payloads(storage, sleep_time=0)
+            self.assertEqual(storage.get_chunk(self.userid, "aaaaaaaa"),
+                             "legacy")
+            with storage.dbconnector.connect() as session:
+                rows = session.execute("""
+                    SELECT chunk, payload_encoding, created FROM chunks
+                    ORDER BY chunk
+                """, {}, {"queryName": "TEST_GET_CHUNK_ROWS"}).fetchall()
+            self.assertEqual([row["payload_encoding"] for row in rows],
+                             [None, None])
+            self.assertEqual(rows[0]["created"], None)
+            self.assertNotEqual(rows[1]["created"], None)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_identical_payloads_are_stored_once(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct database access")
+        storage = self.get_sql_storage()
+        payload = randtext(100)
+        payload_hash = hashlib.sha256(payload).hexdigest()
+
+        def get_refcount():
+            with storage.dbconnector.connect() as session:
+                return session.execute("""
+                    SELECT refcount FROM payloads WHERE hash = :hash
+                """, {
+                    "hash": payload_hash,
+                }, {"queryName": "TEST_GET_PAYLOAD_REFCOUNT"}).scalar()
+
+        # Two users upload the same content, one of them twice over.
+        # Payloads are only shared within a shard, so keep them together.
+        other_userid = randid()
+        while self.get_user_storage(other_userid) is not storage:
+            other_userid = randid()
+        other_root = "/0.1/" + other_userid
+        self.app.put(self.root + "/chunks/aaaaaaaa", payload, status=201)
+        self.app.put(self.root + "/chunks/aaaaaaaa", payload, status=201)
+        self.app.put(self.root + "/chunks/bbbbbbbb", payload, status=201)
+        self.app.put(other_root + "/chunks/aaaaaaaa", payload, status=201)
+        self.assertEqual(get_refcount(), 3)
+        for root in (self.root, other_root):
+            resp = self.app.get(root + "/chunks/aaaaaaaa")
+            self.assertEqual(resp.body, payload)
+
+        # Resetting one user drops only their references, once their
+        # old data has been purged in the background.
+        self.app.delete(self.root)
+        self.app.get(self.root + "/chunks/aaaaaaaa", status=404)
+        self.assertEqual(get_refcount(), 3)
+        collect_garbage(storage, sleep_time=0, purge_delay=-1)
+        self.assertEqual(get_refcount(), 1)
+        resp = self.app.get(other_root + "/chunks/aaaaaaaa")
+        self.assertEqual(resp.body, payload)
+
+    def test_reset_data_is_purged_in_batches(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct database access")
+        storage = self.get_sql_storage()
+
+        def count_rows():
+            counts = {}
+            with storage.dbconnector.connect() as session:
+                for table in ("heads", "branches", "transactions",
+                              "transaction_chunks", "chunks", "dead_stores"):
+                    counts[table] = session.execute(
+                        "SELECT COUNT(*) FROM %s" % (table,), {}, {
+                            "queryName": "TEST_COUNT_" + table.upper(),
+                        }).scalar()
+            return counts
+
+        parent = ROOT_TRANSACTION
+        for i in xrange(3):
+            chunk = "chunk%03d" % (i,)
+            self.app.put(self.root + "/chunks/" + chunk, chunk)
+            trn = randid()
+            self.app.put_json(self.root + "/transactions/" + trn, {
+                "parent": parent,
+                "chunks": [chunk],
+            })
+            parent = trn
+        self.app.put_json(self.root + "/head", {"head": trn}, status=204)
+
+        # Resetting the user empties their storage immediately, and
+        # they can start writing again straight away.
+        self.app.delete(self.root)
+        self.assertEqual(self.app.get(self.root + "/head").json["head"],
+                         ROOT_TRANSACTION)
+        self.app.get(self.root + "/transactions/" + trn, status=404)
+        resp = self.app.get(self.root + "/transactions")
+        self.assertEqual(resp.json["transactions"], [])
+        self.app.put(self.root + "/chunks/chunk000", "new", status=201)
+        resp = self.app.get(self.root + "/chunks/chunk000")
+        self.assertEqual(resp.body, "new")
+
+        # But the old rows are only removed later, in small batches.
+        self.assertEqual(count_rows()["transactions"], 3)
+        self.assertEqual(storage.gc_dead_stores(), None)
+        num_batches = 0
+        storeid = storage.gc_dead_stores(limit=2, delay=-1)
+        while storeid is not None:
+            num_batches += 1
+            storeid = storage.gc_dead_stores(storeid, limit=2, delay=-1)
+        self.assertTrue(num_batches >= 4)
+        self.assertEqual(count_rows(), {
+            "heads": 0,
+            "branches": 0,
+            "transactions": 0,
+            "transaction_chunks": 0,
+            "chunks": 1,
+            "dead_stores": 0,
+        })
+        resp = self.app.get(self.root + "/chunks/chunk000")
+        self.assertEqual(resp.body, "new")
+
+    def test_losing_a_race_to_reset_rolls_back(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct database access")
+        storage = self.get_sql_storage()
+        self.app.put(self.root + "/chunks/aaaaaaaa", "data")
+        self.app.delete(self.root)
+        self.app.put(self.root + "/chunks/bbbbbbbb", "more data")
+
+        # Pretend the user's first reset happened concurrently, after we
+        # looked up their store, so creating the new store fails.
+        connect = storage.dbconnector.connect
+        outcomes = []
+
+        def spy_connect(*args, **kwds):
+            session = connect(*args, **kwds)
+            commit, rollback = session.commit, session.rollback
+            session.commit = lambda: (outcomes.append("commit"), commit())
+            session.rollback = lambda: (outcomes.append("rollback"),
+                                        rollback())
+            return session
+
+        storage.dbconnector.connect = spy_connect
+        storage._get_storeid = lambda session, userid: userid
+        try:
+            storage.reset(self.userid)
+        finally:
+            del storage.dbconnector.connect
+            del storage._get_storeid
+
+        # The failed transaction is rolled back rather than committed, and
+        # the concurrent reset stands.
+        self.assertEqual(outcomes, ["rollback"])
+        resp = self.app.get(self.root + "/chunks/bbbbbbbb")
+        self.assertEqual(resp.body, "more data")
+
+    def test_reading_immutable_data_from_replicas(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct database access")
+        storage = self.get_sql_storage()
+        tempdir = tempfile.mkdtemp()
+        replica = DBConnector("sqlite:///" + os.path.join(tempdir, "r.db"),
+                              create_tables=True)
+        storage.replicas = [replica]
+        try:
+            # Reads fall back to the primary when the replica lags behind.
+            self.app.put(self.root + "/chunks/aaaaaaaa", "primary")
+            trn = randid()
+            self.app.put_json(self.root + "/transactions/" + trn, {
+                "parent": ROOT_TRANSACTION,
+                "chunks": ["aaaaaaaa"],
+            })
+            self.app.put_json(self.root + "/head", {"head": trn}, status=204)
+            resp = self.app.get(self.root + "/transactions/" + trn)
+            self.assertEqual(resp.json["chunks"], ["aaaaaaaa"])
+            resp = self.app.get(self.root + "/chunks/aaaaaaaa")
+            self.assertEqual(resp.body, "primary")
+
+            # But chunks are served from the replica when it has them.
+            self.app.put(self.root + "/chunks/bbbbbbbb", "primary")
+            with replica.connect() as session:
+                session.execute("""
+                    INSERT INTO chunks
+                      (userid, chunk, payload, payload_encoding)
+                    VALUES (:userid, :chunk, :payload, 'identity')
+                """, {
+                    "userid": self.userid,
+                    "chunk": "bbbbbbbb",
+                    "payload": replica.to_binary_param("replica"),
+                }, {"queryName": "TEST_INSERT_REPLICA_CHUNK"})
+            resp = self.app.get(self.root + "/chunks/bbbbbbbb")
+            self.assertEqual(resp.body, "replica")
+
+            # The head is always read from the primary.
+            self.assertEqual(storage.get_head(self.userid), trn)
+
+            # An unavailable replica is skipped until it's retried.
+            storage.replicas = [DBConnector("sqlite:////no/such/dir/r.db")]
+            self.assertEqual(storage.get_chunk(self.userid, "aaaaaaaa"),
+                             "primary")
+            self.assertEqual(storage._choose_replica(), None)
+
+            # Just after a reset, reads go to the primary, so a replica
+            # that hasn't seen the reset yet can't serve old data.
+            storage.replicas = [replica]
+            self.app.delete(self.root)
+            self.app.get(self.root + "/chunks/bbbbbbbb", status=404)
+
+            # Once it's had time to catch up, the replica is used again,
+            # and it finds the user's store without asking the primary.
+            storage._replicas_stale_until[self.userid] = 0
+            resp = self.app.get(self.root + "/chunks/bbbbbbbb")
+            self.assertEqual(resp.body, "replica")
+        finally:
+            storage.replicas = []
+            shutil.rmtree(tempdir)
+
+    def test_garbage_collection(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct database access")
+        storage = self.get_sql_storage()
+        self.app.put(self.root + "/chunks/aaaaaaaa", "committed")
+        self.app.put(self.root + "/chunks/bbbbbbbb", "pending")
+        self.app.put(self.root + "/chunks/cccccccc", "unreferenced")
+        trn1 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn1, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": ["aaaaaaaa"],
+        })
+        self.app.put_json(self.root + "/head", {"head": trn1}, status=204)
+        trn2 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn2, {
+            "parent": trn1,
+            "chunks": ["bbbbbbbb"],
+        })
+
+        def count_payloads():
+            with storage.dbconnector.connect() as session:
+                return session.execute("SELECT COUNT(*) FROM payloads", {}, {
+                    "queryName": "TEST_COUNT_PAYLOADS",
+                }).scalar()
+
+        # Recently-written data is left alone.
+        collect_garbage(storage, batch_size=2, sleep_time=0)
+        self.assertEqual(storage.get_transaction(self.userid, trn2)["chunks"],
+                         ["bbbbbbbb"])
+        self.assertEqual(storage.get_chunk(self.userid, "cccccccc"),
+                         "unreferenced")
+        self.assertEqual(count_payloads(), 3)
+
+        # Uploading an old chunk again counts as using it.
+        with storage.dbconnector.connect() as session:
+            session.execute("""
+                UPDATE chunks SET created = 0 WHERE userid = :userid
+            """, {"userid": self.userid}, {"queryName": "TEST_AGE_CHUNKS"})
+        self.app.put(self.root + "/chunks/cccccccc", "unreferenced")
+        collect_garbage(storage, batch_size=2, sleep_time=0, max_age=60)
+        self.assertEqual(storage.get_chunk(self.userid, "cccccccc"),
+                         "unreferenced")
+
+        # But once it's old enough, anything not reachable from a
+        # committed transaction is deleted.
+        collect_garbage(storage, batch_size=2, sleep_time=0, max_age=-1)
+        self.assertRaises(TransactionNotFoundError,
+                          storage.get_transaction, self.userid, trn2)
+        self.assertRaises(ChunkNotFoundError,
+                          storage.get_chunk, self.userid, "bbbbbbbb")
+        self.assertRaises(ChunkNotFoundError,
+                          storage.get_chunk, self.userid, "cccccccc")
+        self.assertEqual(count_payloads(), 1)
+        self.assertEqual(storage.get_chunk(self.userid, "aaaaaaaa"),
+                         "committed")
+        if storage.filestore is not None:
+            self.assertEqual(sum(len(filenames) for _, _, filenames
+                                 in os.walk(storage.filestore.path)), 1)
+
+        # The abandoned branch can no longer be committed.
+        self.app.put_json(self.root + "/head", {"head": trn2}, status=409)
+
+    def test_garbage_collection_in_bounded_batches(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct database access")
+        storage = self.get_sql_storage()
+        chunks = ["chunk%03d" % (i,) for i in xrange(5)]
+        for chunk in chunks:
+            self.app.put(self.root + "/chunks/" + chunk, chunk)
+        trn1 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn1, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": chunks,
+        })
+        trn2 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn2, {
+            "parent": trn1,
+            "chunks": chunks,
+        })
+
+        def count_rows(table):
+            with storage.dbconnector.connect() as session:
+                return session.execute(
+                    "SELECT COUNT(*) FROM %s WHERE userid = :userid" % (
+                        table,
+                    ), {"userid": self.userid}, {
+                        "queryName": "TEST_COUNT_USER_" + table.upper(),
+                    }).scalar()
+
+        # A stale branch is killed, then deleted a transaction at a time.
+        start = (self.userid, "")
+        storage.gc_stale_branches(start, limit=2, max_age=-1)
+        self.assertEqual(count_rows("transactions"), 1)
+        self.assertEqual(count_rows("transaction_chunks"), 5)
+        self.app.put_json(self.root + "/head", {"head": trn2}, status=409)
+        self.app.put_json(self.root + "/transactions/" + randid(), {
+            "parent": trn2,
+            "chunks": [],
+        }, status=409)
+        self.assertEqual(count_rows("branches"), 1)
+        collect_garbage(storage, batch_size=2, sleep_time=0, max_age=60)
+        self.assertEqual(count_rows("transactions"), 0)
+        self.assertEqual(count_rows("transaction_chunks"), 0)
+        self.assertEqual(count_rows("branches"), 0)
+
+        # Only unreferenced chunks are selected for deletion, so they're
+        # found even if many referenced chunks come before them.
+        trn3 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn3, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": chunks[:4],
+        })
+        self.app.put_json(self.root + "/head", {"head": trn3}, status=204)
+        self.assertEqual(storage.gc_unreferenced_chunks(start, limit=1,
+                                                        max_age=-1),
+                         (self.userid, "chunk004"))
+        self.assertEqual(count_rows("chunks"), 4)
+
     def test_cant_commit_conflicting_heads(self):
         self.app.put(self.root + "/chunks/xx", "xx")
         trn1 = randid()
@@ -235,6 +1298,394 @@ class TestAPI(FunctionalTestCase):
         resp = self.app.get(self.root + "/head")
         self.assertEqual(resp.json["head"], ROOT_TRANSACTION)
 
+    def test_committing_again_after_clearing_user_data(self):
+        self.app.put(self.root + "/chunks/xx", "xx")
+        trn1 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn1, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": ["xx"],
+        })
+        self.app.put_json(self.root + "/head", {
+            "head": trn1,
+        }, status=204)
+        self.app.delete(self.root)
+
+        # The old head is gone, so we can commit a fresh history from root.
+        self.app.put(self.root + "/chunks/yy", "yy")
+        trn2 = randid()
+        self.app.put_json(self.root + "/transactions/" + trn2, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": ["yy"],
+        })
+        self.app.put_json(self.root + "/head", {
+            "head": trn2,
+        }, status=204)
+        resp = self.app.get(self.root + "/head")
+        self.assertEqual(resp.json["head"], trn2)
+        resp = self.app.get(self.root + "/transactions")
+        self.assertEqual(resp.json["transactions"], [trn2])
+
+
+class TestAPIWithFileChunkStore(TestAPI):
+
+    TEST_INI_FILE = "tests-filestore.ini"
+
+    def setUp(self):
+        self.chunk_path = tempfile.mkdtemp()
+        os.environ["MOZSVC_CHUNK_PATH"] = self.chunk_path
+        super(TestAPIWithFileChunkStore, self).setUp()
+
+    def tearDown(self):
+        super(TestAPIWithFileChunkStore, self).tearDown()
+        del os.environ["MOZSVC_CHUNK_PATH"]
+        shutil.rmtree(self.chunk_path)
+
+    def test_chunk_payloads_are_stored_as_files(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct filesystem access")
+        payload = "stored in a file"
+        digest = hashlib.sha256(payload).hexdigest()
+        self.app.put(self.root + "/chunks/aaaaaaaa", payload, status=201)
+        filepath = os.path.join(self.chunk_path, digest[:2], digest[2:4],
+                                digest)
+        with open(filepath, "rb") as f:
+            self.assertEqual(f.read(), payload)
+        resp = self.app.get(self.root + "/chunks/aaaaaaaa")
+        self.assertEqual(resp.body, payload)
+        self.assertEqual(resp.content_length, len(payload))
+
+    def test_orphaned_files_are_garbage_collected(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct filesystem access")
+        storage = self.get_sql_storage()
+        self.app.put(self.root + "/chunks/aaaaaaaa", "used", status=201)
+        trn = randid()
+        self.app.put_json(self.root + "/transactions/" + trn, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": ["aaaaaaaa"],
+        })
+        self.app.put_json(self.root + "/head", {"head": trn}, status=204)
+
+        # Simulate uploads whose database transaction was rolled back,
+        # leaving their files behind with no payload row.
+        old_orphan = storage.filestore.put("old orphan")
+        new_orphan = storage.filestore.put("new orphan")
+        old_time = time.time() - 120
+        os.utime(storage.filestore.get_path(old_orphan), (old_time, old_time))
+        self.assertEqual(storage.filestore.discard(randtext(64)), None)
+
+        # Only files old enough and without a row are deleted.
+        collect_garbage(storage, batch_size=1, sleep_time=0, max_age=60)
+        self.assertEqual(storage.filestore.get_mtime(old_orphan), None)
+        self.assertEqual(storage.filestore.get(new_orphan),
+                         "new orphan")
+        self.assertEqual(storage.get_chunk(self.userid, "aaaaaaaa"), "used")
+
+        # Storing an orphan again marks it as recently used.
+        os.utime(storage.filestore.get_path(new_orphan), (old_time, old_time))
+        storage.filestore.put("new orphan")
+        collect_garbage(storage, batch_size=1, sleep_time=0, max_age=60)
+        self.assertEqual(storage.filestore.get(new_orphan), "new orphan")
+
+        # Files that might still be in use by legacy chunks are left alone.
+        with storage.dbconnector.connect() as session:
+            session.execute("""
+                INSERT INTO chunks (userid, chunk, payload_hash,
+                                    payload_encoding)
+                VALUES (:userid, 'bbbbbbbb', :hash, 'identity')
+            """, {
+                "userid": self.userid,
+                "hash": new_orphan,
+            }, {"queryName": "TEST_INSERT_LEGACY_FILESTORE_CHUNK"})
+        self.assertEqual(storage.gc_orphaned_files(max_age=-1), None)
+        self.assertEqual(storage.get_chunk(self.userid, "bbbbbbbb"),
+                         "new orphan")
+        self.assertEqual(storage.get_chunk(self.userid, "aaaaaaaa"), "used")
+
+
+class TestAPIWithCompression(TestAPI):
+
+    TEST_INI_FILE = "tests-compression.ini"
+
+    def test_chunks_are_served_precompressed(self):
+        payload = "[:db/add 1 :x/y 2]\n" * 100
+        self.app.put(self.root + "/chunks/aaaaaaaa", payload, status=201)
+
+        # Clients that accept gzip get the stored data as-is.  We have to
+        # bypass webtest here, since it transparently decodes responses.
+        req = webob.Request.blank(self.root + "/chunks/aaaaaaaa", headers={
+            "Accept-Encoding": "gzip",
+        })
+        resp = req.get_response(self.app.app)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertTrue(resp.content_length < len(payload))
+        self.assertEqual(zlib.decompress(resp.body, 16 + zlib.MAX_WBITS),
+                         payload)
+
+        # Other clients get it decompressed.
+        for accept in (None, "gzip;q=0", "deflate"):
+            headers = {"Accept-Encoding": accept} if accept else {}
+            resp = self.app.get(self.root + "/chunks/aaaaaaaa",
+                                headers=headers)
+            self.assertFalse("Content-Encoding" in resp.headers)
+            self.assertEqual(resp.body, payload)
+
+        # Incompressible payloads are stored uncompressed.
+        payload = os.urandom(100)
+        self.app.put(self.root + "/chunks/bbbbbbbb", payload, status=201)
+        req = webob.Request.blank(self.root + "/chunks/bbbbbbbb", headers={
+            "Accept-Encoding": "gzip",
+        })
+        resp = req.get_response(self.app.app)
+        self.assertFalse("Content-Encoding" in resp.headers)
+        self.assertEqual(resp.body, payload)
+
+
+class TestAPIWithMemcachedStorage(TestAPI):
+
+    TEST_INI_FILE = "tests-memcached.ini"
+
+    def test_immutable_objects_are_served_from_cache(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct database access")
+        storage = self.config.registry["mentatsync:storage:default"]
+        self.app.put(self.root + "/chunks/aaaaaaaa", "cached", status=201)
+        trn = randid()
+        self.app.put_json(self.root + "/transactions/" + trn, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": ["aaaaaaaa"],
+        })
+        self.app.put_json(self.root + "/head", {"head": trn}, status=204)
+        self.app.get(self.root + "/chunks/aaaaaaaa")
+        self.app.get(self.root + "/transactions/" + trn)
+        self.assertEqual(self.app.get(self.root + "/head").json["head"], trn)
+
+        # Remove the underlying data behind the cache's back.
+        with storage.storage.dbconnector.connect() as session:
+            for table in ("chunks", "transaction_chunks", "transactions"):
+                session.execute("DELETE FROM %s" % (table,), {}, {
+                    "queryName": "TEST_DELETE_ALL_" + table.upper(),
+                })
+
+        # Immutable things are still served from the cache.
+        resp = self.app.get(self.root + "/chunks/aaaaaaaa")
+        self.assertEqual(resp.body, "cached")
+        resp = self.app.get(self.root + "/transactions/" + trn)
+        self.assertEqual(resp.json["chunks"], ["aaaaaaaa"])
+
+        # But resetting the user makes them disappear.
+        self.app.delete(self.root)
+        self.app.get(self.root + "/chunks/aaaaaaaa", status=404)
+        self.app.get(self.root + "/transactions/" + trn, status=404)
+
+    def test_cached_head_is_updated_when_set(self):
+        self.assertEqual(self.app.get(self.root + "/head").json["head"],
+                         ROOT_TRANSACTION)
+        trn = randid()
+        self.app.put_json(self.root + "/transactions/" + trn, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": [],
+        })
+        self.app.put_json(self.root + "/head", {"head": trn}, status=204)
+        self.assertEqual(self.app.get(self.root + "/head").json["head"], trn)
+        self.app.delete(self.root)
+        self.assertEqual(self.app.get(self.root + "/head").json["head"],
+                         ROOT_TRANSACTION)
+
+    def test_cached_head_expires(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct storage access")
+        storage = self.config.registry["mentatsync:storage:default"]
+        # The in-process client accepts fractional expiry times.
+        storage.cache_head_ttl = 0.01
+        self.assertEqual(self.app.get(self.root + "/head").json["head"],
+                         ROOT_TRANSACTION)
+
+        # Even if the head is changed behind the cache's back, the new
+        # head is served once the cached one has expired.
+        trn = randid()
+        self.app.put_json(self.root + "/transactions/" + trn, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": [],
+        })
+        storage.storage.set_head(self.userid, trn)
+        time.sleep(0.02)
+        self.assertEqual(self.app.get(self.root + "/head").json["head"], trn)
+
+    def test_cached_items_expire(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct storage access")
+        storage = self.config.registry["mentatsync:storage:default"]
+        storage.cache_ttl = 0.01
+        self.app.put(self.root + "/chunks/aaaaaaaa", "cached", status=201)
+        self.app.get(self.root + "/chunks/aaaaaaaa")
+
+        # If a reset fails to start a new generation, the items cached
+        # for the old store are still only served for a bounded time.
+        storage.storage.reset(self.userid)
+        self.app.get(self.root + "/chunks/aaaaaaaa")
+        time.sleep(0.02)
+        self.app.get(self.root + "/chunks/aaaaaaaa", status=404)
+
+    def test_items_too_large_to_cache_are_ignored(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct storage access")
+        storage = self.config.registry["mentatsync:storage:default"]
+        self.app.put(self.root + "/chunks/aaaaaaaa", "x", status=201)
+        trn = randid()
+        self.app.put_json(self.root + "/transactions/" + trn, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": ["aaaaaaaa"] * 10,
+        })
+        self.app.put_json(self.root + "/head", {"head": trn}, status=204)
+        storage.cache.max_value_size = 10
+        resp = self.app.get(self.root + "/transactions/" + trn)
+        self.assertEqual(resp.json["chunks"], ["aaaaaaaa"] * 10)
+
+
+class TestAPIWithLRUCacheStorage(TestAPI):
+
+    TEST_INI_FILE = "tests-lrucache.ini"
+
+    def test_chunks_are_cached_and_evicted_by_size(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct storage access")
+        storage = self.config.registry["mentatsync:storage:default"]
+        payload = "x" * (300 * 1024)
+        for chunk in ("aaaaaaaa", "bbbbbbbb", "cccccccc", "dddddddd"):
+            self.app.put(self.root + "/chunks/" + chunk, payload, status=201)
+
+        # Repeated reads are served from the cache.
+        for i in xrange(3):
+            resp = self.app.get(self.root + "/chunks/aaaaaaaa")
+            self.assertEqual(resp.body, payload)
+        stats = storage.get_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+
+        # The cache holds at most 1MB, so reading all four chunks
+        # will evict the least-recently-used one.
+        for chunk in ("bbbbbbbb", "cccccccc", "dddddddd"):
+            self.app.get(self.root + "/chunks/" + chunk)
+        stats = storage.get_cache_stats()
+        self.assertEqual(stats["items"], 3)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertTrue(stats["bytes"] <= stats["max_bytes"])
+        self.app.get(self.root + "/chunks/aaaaaaaa")
+        self.assertEqual(storage.get_cache_stats()["misses"], 5)
+
+        # Resetting the user clears their cached data.
+        self.app.delete(self.root)
+        self.app.get(self.root + "/chunks/dddddddd", status=404)
+
+    def test_cached_data_expires(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct storage access")
+        storage = self.config.registry["mentatsync:storage:default"]
+        storage.cache.ttl = 0
+
+        # Entries are no longer served once their TTL has passed.
+        self.app.put(self.root + "/chunks/aaaaaaaa", "aaa", status=201)
+        self.app.get(self.root + "/chunks/aaaaaaaa")
+        self.app.get(self.root + "/chunks/aaaaaaaa")
+        stats = storage.get_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (0, 2))
+
+        # And users reset before then are forgotten.
+        self.app.delete(self.root)
+        userid = randid()
+        storage.reset(userid)
+        self.assertEqual(list(storage._generations), [userid])
+
+
+class TestAPIWithShardedStorage(TestAPI):
+
+    TEST_INI_FILE = "tests-sharded.ini"
+
+    def test_users_are_spread_across_shards(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct storage access")
+        storage = self.config.registry["mentatsync:storage:default"]
+        self.assertEqual(sorted(storage.shards), ["shard1", "shard2"])
+        shard1 = storage.shards["shard1"]
+        shard2 = storage.shards["shard2"]
+        self.assertNotEqual(shard1.dbconnector, shard2.dbconnector)
+
+        # Users land on both shards, and always on the same one.
+        userids = [randid() for _ in xrange(100)]
+        names = [storage.get_shard_name(userid) for userid in userids]
+        self.assertEqual(set(names), set(["shard1", "shard2"]))
+        self.assertEqual(names, map(storage.get_shard_name, userids))
+
+        # Data written through the API is visible through the owning shard.
+        self.app.put(self.root + "/chunks/aaaaaaaa", "sharded", status=201)
+        owner = storage.get_shard(self.userid)
+        self.assertEqual(owner.get_chunk(self.userid, "aaaaaaaa"), "sharded")
+
+        # Adding a shard only moves users onto the new shard.
+        bigger = ShardedStorage(dict(storage.shards, shard3=shard1))
+        moved = 0
+        for userid, name in zip(userids, names):
+            new_name = bigger.get_shard_name(userid)
+            if new_name != name:
+                self.assertEqual(new_name, "shard3")
+                moved += 1
+        self.assertTrue(0 < moved < 60)
+
+        # Users can be explicitly pinned to a particular shard.
+        other = "shard1" if names[0] == "shard2" else "shard2"
+        pinned = ShardedStorage(storage.shards,
+                                assignments=userids[0] + ":" + other)
+        self.assertEqual(pinned.get_shard_name(userids[0]), other)
+        self.assertEqual(pinned.get_shard_name(userids[1]), names[1])
+
+
+class TestAPIWithMemoryStorage(TestAPI):
+
+    TEST_INI_FILE = "tests-memory.ini"
+
+    def test_failed_push_leaves_no_trace(self):
+        trn1 = randid()
+        trn2 = randid()
+        self.app.put(self.root + "/chunks/aaaaaaaa", "abc", status=201)
+        self.app.post_json(self.root + "/push", {
+            "chunks": {"cccccccc": "Y2Nj"},
+            "transactions": [
+                {"id": trn1, "parent": ROOT_TRANSACTION,
+                 "chunks": ["aaaaaaaa"]},
+                {"id": trn2, "parent": trn1, "chunks": ["bbbbbbbb"]},
+            ],
+            "head": trn2,
+        }, status=404)
+        self.app.get(self.root + "/transactions/" + trn1, status=404)
+        self.app.get(self.root + "/chunks/cccccccc", status=404)
+        self.assertEqual(self.app.get(self.root + "/head").json["head"],
+                         ROOT_TRANSACTION)
+        # The same transaction can then be created successfully.
+        self.app.put_json(self.root + "/transactions/" + trn1, {
+            "parent": ROOT_TRANSACTION,
+            "chunks": ["aaaaaaaa"],
+        })
+        self.app.put_json(self.root + "/head", {"head": trn1}, status=204)
+        resp = self.app.get(self.root + "/transactions?include=chunks")
+        self.assertEqual(resp.json["transactions"][0]["chunks"],
+                         ["aaaaaaaa"])
+
+    def test_reads_and_resets_dont_hold_on_to_users(self):
+        if self.distant:
+            raise unittest2.SkipTest("requires direct storage access")
+        storage = self.config.registry["mentatsync:storage:default"]
+        self.assertEqual(self.app.get(self.root + "/head").json["head"],
+                         ROOT_TRANSACTION)
+        self.app.get(self.root + "/chunks/aaaaaaaa", status=404)
+        self.app.get(self.root + "/transactions/" + randid(), status=404)
+        self.assertFalse(self.userid in storage._users)
+        self.app.put(self.root + "/chunks/aaaaaaaa", "abc", status=201)
+        self.assertTrue(self.userid in storage._users)
+        self.app.delete(self.root)
+        self.assertFalse(self.userid in storage._users)
+        self.app.get(self.root + "/chunks/aaaaaaaa", status=404)
+
 
 if __name__ == "__main__":
     # When run as a script, this file will execute the
@@ -2,25 +2,67 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import re
 import json
+import base64
+import itertools
 
 from pyramid.security import Allow
 from pyramid.request import Response
-from pyramid.httpexceptions import HTTPNotFound, HTTPConflict
+from pyramid.response import FileIter
+from pyramid.httpexceptions import (HTTPNotFound, HTTPConflict,
+                                    HTTPBadRequest)
 
 from cornice import Service
 
+from mentatsync.notify import get_notifier
+
 from mentatsync.storage import (
     ROOT_TRANSACTION,
     get_storage,
+    get_file_size,
     NotFoundError,
+    TransactionNotFoundError,
     ConflictError,
+    ChunkHashMismatchError,
 )
 
 
 UUID_REGEX = "[a-z0-9-]{36}"  # XXX TODO: make more precise...
 CHUNKID_REGEX = "[a-z0-9-]{1,64}"  # XXX TODO: make more precise...
 
+# Content-type for bodies containing a sequence of framed chunk records.
+# Each record is a header line "<chunkid> <length>\n" followed by exactly
+# that many bytes of raw payload data.
+CHUNK_RECORDS_CONTENT_TYPE = "application/x-mentatsync-chunks"
+CHUNK_RECORD_HEADER_REGEX = "^(" + CHUNKID_REGEX + ") ([0-9]{1,10})\n$"
+
+# Content-codings in which we're willing to send a single chunk, if the
+# storage backend happens to have it stored that way.
+CHUNK_CONTENT_ENCODINGS = ("gzip",)
+
+# Cache-Control header for responses whose content can never change.
+# They're still private to the user, so must not be stored in shared caches.
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+# Default and maximum number of seconds to wait for the head to change.
+# The maximum can be changed via the "mentatsync.max_watch_timeout" setting.
+DEFAULT_WATCH_TIMEOUT = 30
+MAX_WATCH_TIMEOUT = 60
+
+# Default and maximum number of transactions to return in a single page.
+# The maximum can be changed via the "mentatsync.max_transactions_limit"
+# setting.
+DEFAULT_TRANSACTIONS_LIMIT = 100
+MAX_TRANSACTIONS_LIMIT = 1000
+
+# Maximum number of chunks that can be fetched in a single request.
+# This can be changed via the "mentatsync.max_chunk_ids" setting.
+MAX_CHUNK_IDS = 1000
+
+# Size of the blocks in which to send chunk data from a file.
+FILE_BLOCK_SIZE = 64 * 1024
+
 
 def default_acl(request):
     """Default ACL: only the owner is allowed access.
@@ -31,6 +73,149 @@ def default_acl(request):
     return [(Allow, request.matchdict["userid"], "owner")]
 
 
+def set_validators(response, etag, cache_control=IMMUTABLE_CACHE_CONTROL):
+    """Set caching headers on a response, and make it conditional.
+
+    This sets a strong ETag and the given Cache-Control header on the
+    response.  Requests with a matching If-None-Match header will then
+    get a "304 Not Modified" response with no body.
+    """
+    response.etag = etag
+    response.headers["Cache-Control"] = cache_control
+    response.conditional_response = True
+
+
+def get_watch_timeout(request):
+    """Get the requested timeout for watching the head, in seconds.
+
+    Requests for longer than the configured maximum are silently capped.
+    """
+    settings = request.registry.settings
+    max_timeout = settings.get("mentatsync.max_watch_timeout",
+                               MAX_WATCH_TIMEOUT)
+    try:
+        timeout = float(request.GET.get("timeout", DEFAULT_WATCH_TIMEOUT))
+    except ValueError:
+        raise HTTPBadRequest("invalid timeout")
+    if timeout < 0:
+        raise HTTPBadRequest("invalid timeout")
+    return min(timeout, float(max_timeout))
+
+
+def get_transactions_limit(request):
+    """Get the requested page size for a transaction listing.
+
+    Requests for more than the configured maximum are silently capped.
+    """
+    settings = request.registry.settings
+    max_limit = settings.get("mentatsync.max_transactions_limit",
+                             MAX_TRANSACTIONS_LIMIT)
+    try:
+        limit = int(request.GET.get("limit", DEFAULT_TRANSACTIONS_LIMIT))
+    except ValueError:
+        raise HTTPBadRequest("invalid limit")
+    if limit < 1:
+        raise HTTPBadRequest("invalid limit")
+    return min(limit, int(max_limit))
+
+
+def encode_transactions_cursor(seq):
+    """Encode the position in a transaction listing as an opaque cursor."""
+    return base64.urlsafe_b64encode("seq:%d" % (seq,)).rstrip("=")
+
+
+def decode_transactions_cursor(cursor):
+    """Decode an opaque cursor into a position in a transaction listing."""
+    padding = "=" * (-len(cursor) % 4)
+    try:
+        cursor = base64.urlsafe_b64decode(str(cursor) + padding)
+        match = re.match("^seq:([0-9]{1,18})$", cursor)
+    except (TypeError, UnicodeError):
+        match = None
+    if match is None:
+        raise HTTPBadRequest("invalid cursor")
+    return int(match.group(1))
+
+
+def render_transactions(frm, limit, snapshot, trns, full):
+    """Generate the JSON form of a page of transactions, incrementally.
+
+    The page is built from up to limit+1 transactions, with the last one
+    being used only to tell whether to include a cursor for the next page.
+    If the listing starts from a snapshot, it's included before them.
+    """
+    yield '{"from": %s, "limit": %d, "snapshot": %s, "transactions": [' % (
+        json.dumps(frm), limit, json.dumps(snapshot))
+    next_cursor = None
+    prev_trn = None
+    for i, trn in enumerate(trns):
+        if i == limit:
+            next_cursor = encode_transactions_cursor(prev_trn["seq"])
+            break
+        if i > 0:
+            yield ", "
+        yield json.dumps(trn if full else trn["id"])
+        prev_trn = trn
+    yield '], "next": %s}' % (json.dumps(next_cursor),)
+
+
+def start_listing(get_page, userid, seq, limit):
+    """Start fetching a page of transactions after the given seq.
+
+    This fetches one more than we need, to find out if there's another
+    page.  The results are rendered incrementally as they come out of
+    storage, but we start the query now so that errors aren't hidden in
+    the body.  Returns an iterator of the remaining transactions, and a
+    list containing the first transaction if there is one.
+    """
+    trns = iter(get_page(userid, seq, limit + 1))
+    try:
+        first = [next(trns)]
+    except StopIteration:
+        first = []
+    return trns, first
+
+
+def buffer_output(iterable, size):
+    """Join small strings from an iterable into blocks of a minimum size."""
+    buf = []
+    buf_size = 0
+    for data in iterable:
+        buf.append(data)
+        buf_size += len(data)
+        if buf_size >= size:
+            yield "".join(buf)
+            buf = []
+            buf_size = 0
+    if buf:
+        yield "".join(buf)
+
+
+def render_chunk_records(chunks):
+    """Generate the framed binary form of some (chunk, payload) pairs."""
+    for chunk, payload in chunks:
+        yield ("%s %d\n" % (chunk, len(payload))).encode("ascii")
+        yield payload
+
+
+def parse_chunk_records(fileobj):
+    """Generate (chunk, payload) pairs from a framed binary file object."""
+    while True:
+        # The header line will be short, so bound how much we read for it.
+        header = fileobj.readline(100)
+        if not header:
+            break
+        match = re.match(CHUNK_RECORD_HEADER_REGEX, header)
+        if match is None:
+            raise HTTPBadRequest("invalid chunk record header")
+        chunk = match.group(1)
+        size = int(match.group(2))
+        payload = fileobj.read(size)
+        if len(payload) != size:
+            raise HTTPBadRequest("truncated chunk record")
+        yield chunk, payload
+
+
 def convert_storage_errors(func):
     def wrapped(*args, **kwds):
         try:
@@ -39,6 +224,8 @@ def convert_storage_errors(func):
             raise HTTPNotFound()
         except ConflictError:
             raise HTTPConflict()
+        except ChunkHashMismatchError:
+            raise HTTPBadRequest("chunk id does not match content hash")
     return wrapped
 
 
@@ -80,13 +267,21 @@ root = MentatSyncService(name="root", path="")
 
 head = MentatSyncService(name="head", path="/head")
 
+head_watch = MentatSyncService(name="head_watch", path="/head/watch")
+
 transactions = MentatSyncService(name="transactions", path="/transactions")
 
 transaction = MentatSyncService(name="transaction",
                                 path="/transactions/{transaction}")
 
+snapshot = MentatSyncService(name="snapshot", path="/snapshot")
+
+chunks = MentatSyncService(name="chunks", path="/chunks")
+
 chunk = MentatSyncService(name="chunk", path="/chunks/{chunk}")
 
+push = MentatSyncService(name="push", path="/push")
+
 
 @root.get()
 def get_root(request):
@@ -98,6 +293,7 @@ def delete_root(request):
     storage = get_storage(request)
     userid = request.matchdict["userid"]
     storage.reset(userid)
+    get_notifier(request).notify(userid, ROOT_TRANSACTION)
     request.response.status = 204
     return request.response
 
@@ -106,8 +302,32 @@ def delete_root(request):
 def get_head(request):
     storage = get_storage(request)
     userid = request.matchdict["userid"]
+    head = storage.get_head(userid)
+    # Clients poll this a lot, so let them cheaply check for changes.
+    set_validators(request.response, head, cache_control="no-cache")
     return {
-        "head": storage.get_head(userid)
+        "head": head
+    }
+
+
+@head_watch.get(renderer="json")
+def get_head_watch(request):
+    storage = get_storage(request)
+    userid = request.matchdict["userid"]
+    known_head = request.GET.get("head", ROOT_TRANSACTION)
+    timeout = get_watch_timeout(request)
+    # Start watching before checking the current head, so that we can't
+    # miss a change that happens in between.
+    with get_notifier(request).watch(userid) as waiter:
+        head = storage.get_head(userid)
+        if head == known_head:
+            head = waiter.wait(timeout)
+    # If the timeout expires first, the head hasn't changed, so send
+    # back the one the client already knows about.
+    if head is None:
+        head = known_head
+    return {
+        "head": head
     }
 
 
@@ -118,22 +338,67 @@ def put_head(request):
     userid = request.matchdict["userid"]
     new_head = json.loads(request.body)["head"]
     storage.set_head(userid, new_head)
+    get_notifier(request).notify(userid, new_head)
     request.response.status = 204
     return request.response
 
 
-@transactions.get(renderer="json")
+@transactions.get()
 @convert_storage_errors
 def get_transactions(request):
     storage = get_storage(request)
     userid = request.matchdict["userid"]
     frm = request.GET.get("from", ROOT_TRANSACTION)
-    limit = int(request.GET.get("limit", "100"))
-    return {
-        "from": frm,
-        "limit": limit,
-        "transactions": list(storage.get_transactions(userid, frm, limit)),
-    }
+    limit = get_transactions_limit(request)
+    include = request.GET.get("include")
+    if include is None:
+        get_page = storage.get_transactions_after
+        find_snapshot = storage.get_snapshot
+    elif include == "chunks":
+        get_page = storage.get_transactions_with_chunks_after
+        find_snapshot = storage.get_snapshot_with_chunks
+    else:
+        raise HTTPBadRequest("unsupported value for include")
+    # A cursor tells us exactly where to resume.  Otherwise we have to
+    # look up the sequence number of the "from" transaction.  If it can't
+    # be found then it may have been pruned after a snapshot was taken.
+    cursor = request.GET.get("cursor")
+    if cursor is not None:
+        seq = decode_transactions_cursor(cursor)
+    elif frm == ROOT_TRANSACTION:
+        seq = 0
+    else:
+        try:
+            seq = storage.get_transaction_seq(userid, frm)
+        except TransactionNotFoundError:
+            seq = None
+    # Listings from the root start at the newest snapshot, so that new
+    # clients don't have to replay all of the history before it.
+    snapshot = None
+    if seq is None or seq == 0:
+        snapshot = find_snapshot(userid)
+        if snapshot is not None:
+            seq = snapshot["seq"]
+        elif seq is None:
+            raise HTTPNotFound()
+    trns, first = start_listing(get_page, userid, seq, limit)
+    # Committed transactions have consecutive seqs, so a gap at the start
+    # means that the history we wanted has been pruned.  The client must
+    # start again from the snapshot that replaced it.
+    if snapshot is None and first and first[0]["seq"] != seq + 1:
+        # Let go of the first query, so it can release its connection.
+        del trns, first
+        snapshot = find_snapshot(userid)
+        if snapshot is not None and snapshot["seq"] > seq:
+            seq = snapshot["seq"]
+        else:
+            snapshot = None
+        trns, first = start_listing(get_page, userid, seq, limit)
+    body = render_transactions(frm, limit, snapshot,
+                               itertools.chain(first, trns),
+                               include is not None)
+    return Response(app_iter=buffer_output(body, FILE_BLOCK_SIZE),
+                    content_type="application/json")
 
 
 @transaction.get(renderer="json")
@@ -143,6 +408,11 @@ def get_transaction(request):
     userid = request.matchdict["userid"]
     trnid = request.matchdict["transaction"]
     trn = storage.get_transaction(userid, trnid)
+    if trn["committed"]:
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        cache_control = "no-cache"
+    set_validators(request.response, trn["id"], cache_control)
     return {
         "id": trn["id"],
         "seq": trn["seq"],
@@ -165,14 +435,92 @@ def put_transaction(request):
     return request.response
 
 
+@snapshot.get(renderer="json")
+@convert_storage_errors
+def get_snapshot(request):
+    storage = get_storage(request)
+    userid = request.matchdict["userid"]
+    snapshot = storage.get_snapshot_with_chunks(userid)
+    if snapshot is None:
+        raise HTTPNotFound()
+    # It can be replaced by a newer one, but clients can cheaply check.
+    set_validators(request.response, snapshot["id"], cache_control="no-cache")
+    return {
+        "id": snapshot["id"],
+        "seq": snapshot["seq"],
+        "chunks": snapshot["chunks"]
+    }
+
+
+@snapshot.put()
+@convert_storage_errors
+def put_snapshot(request):
+    storage = get_storage(request)
+    userid = request.matchdict["userid"]
+    params = json.loads(request.body)
+    trnid = params["id"]
+    if not re.match("^" + UUID_REGEX + "$", trnid):
+        raise HTTPBadRequest("invalid transaction id")
+    storage.create_snapshot(userid, trnid, params["chunks"])
+    request.response.status = 201
+    return request.response
+
+
+@chunks.get()
+@convert_storage_errors
+def get_chunks(request):
+    storage = get_storage(request)
+    userid = request.matchdict["userid"]
+    chunk_ids = request.GET.get("ids", "").split(",")
+    max_ids = request.registry.settings.get("mentatsync.max_chunk_ids",
+                                            MAX_CHUNK_IDS)
+    if len(chunk_ids) > int(max_ids):
+        raise HTTPBadRequest("too many chunk ids")
+    if not all(re.match("^" + CHUNKID_REGEX + "$", c) for c in chunk_ids):
+        raise HTTPBadRequest("invalid chunk id")
+    # Start the query now, so that errors aren't hidden in the body.
+    payloads = iter(storage.get_chunks(userid, chunk_ids))
+    try:
+        first = [next(payloads)]
+    except StopIteration:
+        first = []
+    payloads = itertools.chain(first, payloads)
+    return Response(app_iter=render_chunk_records(payloads),
+                    content_type=CHUNK_RECORDS_CONTENT_TYPE)
+
+
+@chunks.post()
+@convert_storage_errors
+def post_chunks(request):
+    storage = get_storage(request)
+    userid = request.matchdict["userid"]
+    records = parse_chunk_records(request.body_file)
+    storage.create_chunks(userid, records)
+    request.response.status = 201
+    return request.response
+
+
 @chunk.get()
 @convert_storage_errors
 def get_chunk(request):
     storage = get_storage(request)
     userid = request.matchdict["userid"]
     chunk = request.matchdict["chunk"]
-    payload = storage.get_chunk(userid, chunk)
-    return Response(payload)
+    # Let the storage send us pre-compressed data if the client accepts it.
+    encodings = [e for e in CHUNK_CONTENT_ENCODINGS
+                 if e in request.accept_encoding]
+    fileobj, encoding = storage.open_chunk_encoded(userid, chunk, encodings)
+    # Use the server's optimized file-sending machinery if available.
+    file_wrapper = request.environ.get("wsgi.file_wrapper", FileIter)
+    response = Response(app_iter=file_wrapper(fileobj, FILE_BLOCK_SIZE))
+    response.content_length = get_file_size(fileobj)
+    response.vary = ("Accept-Encoding",)
+    if encoding != "identity":
+        response.content_encoding = encoding
+        set_validators(response, chunk + ":" + encoding)
+    else:
+        set_validators(response, chunk)
+    return response
 
 
 @chunk.put()
@@ -181,6 +529,65 @@ def put_chunk(request):
     storage = get_storage(request)
     userid = request.matchdict["userid"]
     chunk = request.matchdict["chunk"]
-    storage.create_chunk(userid, chunk, request.body)
+    # Stream the payload from the request rather than buffering it all.
+    storage.create_chunk_from_file(userid, chunk, request.body_file)
+    request.response.status = 201
+    return request.response
+
+
+def is_string(value):
+    """Check whether a value decoded from JSON is a string."""
+    return isinstance(value, basestring)
+
+
+def validate_push_transaction(trn):
+    """Check the shape of a transaction in a push body.
+
+    Each must be an object with string "id" and "parent" keys, and a list
+    of chunk ids under "chunks".  Anything else gets a "400 Bad Request".
+    """
+    if not isinstance(trn, dict):
+        raise HTTPBadRequest("invalid transaction")
+    if not is_string(trn.get("id")) or not is_string(trn.get("parent")):
+        raise HTTPBadRequest("invalid transaction")
+    if not re.match("^" + UUID_REGEX + "$", trn["id"]):
+        raise HTTPBadRequest("invalid transaction id")
+    chunks = trn.get("chunks")
+    if not isinstance(chunks, list) or not all(map(is_string, chunks)):
+        raise HTTPBadRequest("invalid transaction chunks")
+
+
+@push.post()
+@convert_storage_errors
+def post_push(request):
+    storage = get_storage(request)
+    userid = request.matchdict["userid"]
+    try:
+        params = json.loads(request.body)
+    except ValueError:
+        raise HTTPBadRequest("invalid push body")
+    if not isinstance(params, dict):
+        raise HTTPBadRequest("invalid push body")
+    chunks = params.get("chunks", {})
+    if not isinstance(chunks, dict):
+        raise HTTPBadRequest("invalid chunks")
+    try:
+        chunks = [(chunk, base64.b64decode(payload))
+                  for (chunk, payload) in chunks.items()]
+    except (TypeError, UnicodeError):
+        raise HTTPBadRequest("invalid chunk payload")
+    if not all(re.match("^" + CHUNKID_REGEX + "$", c) for c, _ in chunks):
+        raise HTTPBadRequest("invalid chunk id")
+    transactions = params.get("transactions", [])
+    if not isinstance(transactions, list):
+        raise HTTPBadRequest("invalid transactions")
+    for trn in transactions:
+        validate_push_transaction(trn)
+    head = params.get("head")
+    if head is not None and not is_string(head):
+        raise HTTPBadRequest("invalid head")
+    storage.push(userid, chunks, transactions, head)
+    if head is not None:
+        get_notifier(request).notify(userid, head)
     request.response.status = 201
     return request.response
@@ -14,6 +14,11 @@ install_requires = ['SQLALchemy', 'unittest2', 'simplejson', 'pyramid',
 entry_points = """
 [paste.app_factory]
 main = mentatsync:main
+
+[console_scripts]
+mentatsync-convert-payloads = mentatsync.scripts.convert_payloads:main
+mentatsync-gc = mentatsync.scripts.gc:main
+mentatsync-migrate-schema = mentatsync.scripts.migrate_schema:main
 """
 
 version = "0.0.1"